@@ -180,7 +180,7 @@ function constructQuery(filters, documentFilter) {
     }
 
     if (tags) {
-      conditions.push("tags ILIKE $" + (query.values.length + 1));
+      conditions.push("EXISTS (SELECT 1 FROM unnest(tags) AS tag WHERE tag ILIKE $" + (query.values.length + 1) + ")");
       query.values.push(`%${tags}%`);
     }
 
@@ -0,0 +1,425 @@
+"""Benchmark the pull, summarize and refresh stages offline.
+
+Each scale gets a fresh scratch database and stub Federal Register and
+Claude APIs (see stubs.py); each stage runs in its own process against
+them, so its peak RSS is its own. Results are written as JSON, and two
+result files can be compared with --compare.
+
+    python benchmarks/run_benchmarks.py --database-url postgresql://postgres@localhost/postgres --scales 1000 10000
+    python benchmarks/run_benchmarks.py --pg-bin /usr/lib/postgresql/16/bin
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/before.json benchmarks/results/after.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psycopg2
+from psycopg2.extensions import make_dsn
+
+from stubs import DocumentSource, StubClaudeAPI, StubFederalRegisterAPI
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+STAGES = ['pull', 'summarize', 'refresh']
+DEFAULT_SCALES = [1000, 10000, 100000]
+# Compared between runs, with whether a higher value is better
+COMPARED_METRICS = [
+    ('documents_per_second', True),
+    ('latency_p50_seconds', False),
+    ('latency_p95_seconds', False),
+    ('db_round_trips', False),
+    ('peak_rss_mb', False),
+]
+
+class ThrowawayPostgres:
+    """Scratch databases, created on an existing server or on a temporary cluster started with initdb, and dropped afterwards."""
+
+    def __init__(self, server_url=None, pg_bin=None):
+        self.server_url = server_url
+        self.pg_bin = pg_bin
+        self.cluster_dir = None
+        self.databases = []
+
+    def _tool(self, name):
+        path = os.path.join(self.pg_bin, name) if self.pg_bin else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise SystemExit(f"{name} not found; pass --pg-bin, or --database-url to use an existing server")
+        return path
+
+    def __enter__(self):
+        if self.server_url is None:
+            self.cluster_dir = tempfile.mkdtemp(prefix='pipeline-benchmark-pg-')
+            data_dir = os.path.join(self.cluster_dir, 'data')
+            subprocess.run([self._tool('initdb'), '-D', data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                           check=True, capture_output=True)
+            # Unix socket only, so the cluster can't clash with a server already on the default port
+            subprocess.run([self._tool('pg_ctl'), '-D', data_dir, '-l', os.path.join(self.cluster_dir, 'postgres.log'), '-w',
+                            '-o', f"-c listen_addresses='' -k {self.cluster_dir}", 'start'],
+                           check=True, capture_output=True)
+            self.server_url = make_dsn(user='postgres', dbname='postgres', host=self.cluster_dir)
+        return self
+
+    def __exit__(self, *exc_info):
+        for name in self.databases:
+            self._admin(f"DROP DATABASE IF EXISTS {name}")
+        if self.cluster_dir is not None:
+            subprocess.run([self._tool('pg_ctl'), '-D', os.path.join(self.cluster_dir, 'data'), '-m', 'fast', 'stop'],
+                           capture_output=True)
+            shutil.rmtree(self.cluster_dir, ignore_errors=True)
+
+    def _admin(self, statement):
+        conn = psycopg2.connect(self.server_url)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(statement)
+        finally:
+            conn.close()
+
+    def server_version(self):
+        with psycopg2.connect(self.server_url) as conn, conn.cursor() as cur:
+            cur.execute("SHOW server_version")
+            return cur.fetchone()[0]
+
+    def create_database(self, name):
+        """Create an empty database with the pipeline's schema and return its URL."""
+        self._admin(f"DROP DATABASE IF EXISTS {name}")
+        self._admin(f"CREATE DATABASE {name}")
+        self.databases.append(name)
+        url = make_dsn(self.server_url, dbname=name)
+        sys.path.insert(0, REPO_DIR)
+        from scripts import migrate
+        migrate.migrate(url, batch_pause=0)
+        return url
+
+class DocumentTracker:
+    """When each document entered a stage and when its result was committed, for per-document latencies."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = {}
+        self.finished = {}
+
+    def start(self, document_numbers):
+        now = time.perf_counter()
+        with self.lock:
+            for document_number in document_numbers:
+                self.started.setdefault(document_number, now)
+
+    def finish(self, document_numbers):
+        now = time.perf_counter()
+        with self.lock:
+            for document_number in document_numbers:
+                self.finished[document_number] = now
+
+    def latencies(self):
+        return np.array([finished - self.started[document_number]
+                         for document_number, finished in self.finished.items() if document_number in self.started])
+
+class RoundTripCounter:
+    """Counts statements, COPYs, commits and rollbacks sent over every psycopg2 connection opened after install()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, n=1):
+        with self.lock:
+            self.count += n
+
+    def install(self):
+        """Wrap psycopg2.connect so every connection and cursor counts its round trips.
+
+        The counting classes subclass whatever connection and cursor
+        factories the code under test asks for, so its own instrumentation keeps working.
+        """
+        counter = self
+        counting_classes = {}
+
+        def counting_cursor_class(base):
+            if base not in counting_classes:
+                class CountingCursor(base):
+                    def execute(self, query, vars=None):
+                        counter.add()
+                        return super().execute(query, vars)
+
+                    def executemany(self, query, vars_list):
+                        vars_list = list(vars_list)
+                        counter.add(len(vars_list))
+                        return super().executemany(query, vars_list)
+
+                    def copy_expert(self, sql, file, size=8192):
+                        counter.add()
+                        return super().copy_expert(sql, file, size)
+
+                counting_classes[base] = CountingCursor
+            return counting_classes[base]
+
+        def counting_connection_class(base):
+            if base not in counting_classes:
+                class CountingConnection(base):
+                    def cursor(self, *args, **kwargs):
+                        kwargs['cursor_factory'] = counting_cursor_class(
+                            kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor)
+                        return super().cursor(*args, **kwargs)
+
+                    def commit(self):
+                        counter.add()
+                        return super().commit()
+
+                    def rollback(self):
+                        counter.add()
+                        return super().rollback()
+
+                counting_classes[base] = CountingConnection
+            return counting_classes[base]
+
+        connect = psycopg2.connect
+
+        def counting_connect(*args, **kwargs):
+            kwargs['connection_factory'] = counting_connection_class(
+                kwargs.get('connection_factory') or psycopg2.extensions.connection)
+            return connect(*args, **kwargs)
+
+        psycopg2.connect = counting_connect
+
+def setup_pull(tracker, scale, options):
+    """Documents enter when parsed from a search page and finish when their insert batch commits."""
+    from scripts import pull_fr_documents as pull
+
+    from_api = pull.FRDocumentRecord.from_api
+    insert_to_postgres = pull.insert_to_postgres
+
+    def tracked_from_api(cls, doc):
+        tracker.start([doc.get('document_number')])
+        return from_api(doc)
+
+    def tracked_insert_to_postgres(conn, records):
+        inserted_document_numbers = insert_to_postgres(conn, records)
+        tracker.finish(record.document_number for record in records)
+        return inserted_document_numbers
+
+    pull.FRDocumentRecord.from_api = classmethod(tracked_from_api)
+    pull.insert_to_postgres = tracked_insert_to_postgres
+    return lambda: pull.main(terms=[], start_date='2024-01-01', end_date='2024-12-31', limit=options['per_page'])
+
+def setup_summarize(tracker, scale, options):
+    """Documents enter when claimed and finish when their classification is written back."""
+    from scripts import summarize_fr_documents as summarize
+
+    claim_pending_rows = summarize.claim_pending_rows
+    update_rows_in_postgres = summarize.update_rows_in_postgres
+
+    def tracked_claim_pending_rows(*args, **kwargs):
+        rows = claim_pending_rows(*args, **kwargs)
+        tracker.start(row[0] for row in rows)
+        return rows
+
+    def tracked_update_rows_in_postgres(conn, rows, worker_id=None):
+        written = update_rows_in_postgres(conn, rows, worker_id)
+        tracker.finish(written)
+        return written
+
+    summarize.claim_pending_rows = tracked_claim_pending_rows
+    summarize.update_rows_in_postgres = tracked_update_rows_in_postgres
+    return lambda: summarize.main(limit=scale, max_concurrency=options['llm_concurrency'],
+                                  max_requests_per_minute=options['llm_client_rpm'],
+                                  max_tokens_per_minute=options['llm_client_tpm'])
+
+def setup_refresh(tracker, scale, options):
+    """Documents enter when their multi-ID request is started and finish when their counts are written."""
+    from scripts import update_fr_documents as update
+
+    fetch_counts = update.fetch_counts
+    write_counts_to_both_tables = update.write_counts_to_both_tables
+
+    async def tracked_fetch_counts(client, rate_limiter, semaphore, document_numbers):
+        tracker.start(document_numbers)
+        return await fetch_counts(client, rate_limiter, semaphore, document_numbers)
+
+    def tracked_write_counts_to_both_tables(conn, counts):
+        write_counts_to_both_tables(conn, counts)
+        tracker.finish(count[0] for count in counts)
+
+    update.fetch_counts = tracked_fetch_counts
+    update.write_counts_to_both_tables = tracked_write_counts_to_both_tables
+    # Enough multi-ID requests to cover every document once
+    request_budget = math.ceil(scale / update.FETCH_BATCH_SIZE)
+    return lambda: update.main(request_budget=request_budget, max_concurrency=options['fr_concurrency'],
+                               max_requests_per_minute=options['fr_client_rpm'])
+
+STAGE_SETUP = {'pull': setup_pull, 'summarize': setup_summarize, 'refresh': setup_refresh}
+
+def run_stage(stage, scale, environment, options, results):
+    """Run one stage in this (fresh) process and put its measurements on the results queue."""
+    os.environ.update(environment)
+    sys.path.insert(0, REPO_DIR)
+    round_trips = RoundTripCounter()
+    round_trips.install()
+    tracker = DocumentTracker()
+    run = STAGE_SETUP[stage](tracker, scale, options)
+    if not options['verbose']:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - started
+
+    latencies = tracker.latencies()
+    results.put({
+        'documents': len(tracker.finished),
+        'seconds': round(seconds, 3),
+        'documents_per_second': round(len(tracker.finished) / seconds, 1) if seconds else None,
+        'latency_p50_seconds': round(float(np.percentile(latencies, 50)), 4) if len(latencies) else None,
+        'latency_p95_seconds': round(float(np.percentile(latencies, 95)), 4) if len(latencies) else None,
+        'db_round_trips': round_trips.count,
+        'baseline_rss_mb': round(baseline_rss_kb / 1024, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+def run_scale(postgres, scale, stages, options, work_dir):
+    source = DocumentSource(scale, recorded_path=options['recorded_documents'])
+    database_url = postgres.create_database(f"pipeline_benchmark_{scale}")
+    fr_api = StubFederalRegisterAPI(source, latency_seconds=options['fr_latency'], requests_per_minute=options['fr_server_rpm'])
+    claude_api = StubClaudeAPI(latency_seconds=options['llm_latency'], requests_per_minute=options['llm_server_rpm'])
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with fr_api, claude_api:
+        environment = {
+            'DATABASE_URL': database_url,
+            'FR_DOCUMENTS_TABLE_NAME': 'fr_documents',
+            'AI_DOCUMENTS_TABLE_NAME': 'ai_documents',
+            'FR_API_BASE_URL': fr_api.api_base_url,
+            # A cold HTTP cache per scale, kept away from the real one
+            'FR_HTTP_CACHE_PATH': os.path.join(work_dir, f"fr_http_cache_{scale}.sqlite"),
+            'CLAUDE_API_KEY': 'benchmark',
+            'CLAUDE_API_BASE_URL': claude_api.url,
+            'TQDM_DISABLE': '' if options['verbose'] else '1',
+        }
+        for stage in stages:
+            fr_api.reset_stats()
+            claude_api.reset_stats()
+            logger.info(f"Running {stage} at {scale} documents")
+            queue = context.Queue()
+            process = context.Process(target=run_stage, args=(stage, scale, environment, options, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"{stage} at {scale} documents exited with code {process.exitcode}")
+            api = claude_api if stage == 'summarize' else fr_api
+            result = {'scale': scale, 'stage': stage, **queue.get(),
+                      'api_requests': api.stats['requests'], 'api_rate_limited': api.stats['rate_limited']}
+            logger.info(
+                f"{stage} at {scale}: {result['documents_per_second']} docs/s, p50 {result['latency_p50_seconds']}s, "
+                f"p95 {result['latency_p95_seconds']}s, {result['db_round_trips']} DB round-trips, peak RSS {result['peak_rss_mb']} MB"
+            )
+            results.append(result)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scales, stages, options, database_url=None, pg_bin=None, output=None):
+    commit = git_commit()
+    with ThrowawayPostgres(database_url, pg_bin) as postgres, tempfile.TemporaryDirectory(prefix='pipeline-benchmark-') as work_dir:
+        report = {
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git_commit': commit,
+            'python': platform.python_version(),
+            'postgres': postgres.server_version(),
+            'options': options,
+            'results': [],
+        }
+        for scale in scales:
+            report['results'].extend(run_scale(postgres, scale, stages, options, work_dir))
+
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote results to {output}")
+    return report
+
+def compare(before_path, after_path):
+    """Print each metric's change between two result files, for the stages and scales they share."""
+    with open(before_path) as f:
+        before = {(result['stage'], result['scale']): result for result in json.load(f)['results']}
+    with open(after_path) as f:
+        after = {(result['stage'], result['scale']): result for result in json.load(f)['results']}
+
+    print(f"{'stage':<10} {'scale':>7} {'metric':<22} {'before':>12} {'after':>12} {'change':>9}")
+    for key in sorted(before.keys() & after.keys(), key=lambda key: (STAGES.index(key[0]), key[1])):
+        for metric, higher_is_better in COMPARED_METRICS:
+            old, new = before[key].get(metric), after[key].get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            verdict = ''
+            if abs(change) >= 0.05:
+                verdict = 'better' if (change > 0) == higher_is_better else 'worse'
+            print(f"{key[0]:<10} {key[1]:>7} {metric:<22} {old:>12} {new:>12} {change:>+8.1%} {verdict}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against stub APIs and a scratch database.")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="Compare two result files instead of running.")
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES, help="Document counts to benchmark at.")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help="Stages to run, in pipeline order; later stages work on what earlier ones loaded.")
+    parser.add_argument('--database-url', help="Server to create scratch databases on; by default a temporary cluster is started.")
+    parser.add_argument('--pg-bin', help="Directory with initdb and pg_ctl, if they aren't on PATH.")
+    parser.add_argument('--output', help="Result file; defaults to benchmarks/results/<time>-<commit>.json.")
+    parser.add_argument('--recorded-documents', help="JSON lines of recorded API documents to serve instead of synthetic ones.")
+    parser.add_argument('--per-page', type=int, default=1000, help="Search page size for the pull stage.")
+    parser.add_argument('--fr-latency', type=float, default=0.05, help="Median stub Federal Register API latency in seconds.")
+    parser.add_argument('--fr-server-rpm', type=int, help="Requests per minute the stub Federal Register API allows before answering 429.")
+    parser.add_argument('--fr-client-rpm', type=int, default=10 ** 6, help="The refresher's own request rate cap.")
+    parser.add_argument('--fr-concurrency', type=int, default=100)
+    parser.add_argument('--llm-latency', type=float, default=0.2, help="Median stub Claude API latency in seconds, plus 0.02s per document.")
+    parser.add_argument('--llm-server-rpm', type=int, help="Requests per minute the stub Claude API allows before answering 429.")
+    parser.add_argument('--llm-client-rpm', type=int, default=10 ** 6, help="The summarizer's own request rate cap.")
+    parser.add_argument('--llm-client-tpm', type=int, default=10 ** 9, help="The summarizer's own token rate cap.")
+    parser.add_argument('--llm-concurrency', type=int, default=8)
+    parser.add_argument('--verbose', action='store_true', help="Show the stages' own logs and progress bars.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        options = {
+            'recorded_documents': args.recorded_documents,
+            'per_page': args.per_page,
+            'fr_latency': args.fr_latency,
+            'fr_server_rpm': args.fr_server_rpm,
+            'fr_client_rpm': args.fr_client_rpm,
+            'fr_concurrency': args.fr_concurrency,
+            'llm_latency': args.llm_latency,
+            'llm_server_rpm': args.llm_server_rpm,
+            'llm_client_rpm': args.llm_client_rpm,
+            'llm_client_tpm': args.llm_client_tpm,
+            'llm_concurrency': args.llm_concurrency,
+            'verbose': args.verbose,
+        }
+        stages = [stage for stage in STAGES if stage in args.stages]
+        run_benchmarks(args.scales, stages, options, database_url=args.database_url, pg_bin=args.pg_bin, output=args.output)
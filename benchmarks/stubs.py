@@ -0,0 +1,323 @@
+"""Local stand-ins for the Federal Register API and the Claude Messages API, for benchmarking the pipeline offline."""
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+AGENCIES = [
+    'Commerce Department', 'National Institute of Standards and Technology', 'Federal Trade Commission',
+    'Environmental Protection Agency', 'Transportation Department', 'Federal Aviation Administration',
+    'Health and Human Services Department', 'Food and Drug Administration', 'Energy Department',
+    'Federal Energy Regulatory Commission', 'Defense Department', 'Homeland Security Department',
+    'Securities and Exchange Commission', 'Agriculture Department', 'National Oceanic and Atmospheric Administration',
+]
+# Roughly the mix of document types published in a year
+DOCUMENT_TYPES = [('Notice', 0.70), ('Rule', 0.15), ('Proposed Rule', 0.12), ('Presidential Document', 0.03)]
+VOCABULARY = (
+    'agency proposes amend regulations require information collection public comment request approval office '
+    'management budget rule final effective date federal register docket safety standard review program '
+    'application permit emission facility airworthiness directive aircraft model fishery quota season area '
+    'hearing meeting committee advisory notice availability environmental impact statement tariff trade '
+    'export controls semiconductor data privacy consumer protection health device clinical grant funding'
+).split()
+AI_PHRASES = ['artificial intelligence', 'machine learning models', 'automated decision systems', 'AI risk management']
+
+# Shares of synthetic documents that are recurring meeting notices, which differ only in dates and
+# docket numbers, and that mention AI
+RECURRING_SHARE = 0.10
+AI_SHARE = 0.03
+# Lengths are lognormal, like the real corpus: most abstracts are a paragraph, a few run to pages,
+# and about a quarter of notices have none at all
+ABSTRACT_MEDIAN_CHARS = 700
+ABSTRACT_SIGMA = 0.6
+ABSTRACT_MAX_CHARS = 6000
+EMPTY_ABSTRACT_SHARE = 0.25
+
+def words(rng, n_chars):
+    text = []
+    length = 0
+    while length < n_chars:
+        word = rng.choice(VOCABULARY)
+        text.append(word)
+        length += len(word) + 1
+    return ' '.join(text)
+
+def synthetic_document(index, seed=0):
+    """A search-result document shaped like the API's, generated deterministically from its index."""
+    rng = random.Random(seed * 1000003 + index)
+    document_type = rng.choices([name for name, _ in DOCUMENT_TYPES], [share for _, share in DOCUMENT_TYPES])[0]
+    agency = rng.choice(AGENCIES)
+    publication_date = f"2024-{1 + index % 12:02d}-{1 + index % 28:02d}"
+    document_number = f"2024-{index:06d}"
+
+    if rng.random() < RECURRING_SHARE:
+        committee = rng.randrange(40)
+        title = f"{agency} Advisory Committee {committee}; Notice of Public Meeting"
+        abstract = (f"This notice announces a meeting of the {agency} Advisory Committee {committee}. The committee will meet "
+                    f"on {publication_date} to discuss program updates and receive public comment. Docket {rng.randrange(10 ** 6)}.")
+    else:
+        title = words(rng, min(int(rng.lognormvariate(math.log(90), 0.4)), 400)).capitalize()
+        abstract = ''
+        if rng.random() >= EMPTY_ABSTRACT_SHARE:
+            abstract = words(rng, min(int(rng.lognormvariate(math.log(ABSTRACT_MEDIAN_CHARS), ABSTRACT_SIGMA)), ABSTRACT_MAX_CHARS))
+        if rng.random() < AI_SHARE:
+            abstract = f"{abstract} This action addresses {rng.choice(AI_PHRASES)}."
+
+    docket_id = f"{agency[:3].upper()}-2024-{rng.randrange(10 ** 4):04d}"
+    return {
+        'abstract': abstract or None,
+        'action': rng.choice(['Notice.', 'Final rule.', 'Proposed rule.', 'Notice of meeting.']),
+        'agency_names': [agency],
+        'html_url': f"https://www.federalregister.gov/documents/{publication_date.replace('-', '/')}/{document_number}/x",
+        'body_html_url': f"https://www.federalregister.gov/documents/full_text/html/{document_number}.html",
+        'citation': f"89 FR {rng.randrange(1, 99999)}",
+        'comment_url': None,
+        'comments_close_on': f"2099-{1 + index % 12:02d}-01" if document_type == 'Proposed Rule' else None,
+        'dates': f"Comments must be received by {publication_date}." if document_type == 'Proposed Rule' else None,
+        'docket_ids': [docket_id],
+        'document_number': document_number,
+        'effective_on': publication_date if document_type == 'Rule' else None,
+        'excerpts': abstract[:250] if abstract else None,
+        'full_text_xml_url': f"https://www.federalregister.gov/documents/full_text/xml/{document_number}.xml",
+        'json_url': f"https://www.federalregister.gov/api/v1/documents/{document_number}.json",
+        'page_views': {'count': rng.randrange(5000)},
+        'publication_date': publication_date,
+        'raw_text_url': f"https://www.federalregister.gov/documents/full_text/text/{document_number}.txt",
+        'regulations_dot_gov_info': {'docket_id': docket_id, 'docket_comments_count': rng.randrange(50)},
+        'regulations_dot_gov_url': None,
+        'significant': rng.random() < 0.05,
+        'subtype': None,
+        'title': title,
+        'toc_doc': title[:80],
+        'toc_subject': agency,
+        'topics': [],
+        'type': document_type,
+    }
+
+class DocumentSource:
+    """The documents a stub API serves: synthetic ones, or recorded API documents replayed under new document numbers."""
+
+    def __init__(self, count, recorded_path=None, seed=0):
+        self.count = count
+        self.seed = seed
+        self.recorded = None
+        if recorded_path:
+            with open(recorded_path) as f:
+                self.recorded = [json.loads(line) for line in f if line.strip()]
+
+    def document(self, index):
+        if self.recorded:
+            document = dict(self.recorded[index % len(self.recorded)])
+            document['document_number'] = f"{document.get('document_number', 'recorded')}-{index:06d}"
+            return document
+        return synthetic_document(index, self.seed)
+
+    def index_of(self, document_number):
+        return int(document_number.rsplit('-', 1)[-1])
+
+class SlidingWindowLimiter:
+    """Answers whether a request fits in a requests-per-minute cap, like the real APIs' rate limits."""
+
+    def __init__(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.sent = deque()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.requests_per_minute:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            while self.sent and now - self.sent[0] >= 60:
+                self.sent.popleft()
+            if len(self.sent) >= self.requests_per_minute:
+                return False
+            self.sent.append(now)
+            return True
+
+class StubServer:
+    """A threaded HTTP server on a free local port, with request counters and simulated latency and rate limits."""
+
+    def __init__(self, latency_seconds=0.05, requests_per_minute=None, retry_after_seconds=1.0):
+        self.latency_seconds = latency_seconds
+        self.limiter = SlidingWindowLimiter(requests_per_minute)
+        self.retry_after_seconds = retry_after_seconds
+        self.stats = {'requests': 0, 'rate_limited': 0, 'bytes_sent': 0}
+        self.stats_lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.dispatch(self, 'GET')
+
+            def do_POST(self):
+                stub.dispatch(self, 'POST')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {key: 0 for key in self.stats}
+
+    def dispatch(self, handler, method):
+        body = handler.rfile.read(int(handler.headers.get('content-length') or 0))
+        with self.stats_lock:
+            self.stats['requests'] += 1
+        if not self.limiter.allow():
+            with self.stats_lock:
+                self.stats['rate_limited'] += 1
+            self.send(handler, 429, self.rate_limit_body(), {'Retry-After': str(self.retry_after_seconds)})
+            return
+        # Latencies are lognormal around the configured median, so a few requests are slow
+        time.sleep(self.latency_seconds * random.lognormvariate(0, 0.5))
+        status, payload = self.respond(method, urlparse(handler.path), body)
+        self.send(handler, status, payload)
+
+    def send(self, handler, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        with self.stats_lock:
+            self.stats['bytes_sent'] += len(data)
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        try:
+            handler.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting, as the real APIs' clients sometimes do
+            pass
+
+    def rate_limit_body(self):
+        return {'status': 429, 'message': 'Rate limit exceeded'}
+
+    def respond(self, method, url, body):
+        raise NotImplementedError
+
+class StubFederalRegisterAPI(StubServer):
+    """Serves the search endpoint pull_fr_documents pages through and the document endpoints update_fr_documents reads counts from.
+
+    Search results are served from the document source in order, whatever
+    the date conditions. A multi-ID lookup drops missing_share of its
+    documents, so the per-document fallback is exercised as it is in production.
+    """
+
+    def __init__(self, source, missing_share=0.01, **kwargs):
+        super().__init__(**kwargs)
+        self.source = source
+        self.missing_share = missing_share
+
+    @property
+    def api_base_url(self):
+        return f"{self.url}/api/v1"
+
+    def respond(self, method, url, body):
+        path = url.path
+        if path.endswith('/documents.json'):
+            return 200, self.search_page(parse_qs(url.query))
+        match = re.search(r'/documents/([^/]+)\.json$', path)
+        if not match:
+            return 404, {'status': 404, 'message': 'Not found'}
+        document_numbers = match.group(1).split(',')
+        if len(document_numbers) == 1:
+            return 200, self.counts(document_numbers[0])
+        results = [self.counts(document_number) for document_number in document_numbers
+                   if random.random() >= self.missing_share]
+        return 200, {'count': len(results), 'results': results}
+
+    def search_page(self, query):
+        per_page = int(query.get('per_page', ['20'])[0])
+        page = int(query.get('page', ['1'])[0])
+        total_pages = max(1, math.ceil(self.source.count / per_page))
+        start = (page - 1) * per_page
+        response = {
+            'count': self.source.count,
+            'total_pages': total_pages,
+            'results': [self.source.document(index) for index in range(start, min(start + per_page, self.source.count))],
+        }
+        if page < total_pages:
+            response['next_page_url'] = f"{self.api_base_url}/documents.json?page={page + 1}&per_page={per_page}"
+        return response
+
+    def counts(self, document_number):
+        # Counts drift between refreshes, the way real page views and comments do
+        index = self.source.index_of(document_number)
+        return {
+            'document_number': document_number,
+            'page_views': {'count': index % 5000 + random.randrange(20)},
+            'regulations_dot_gov_info': {'comments_count': index % 50 + random.randrange(3)},
+        }
+
+class StubClaudeAPI(StubServer):
+    """Answers Messages API requests with the forced tool call, labelling documents AI-related by keyword.
+
+    Latency grows with the number of documents in a packed request, as
+    output tokens do with the real model.
+    """
+
+    def __init__(self, latency_per_document_seconds=0.02, **kwargs):
+        super().__init__(**kwargs)
+        self.latency_per_document_seconds = latency_per_document_seconds
+
+    def rate_limit_body(self):
+        return {'type': 'error', 'error': {'type': 'rate_limit_error', 'message': 'Number of requests has exceeded your rate limit'}}
+
+    @staticmethod
+    def classify(text):
+        lowered = text.lower()
+        ai_related = int(any(phrase.lower() in lowered for phrase in AI_PHRASES))
+        return {'ai_related': ai_related, 'llm_summary': '* Stub summary.' if ai_related else '',
+                'tags': ['Policy & Standards'] if ai_related else []}
+
+    def respond(self, method, url, body):
+        request = json.loads(body)
+        content = request['messages'][0]['content']
+        prompt = content if isinstance(content, str) else ''.join(block.get('text', '') for block in content)
+        tool_name = (request.get('tool_choice') or {}).get('name', 'record_classification')
+
+        documents = re.split(r'Document number: (\S+)', prompt)
+        if len(documents) > 1:
+            payload = {'classifications': [dict(self.classify(text), document_number=document_number)
+                                           for document_number, text in zip(documents[1::2], documents[2::2])]}
+            document_count = len(payload['classifications'])
+        else:
+            payload = self.classify(prompt)
+            document_count = 1
+        time.sleep(self.latency_per_document_seconds * document_count)
+
+        return 200, {
+            'id': 'msg_benchmark',
+            'type': 'message',
+            'role': 'assistant',
+            'model': request.get('model'),
+            'content': [{'type': 'tool_use', 'id': 'toolu_benchmark', 'name': tool_name, 'input': payload}],
+            'stop_reason': 'tool_use',
+            'stop_sequence': None,
+            'usage': {'input_tokens': len(prompt) // 4, 'output_tokens': 60 * document_count,
+                      'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0},
+        }
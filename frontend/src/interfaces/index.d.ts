@@ -46,7 +46,7 @@ export interface IDocument {
   regulations_dot_gov_docket_id: string;
   regulations_dot_gov_document_id: string;
   page_views_count: number;
-  tags: string;
+  tags: string[];
 }
 
 interface IImage {
@@ -0,0 +1,7 @@
+"""Pipeline that pulls Federal Register documents, classifies them for AI relevance and keeps their counts fresh.
+
+Each stage is a module with a main() for library use and a cli() behind
+its console script. Nothing connects to a database or an API on import;
+settings come from a Config, read from the environment on first use.
+"""
+from .config import Config, ConfigError, get_config, set_config
@@ -0,0 +1,317 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import psycopg2
+
+from .config import ConfigError, get_config
+from .text_features import hashed_term_counts
+
+logger = logging.getLogger(__name__)
+
+FR_DOCUMENTS_TABLE_NAME = os.environ.get('FR_DOCUMENTS_TABLE_NAME', 'fr_documents')
+# Has to be on a persistent volume (on Railway, the service's volume mount path): the index is updated
+# incrementally, and one left on the container's ephemeral disk is refitted from scratch after every deploy
+SIMILARITY_INDEX_DIR = os.environ.get('SIMILARITY_INDEX_DIR')
+SIMILARITY_FEATURES = 2 ** 16
+SIMILARITY_DIMENSIONS = int(os.environ.get('SIMILARITY_DIMENSIONS', 128))
+# Rows sampled to fit the IDF weights and the SVD projection; everything else is only projected
+SIMILARITY_FIT_ROWS = int(os.environ.get('SIMILARITY_FIT_ROWS', 20000))
+SIMILARITY_OVERSAMPLING = 16
+SIMILARITY_POWER_ITERATIONS = 2
+EMBED_BATCH_SIZE = 1000
+
+# The text embedded for each row; its md5 tells an incremental run which rows changed
+TEXT_SQL = "concat_ws(' ', title, abstract, llm_summary)"
+
+def index_directory(directory=None):
+    directory = directory or SIMILARITY_INDEX_DIR
+    if not directory:
+        raise ConfigError("SIMILARITY_INDEX_DIR is not set; point it at a directory on a persistent volume")
+    return directory
+
+def sparse_dot(row_ids, columns, values, n_rows, matrix):
+    """X @ matrix for a sparse X given as flat arrays sorted by row.
+
+    Each row's entries are one contiguous run, and a small vector-matrix
+    product per row beats any whole-array NumPy reduction here.
+    """
+    result = np.zeros((n_rows, matrix.shape[1]), dtype=matrix.dtype)
+    bounds = np.searchsorted(row_ids, np.arange(n_rows + 1))
+    values = values.astype(matrix.dtype)
+    for row, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if end > start:
+            result[row] = values[start:end] @ matrix[columns[start:end]]
+    return result
+
+def sparse_transpose_dot(row_ids, columns, values, n_columns, matrix):
+    """X.T @ matrix for a sparse X given as flat arrays."""
+    order = np.argsort(columns, kind='stable')
+    return sparse_dot(columns[order], row_ids[order], values[order], n_columns, matrix)
+
+class SimilarityModel:
+    """Hashed TF-IDF reduced to a few dense dimensions with a truncated SVD (latent semantic analysis).
+
+    The SVD is computed with a randomized range finder: the TF-IDF matrix is
+    sketched down to dimensions + oversampling columns, and the singular
+    vectors come from eigh of the small Gram matrix of that sketch.
+    """
+
+    def __init__(self, n_features=SIMILARITY_FEATURES, dimensions=SIMILARITY_DIMENSIONS):
+        self.n_features = n_features
+        self.dimensions = dimensions
+        self.idf = None
+        self.components = None
+
+    def _tfidf(self, texts):
+        row_ids, columns, counts = hashed_term_counts(texts, self.n_features)
+        values = np.log1p(counts) * self.idf[columns]
+        norms = np.sqrt(np.bincount(row_ids, weights=values ** 2, minlength=len(texts)))
+        values /= np.maximum(norms, 1e-12)[row_ids]
+        return row_ids, columns, values
+
+    def fit(self, texts):
+        row_ids, columns, counts = hashed_term_counts(texts, self.n_features)
+        document_frequency = np.bincount(columns, minlength=self.n_features)
+        self.idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+        row_ids, columns, values = self._tfidf(texts)
+
+        rank = min(self.dimensions + SIMILARITY_OVERSAMPLING, len(texts))
+        random_state = np.random.default_rng(0)
+        sketch = sparse_dot(row_ids, columns, values, len(texts), random_state.standard_normal((self.n_features, rank)))
+        for _ in range(SIMILARITY_POWER_ITERATIONS):
+            sketch, _ = np.linalg.qr(sketch)
+            sketch = sparse_dot(row_ids, columns, values, len(texts),
+                                sparse_transpose_dot(row_ids, columns, values, self.n_features, sketch))
+        basis, _ = np.linalg.qr(sketch)
+
+        # B = Q.T X is small; the right singular vectors of X are B.T W / s for the eigenpairs (s², W) of B B.T
+        projected = sparse_transpose_dot(row_ids, columns, values, self.n_features, basis)
+        eigenvalues, eigenvectors = np.linalg.eigh(projected.T @ projected)
+        order = np.argsort(eigenvalues)[::-1][:self.dimensions]
+        singular_values = np.sqrt(np.maximum(eigenvalues[order], 1e-12))
+        self.components = (projected @ eigenvectors[:, order] / singular_values).astype(np.float32)
+        self.dimensions = self.components.shape[1]
+        return self
+
+    def embed(self, texts):
+        """Unit-length float32 vectors for texts; texts without any known term get a zero vector."""
+        vectors = sparse_dot(*self._tfidf(texts), len(texts), self.components)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def save(self, path):
+        np.savez(path, idf=self.idf, components=self.components)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        model = cls(n_features=len(data['idf']), dimensions=data['components'].shape[1])
+        model.idf = data['idf']
+        model.components = data['components']
+        return model
+
+class SimilarityIndex:
+    """Document vectors in a memory-mapped float32 matrix, one row per document, with a fitted SimilarityModel.
+
+    The directory holds model.npz, vectors.f32 and documents.tsv (document
+    number and text hash per row, in matrix order). documents.tsv is only
+    replaced after the vectors it lists are written, so vectors.f32 may
+    end with rows left by an interrupted upsert; those are dropped on open.
+    A removed document leaves an empty row (blank document number, zero
+    vector) that the next new document takes over.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = index_directory(directory)
+        self.model = SimilarityModel.load(self._path('model.npz'))
+        self.document_numbers = []
+        self.text_hashes = []
+        with open(self._path('documents.tsv')) as documents_file:
+            for line in documents_file:
+                document_number, text_hash = line.rstrip('\n').split('\t')
+                self.document_numbers.append(document_number)
+                self.text_hashes.append(text_hash)
+        self.positions = {document_number: position for position, document_number in enumerate(self.document_numbers)
+                          if document_number}
+        self.free_positions = [position for position, document_number in enumerate(self.document_numbers) if not document_number]
+        self.vectors = self._open_vectors()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open_vectors(self):
+        path = self._path('vectors.f32')
+        row_size = self.model.dimensions * np.dtype(np.float32).itemsize
+        expected_size = len(self.document_numbers) * row_size
+        size = os.path.getsize(path)
+        if size < expected_size:
+            raise RuntimeError(f"{path} holds fewer vectors than documents.tsv lists; rebuild the index with --rebuild")
+        if size > expected_size:
+            # Appended by an upsert that didn't get as far as saving documents.tsv
+            logger.warning(f"Dropping {(size - expected_size) // row_size} unlisted vectors from {path}")
+            os.truncate(path, expected_size)
+        if not self.document_numbers:
+            return np.zeros((0, self.model.dimensions), dtype=np.float32)
+        return np.memmap(self._path('vectors.f32'), dtype=np.float32, mode='r+',
+                         shape=(len(self.document_numbers), self.model.dimensions))
+
+    @staticmethod
+    def create(directory, model):
+        directory = index_directory(directory)
+        os.makedirs(directory, exist_ok=True)
+        model.save(os.path.join(directory, 'model.npz'))
+        open(os.path.join(directory, 'vectors.f32'), 'wb').close()
+        open(os.path.join(directory, 'documents.tsv'), 'w').close()
+        return SimilarityIndex(directory)
+
+    def upsert(self, document_numbers, text_hashes, vectors):
+        """Overwrite the rows of documents already indexed, fill empty rows with new ones and append the rest."""
+        appended = []
+        for document_number, text_hash, vector in zip(document_numbers, text_hashes, vectors):
+            position = self.positions.get(document_number)
+            if position is None and self.free_positions:
+                position = self.free_positions.pop()
+                self.positions[document_number] = position
+                self.document_numbers[position] = document_number
+            if position is None:
+                appended.append((document_number, text_hash, vector))
+            else:
+                self.vectors[position] = vector
+                self.text_hashes[position] = text_hash
+        if appended:
+            if isinstance(self.vectors, np.memmap):
+                self.vectors.flush()
+            with open(self._path('vectors.f32'), 'ab') as vectors_file:
+                vectors_file.write(np.asarray([vector for _, _, vector in appended], dtype=np.float32).tobytes())
+            for document_number, text_hash, _ in appended:
+                self.positions[document_number] = len(self.document_numbers)
+                self.document_numbers.append(document_number)
+                self.text_hashes.append(text_hash)
+            self.vectors = self._open_vectors()
+        self.save_documents()
+
+    def remove(self, document_numbers):
+        """Empty the rows of documents no longer in fr_documents."""
+        for document_number in document_numbers:
+            position = self.positions.pop(document_number, None)
+            if position is not None:
+                self.document_numbers[position] = ''
+                self.text_hashes[position] = ''
+                self.vectors[position] = 0
+                self.free_positions.append(position)
+        self.save_documents()
+
+    def save_documents(self):
+        if isinstance(self.vectors, np.memmap):
+            self.vectors.flush()
+        temporary_path = self._path('documents.tsv.tmp')
+        with open(temporary_path, 'w') as documents_file:
+            documents_file.writelines(f"{document_number}\t{text_hash}\n"
+                                      for document_number, text_hash in zip(self.document_numbers, self.text_hashes))
+        os.replace(temporary_path, self._path('documents.tsv'))
+
+    def query(self, vector, top_k=10, exclude=None):
+        """The top_k (document_number, cosine similarity) pairs for a unit vector, best first."""
+        scores = self.vectors @ vector
+        if exclude is not None:
+            scores[exclude] = -np.inf
+        scores[self.free_positions] = -np.inf
+        top_k = min(top_k, len(self.positions) - (exclude is not None))
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(self.document_numbers[position], float(scores[position])) for position in best]
+
+    def similar_to(self, document_number, top_k=10):
+        position = self.positions[document_number]
+        return self.query(np.asarray(self.vectors[position]), top_k, exclude=position)
+
+    def query_text(self, text, top_k=10):
+        return self.query(self.model.embed([text])[0], top_k)
+
+def fetch_fit_texts(conn, limit):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {TEXT_SQL} FROM {FR_DOCUMENTS_TABLE_NAME} ORDER BY random() LIMIT %s", (limit,))
+        return [row[0] for row in cur.fetchall()]
+
+def fetch_text_hashes(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT document_number, md5({TEXT_SQL}) FROM {FR_DOCUMENTS_TABLE_NAME}")
+        return cur.fetchall()
+
+def fetch_texts(conn, document_numbers):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT document_number, md5({TEXT_SQL}), {TEXT_SQL} FROM {FR_DOCUMENTS_TABLE_NAME} WHERE document_number = ANY(%s)",
+            (list(document_numbers),)
+        )
+        return cur.fetchall()
+
+def build_similarity_index(directory=None, rebuild=False):
+    """Bring the index up to date: embed rows that are new or whose text changed since the last run.
+
+    The model is fitted on the first run, or with rebuild=True, which also
+    re-embeds every row.
+    """
+    from tqdm import tqdm
+
+    directory = index_directory(directory)
+    with psycopg2.connect(get_config().database_url) as conn:
+        if rebuild or not os.path.exists(os.path.join(directory, 'model.npz')):
+            texts = fetch_fit_texts(conn, SIMILARITY_FIT_ROWS)
+            logger.info(f"Fitting similarity model on {len(texts)} documents")
+            index = SimilarityIndex.create(directory, SimilarityModel().fit(texts))
+        else:
+            index = SimilarityIndex(directory)
+
+        text_hashes = fetch_text_hashes(conn)
+        deleted = set(index.positions) - {document_number for document_number, _ in text_hashes}
+        if deleted:
+            index.remove(deleted)
+            logger.info(f"Removed {len(deleted)} documents no longer in {FR_DOCUMENTS_TABLE_NAME}")
+
+        stale = [document_number for document_number, text_hash in text_hashes
+                 if index.positions.get(document_number) is None
+                 or index.text_hashes[index.positions[document_number]] != text_hash]
+        logger.info(f"{len(stale)} documents to embed; {len(index.positions)} already indexed")
+
+        for start in tqdm(range(0, len(stale), EMBED_BATCH_SIZE), desc="Embedding documents"):
+            rows = fetch_texts(conn, stale[start:start + EMBED_BATCH_SIZE])
+            vectors = index.model.embed([text for _, _, text in rows])
+            index.upsert([row[0] for row in rows], [row[1] for row in rows], vectors)
+
+    logger.info(f"Similarity index has {len(index.document_numbers)} documents")
+    return index
+
+def main(directory=None, rebuild=False):
+    logger.info("Similarity index build started")
+    start_time = time.time()
+    build_similarity_index(directory, rebuild)
+    logger.info(f"Similarity index build finished in {time.time() - start_time:.2f} seconds")
+
+def cli(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build or query the local similarity index over fr_documents.")
+    parser.add_argument('--index-dir', help="Defaults to SIMILARITY_INDEX_DIR, which should be on a persistent volume.")
+    parser.add_argument('--rebuild', action='store_true', help="Refit the model and re-embed every document.")
+    parser.add_argument('--similar-to', metavar='DOCUMENT_NUMBER', help="Print the documents most similar to this one.")
+    parser.add_argument('--query', help="Print the documents most similar to this text.")
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.similar_to or args.query:
+        index = SimilarityIndex(args.index_dir)
+        start_time = time.perf_counter()
+        results = index.similar_to(args.similar_to, args.top_k) if args.similar_to else index.query_text(args.query, args.top_k)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        print(json.dumps({'results': results, 'elapsed_ms': round(elapsed_ms, 2)}, indent=2))
+    else:
+        main(directory=args.index_dir, rebuild=args.rebuild)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,49 @@
+import os
+
+class ConfigError(Exception):
+    pass
+
+class Config:
+    """Connection settings and credentials for the pipeline scripts.
+
+    A setting left as None is looked up in the environment the first time
+    it is used, and raises ConfigError only then if it isn't set there
+    either, so the scripts can be imported and their functions reused
+    without a database URL or an API key.
+    """
+
+    ENVIRONMENT_VARIABLES = {
+        'database_url': 'DATABASE_URL',
+        'claude_api_key': 'CLAUDE_API_KEY',
+    }
+
+    def __init__(self, database_url=None, claude_api_key=None, claude_api_base_url=None):
+        self.settings = {'database_url': database_url, 'claude_api_key': claude_api_key}
+        # Point the client at a local stub server for testing; defaults to the public API
+        self.claude_api_base_url = claude_api_base_url or os.environ.get('CLAUDE_API_BASE_URL')
+
+    def require(self, name):
+        if self.settings[name] is None:
+            value = os.environ.get(self.ENVIRONMENT_VARIABLES[name])
+            if not value:
+                raise ConfigError(f"{self.ENVIRONMENT_VARIABLES[name]} is not set")
+            self.settings[name] = value
+        return self.settings[name]
+
+    @property
+    def database_url(self):
+        return self.require('database_url')
+
+    @property
+    def claude_api_key(self):
+        return self.require('claude_api_key')
+
+config = Config()
+
+def get_config():
+    return config
+
+def set_config(new_config):
+    """Use new_config for everything the scripts do from now on, e.g. to point them at another database."""
+    global config
+    config = new_config
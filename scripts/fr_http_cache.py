@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from .pipeline_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FR_API_BASE_URL = os.environ.get('FR_API_BASE_URL', 'https://www.federalregister.gov/api/v1')
+FR_HTTP_CACHE_PATH = os.environ.get('FR_HTTP_CACHE_PATH', os.path.expanduser('~/.cache/fr_http_cache.sqlite'))
+FR_HTTP_CACHE_MAX_BYTES = int(os.environ.get('FR_HTTP_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# How long a response is served without asking the server again; after that it is revalidated with
+# If-None-Match/If-Modified-Since. Search results change as documents are published, while single
+# documents only change through their page view and comment counts, which the refresher schedules itself.
+FR_HTTP_CACHE_TTL_SECONDS = {
+    'search': int(os.environ.get('FR_HTTP_CACHE_SEARCH_TTL_SECONDS', 600)),
+    'document': int(os.environ.get('FR_HTTP_CACHE_DOCUMENT_TTL_SECONDS', 0)),
+}
+# Check the size cap after this many stores, as well as at the end of each run
+EVICT_EVERY_STORES = 200
+
+DOCUMENT_URL_PATTERN = re.compile(r'/documents/[^/]+\.json$')
+
+CachedResponse = namedtuple('CachedResponse', ['key', 'body', 'etag', 'last_modified', 'fresh'])
+
+def endpoint_type(url):
+    return 'document' if DOCUMENT_URL_PATTERN.search(url) else 'search'
+
+class ResponseCache:
+    """On-disk cache of Federal Register API responses, shared by the pull and refresh scripts.
+
+    Entries are keyed by URL and query parameters and store the body
+    compressed, with the ETag and Last-Modified it came with. Least recently
+    used entries are evicted once the stored bodies exceed max_bytes. Safe
+    to use from several threads.
+    """
+
+    def __init__(self, path=FR_HTTP_CACHE_PATH, max_bytes=FR_HTTP_CACHE_MAX_BYTES, ttl_seconds=FR_HTTP_CACHE_TTL_SECONDS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                stored_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used_at ON responses(last_used_at)")
+        self.conn.commit()
+        self.stores_since_evict = 0
+        self.stats = {'lookups': 0, 'fresh_hits': 0, 'revalidated': 0, 'misses': 0, 'bytes_saved': 0, 'bytes_downloaded': 0}
+
+    @staticmethod
+    def make_key(url, params=None):
+        return f"{url}?{urlencode(sorted((params or {}).items()), doseq=True)}"
+
+    def lookup(self, url, params=None):
+        """Return (key, CachedResponse or None) for a request about to be made."""
+        key = self.make_key(url, params)
+        with self.lock:
+            self.stats['lookups'] += 1
+            row = self.conn.execute(
+                "SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return key, None
+        body, etag, last_modified, stored_at = row
+        fresh = time.time() - stored_at < self.ttl_seconds[endpoint_type(url)]
+        return key, CachedResponse(key, zlib.decompress(body), etag, last_modified, fresh)
+
+    @staticmethod
+    def conditional_headers(cached):
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+    def use(self, cached, revalidated=False):
+        """Serve a cached body, either still fresh or confirmed unchanged by a 304, and return it parsed."""
+        now = time.time()
+        metrics.inc('http_cache_lookups_total', result='revalidated' if revalidated else 'fresh')
+        with self.lock:
+            self.stats['revalidated' if revalidated else 'fresh_hits'] += 1
+            self.stats['bytes_saved'] += len(cached.body)
+            if revalidated:
+                self.conn.execute("UPDATE responses SET stored_at = ?, last_used_at = ? WHERE key = ?", (now, now, cached.key))
+            else:
+                self.conn.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, cached.key))
+            self.conn.commit()
+        return json.loads(cached.body)
+
+    def store(self, key, headers, body):
+        """Remember a 200 response's body (bytes) along with its validators."""
+        compressed = zlib.compress(body)
+        now = time.time()
+        metrics.inc('http_cache_lookups_total', result='miss')
+        with self.lock:
+            self.stats['misses'] += 1
+            self.stats['bytes_downloaded'] += len(body)
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO responses (key, body, size, etag, last_modified, stored_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (key, compressed, len(compressed), headers.get('etag'), headers.get('last-modified'), now, now)
+            )
+            self.conn.commit()
+            self.stores_since_evict += 1
+            evict = self.stores_since_evict >= EVICT_EVERY_STORES
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used entries until the stored bodies fit in max_bytes."""
+        with self.lock:
+            self.stores_since_evict = 0
+            deleted = self.conn.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY last_used_at DESC) AS running_size FROM responses
+                    ) WHERE running_size > ?
+                )
+                """,
+                (self.max_bytes,)
+            ).rowcount
+            self.conn.commit()
+        if deleted:
+            logger.info(f"Evicted {deleted} least recently used responses from the HTTP cache")
+
+    def report(self):
+        stats = self.stats
+        hits = stats['fresh_hits'] + stats['revalidated']
+        hit_rate = hits / stats['lookups'] if stats['lookups'] else 0.0
+        logger.info(
+            f"HTTP cache: {hit_rate:.1%} hit rate over {stats['lookups']} requests "
+            f"({stats['fresh_hits']} fresh, {stats['revalidated']} revalidated, {stats['misses']} downloaded); "
+            f"{stats['bytes_saved'] / 1024:.0f} KB saved, {stats['bytes_downloaded'] / 1024:.0f} KB downloaded"
+        )
+
+    def finish_run(self):
+        """Enforce the size cap and log the run's statistics."""
+        self.evict()
+        self.report()
+
+# One cache per process, shared by the pull and the refresh, which would otherwise each open the same SQLite
+# file and contend for its write lock. Opened on first use.
+http_cache = None
+
+def get_http_cache():
+    global http_cache
+    if http_cache is None:
+        http_cache = ResponseCache()
+    return http_cache
+
+def create_federal_register_client(cache):
+    """A FederalRegister client whose requests go through cache.
+
+    federal_register and requests are only imported here, so the refresh
+    script, which only needs ResponseCache, doesn't pay for them.
+    """
+    import requests
+    from federal_register.client import FederalRegister
+
+    class CachingFederalRegister(FederalRegister):
+        """FederalRegister client whose requests go through a ResponseCache."""
+
+        def __init__(self, cache):
+            super().__init__()
+            self.api_base_url, self.api_version = FR_API_BASE_URL.rsplit('/', 1)
+            self.cache = cache
+
+        def _make_request(self, url, method, params=None):
+            key, cached = self.cache.lookup(url, params)
+            if cached is not None and cached.fresh:
+                return self.cache.use(cached)
+
+            start_time = time.monotonic()
+            try:
+                response = requests.get(url=url, params=params, headers=self.cache.conditional_headers(cached))
+            except requests.exceptions.RequestException:
+                metrics.record_request('federal_register', 'error', time.monotonic() - start_time)
+                raise
+            metrics.record_request('federal_register', response.status_code, time.monotonic() - start_time)
+            if response.status_code == 304 and cached is not None:
+                return self.cache.use(cached, revalidated=True)
+            # If it's a good response, send back.
+            if response.ok:
+                self.cache.store(key, response.headers, response.content)
+                return response.json()
+
+    return CachingFederalRegister(cache)
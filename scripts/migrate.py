@@ -0,0 +1,273 @@
+import argparse
+import importlib
+import logging
+import os
+import pkgutil
+import re
+import time
+from collections import namedtuple
+
+import psycopg2
+import psycopg2.errors
+
+from . import migrations
+from .config import get_config
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_MIGRATIONS_TABLE_NAME = os.environ.get('SCHEMA_MIGRATIONS_TABLE_NAME', 'schema_migrations')
+# Rows per transaction when a migration backfills a column; each batch only holds its rows' locks briefly
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 5000))
+# Pause between backfill batches, leaving I/O headroom for the web app and the pipeline
+MIGRATION_BATCH_PAUSE_SECONDS = float(os.environ.get('MIGRATION_BATCH_PAUSE_SECONDS', 0.05))
+# How long DDL waits for its table lock before giving up and retrying, so it never queues the app's queries behind it
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+MIGRATION_LOCK_ATTEMPTS = int(os.environ.get('MIGRATION_LOCK_ATTEMPTS', 10))
+# Arbitrary key for pg_advisory_lock, so two runners never apply migrations at the same time
+ADVISORY_LOCK_KEY = 4519025
+
+# Modules in scripts/migrations named like 0003_typed_columns
+MIGRATION_MODULE_PATTERN = re.compile(r'^(\d{4})_(\w+)$')
+
+Migration = namedtuple('Migration', ['version', 'name', 'module'])
+
+def load_migrations():
+    """Every migration in scripts/migrations, in version order.
+
+    A migration module either defines SQL, which is applied in one
+    transaction, or upgrade(conn, batch_size, batch_pause), which gets an
+    autocommit connection for work that can't run in a transaction (like
+    CREATE INDEX CONCURRENTLY) and must be safe to rerun if interrupted.
+    """
+    found = []
+    for module_info in pkgutil.iter_modules(migrations.__path__):
+        match = MIGRATION_MODULE_PATTERN.match(module_info.name)
+        if match:
+            module = importlib.import_module(f"{migrations.__name__}.{module_info.name}")
+            found.append(Migration(int(match.group(1)), match.group(2), module))
+    found.sort()
+    versions = [migration.version for migration in found]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError(f"Duplicate migration versions in {migrations.__name__}: {versions}")
+    return found
+
+def ensure_migrations_table(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SCHEMA_MIGRATIONS_TABLE_NAME} (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                duration_seconds REAL
+            )
+        """)
+
+def applied_migrations(conn):
+    """Applied versions, mapped to when they were applied."""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT version, applied_at FROM {SCHEMA_MIGRATIONS_TABLE_NAME}")
+        return dict(cur.fetchall())
+
+def apply_migration(conn, migration, batch_size=MIGRATION_BATCH_SIZE, batch_pause=MIGRATION_BATCH_PAUSE_SECONDS):
+    logger.info(f"Applying migration {migration.version:04d} {migration.name}")
+    start_time = time.monotonic()
+    record_sql = f"INSERT INTO {SCHEMA_MIGRATIONS_TABLE_NAME} (version, name, duration_seconds) VALUES (%s, %s, %s)"
+    if hasattr(migration.module, 'SQL'):
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL lock_timeout = %s", (MIGRATION_LOCK_TIMEOUT,))
+                cur.execute(migration.module.SQL)
+                cur.execute(record_sql, (migration.version, migration.name, time.monotonic() - start_time))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        migration.module.upgrade(conn, batch_size=batch_size, batch_pause=batch_pause)
+        with conn.cursor() as cur:
+            cur.execute(record_sql, (migration.version, migration.name, time.monotonic() - start_time))
+    logger.info(f"Applied migration {migration.version:04d} {migration.name} in {time.monotonic() - start_time:.1f}s")
+
+def migrate(database_url=None, target=None, batch_size=MIGRATION_BATCH_SIZE, batch_pause=MIGRATION_BATCH_PAUSE_SECONDS):
+    """Apply the pending migrations up to target (all of them if None) and return the versions applied."""
+    conn = psycopg2.connect(database_url or get_config().database_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            # Released when the connection closes
+            cur.execute("SELECT pg_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+        ensure_migrations_table(conn)
+        applied = applied_migrations(conn)
+        pending = [migration for migration in load_migrations()
+                   if migration.version not in applied and (target is None or migration.version <= target)]
+        if not pending:
+            logger.info("Schema is up to date.")
+        for migration in pending:
+            apply_migration(conn, migration, batch_size, batch_pause)
+        return [migration.version for migration in pending]
+    finally:
+        conn.close()
+
+def log_status(database_url=None):
+    conn = psycopg2.connect(database_url or get_config().database_url)
+    conn.autocommit = True
+    try:
+        ensure_migrations_table(conn)
+        applied = applied_migrations(conn)
+    finally:
+        conn.close()
+    for migration in load_migrations():
+        applied_at = applied.get(migration.version)
+        state = f"applied {applied_at:%Y-%m-%d %H:%M:%S %Z}" if applied_at else "pending"
+        logger.info(f"{migration.version:04d} {migration.name}: {state}")
+
+# Helpers for upgrade() migrations, which run on an autocommit connection
+
+def column_type(conn, table, column):
+    """The column's type as format_type spells it (e.g. 'text[]', 'timestamp with time zone'), or None if it doesn't exist."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = to_regclass(%s) AND attname = %s AND attnum > 0 AND NOT attisdropped
+            """,
+            (table, column)
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def run_ddl(conn, *statements):
+    """Run statements in one transaction under MIGRATION_LOCK_TIMEOUT, retrying when a lock isn't granted in time.
+
+    A DDL statement waiting for its lock blocks every query that arrives
+    after it, so it's better to give up quickly and try again later than
+    to wait behind a long-running query.
+    """
+    for attempt in range(1, MIGRATION_LOCK_ATTEMPTS + 1):
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL lock_timeout = %s", (MIGRATION_LOCK_TIMEOUT,))
+                for statement in statements:
+                    cur.execute(statement)
+            conn.commit()
+            return
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            if attempt == MIGRATION_LOCK_ATTEMPTS:
+                raise
+            logger.warning(f"Lock not granted within {MIGRATION_LOCK_TIMEOUT}, retrying ({attempt}/{MIGRATION_LOCK_ATTEMPTS})")
+            time.sleep(attempt)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+
+def convert_column(conn, table, column, new_type, expression, batch_size=MIGRATION_BATCH_SIZE,
+                   batch_pause=MIGRATION_BATCH_PAUSE_SECONDS):
+    """Change column to new_type without rewriting table under an exclusive lock.
+
+    expression(value) returns the SQL converting an old value (value is
+    the SQL referring to it) into the new type. New values go into a
+    shadow column: a trigger fills it on every insert and update while
+    existing rows are backfilled in batches of batch_size document
+    numbers, one transaction each. The old column is then dropped and
+    the shadow renamed in its place, which only needs the exclusive lock
+    for an instant. Safe to rerun; a column already of new_type is left alone.
+    """
+    if column_type(conn, table, column) == new_type:
+        return
+    shadow = f"{column}_new"
+    sync_function = f"{table}_{column}_sync"
+    run_ddl(
+        conn,
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {shadow} {new_type}",
+        f"""
+        CREATE OR REPLACE FUNCTION {sync_function}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.{shadow} := {expression(f'NEW.{column}')};
+            RETURN NEW;
+        END
+        $$
+        """,
+        f"DROP TRIGGER IF EXISTS {sync_function} ON {table}",
+        f"CREATE TRIGGER {sync_function} BEFORE INSERT OR UPDATE OF {column} ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION {sync_function}()",
+    )
+
+    converted_count = 0
+    after = ''
+    with conn.cursor() as cur:
+        while True:
+            cur.execute(
+                f"SELECT DISTINCT document_number FROM {table} WHERE document_number > %s ORDER BY document_number LIMIT %s",
+                (after, batch_size)
+            )
+            document_numbers = [row[0] for row in cur.fetchall()]
+            if not document_numbers:
+                break
+            cur.execute(
+                f"""
+                UPDATE {table} SET {shadow} = {expression(column)}
+                WHERE document_number = ANY(%s) AND {column} IS NOT NULL AND {shadow} IS NULL
+                """,
+                (document_numbers,)
+            )
+            converted_count += cur.rowcount
+            after = document_numbers[-1]
+            time.sleep(batch_pause)
+        # Rows without a document number aren't reached by the batches above
+        cur.execute(f"UPDATE {table} SET {shadow} = {expression(column)} WHERE document_number IS NULL AND {column} IS NOT NULL")
+        converted_count += cur.rowcount
+
+    # Dropping the column also drops the indexes on it
+    run_ddl(
+        conn,
+        f"DROP TRIGGER {sync_function} ON {table}",
+        f"DROP FUNCTION {sync_function}()",
+        f"ALTER TABLE {table} DROP COLUMN {column}",
+        f"ALTER TABLE {table} RENAME COLUMN {shadow} TO {column}",
+    )
+    logger.info(f"Converted {table}.{column} to {new_type}, backfilling {converted_count} rows")
+
+def create_index_concurrently(conn, name, table, columns, method='btree', unique=False, where=None):
+    """Build an index without blocking writes to table, unless a valid index called name already exists.
+
+    An index left invalid by an interrupted concurrent build is dropped and
+    built again.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+        row = cur.fetchone()
+        if row and row[0]:
+            return
+        if row:
+            logger.warning(f"Rebuilding invalid index {name}")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        start_time = time.monotonic()
+        cur.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name} ON {table} USING {method} ({columns})"
+            + (f" WHERE {where}" if where else "")
+        )
+        logger.info(f"Built index {name} in {time.monotonic() - start_time:.1f}s")
+
+def cli(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations to the database.")
+    parser.add_argument('--target', type=int, help="Only apply migrations up to this version")
+    parser.add_argument('--status', action='store_true', help="List the migrations and whether each has been applied, then exit")
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH_SIZE, help="Rows per transaction when backfilling a column")
+    parser.add_argument('--batch-pause', type=float, default=MIGRATION_BATCH_PAUSE_SECONDS, help="Seconds to pause between backfill batches")
+    args = parser.parse_args(argv)
+
+    if args.status:
+        log_status()
+    else:
+        migrate(target=args.target, batch_size=args.batch_size, batch_pause=args.batch_pause)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,122 @@
+"""The web app's tables and fr_documents, as created by the old migrate_database.sql and migrate_missing_tables.sql.
+
+Written so it also applies cleanly to a database those files already set up.
+"""
+
+SQL = """
+CREATE TABLE IF NOT EXISTS ai_documents (
+    document_number VARCHAR,
+    created_at VARCHAR,
+    llm_summary VARCHAR,
+    ai_related INTEGER,
+    llm_summary_full VARCHAR,
+    last_modified VARCHAR,
+    abstract VARCHAR,
+    action VARCHAR,
+    agency_names VARCHAR,
+    body_html_url VARCHAR,
+    comment_url VARCHAR,
+    comments_close_on DATE,
+    dates VARCHAR,
+    effective_on VARCHAR,
+    full_text_xml_url VARCHAR,
+    html_url VARCHAR,
+    publication_date DATE,
+    raw_text_url VARCHAR,
+    title VARCHAR,
+    toc_doc VARCHAR,
+    type VARCHAR,
+    regulations_dot_gov_comments_url VARCHAR,
+    regulations_dot_gov_docket_id VARCHAR,
+    regulations_dot_gov_document_id VARCHAR,
+    page_views_count INTEGER,
+    tags VARCHAR,
+    page_views_count_modified_at TIMESTAMP,
+    comments_count INTEGER,
+    comments_count_modified_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS search_queries (
+    id SERIAL PRIMARY KEY,
+    query TEXT NOT NULL,
+    timestamp TIMESTAMP
+);
+
+-- Session store for express-session
+CREATE TABLE IF NOT EXISTS session (
+    sid VARCHAR NOT NULL COLLATE "default",
+    sess JSON NOT NULL,
+    expire TIMESTAMP(6) NOT NULL
+);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'session'::regclass AND contype = 'p') THEN
+        ALTER TABLE session ADD CONSTRAINT session_pkey PRIMARY KEY (sid) NOT DEFERRABLE INITIALLY IMMEDIATE;
+    END IF;
+END
+$$;
+CREATE INDEX IF NOT EXISTS IDX_session_expire ON session (expire);
+
+CREATE INDEX IF NOT EXISTS idx_ai_documents_publication_date ON ai_documents(publication_date);
+CREATE INDEX IF NOT EXISTS idx_ai_documents_document_number ON ai_documents(document_number);
+CREATE INDEX IF NOT EXISTS idx_ai_documents_type ON ai_documents(type);
+CREATE INDEX IF NOT EXISTS idx_ai_documents_agency_names ON ai_documents(agency_names);
+CREATE INDEX IF NOT EXISTS idx_search_queries_timestamp ON search_queries(timestamp);
+
+-- Every document pulled from the Federal Register, classified or not (the big one - 77MB)
+CREATE TABLE IF NOT EXISTS fr_documents (
+    abstract TEXT,
+    action TEXT,
+    agency_names TEXT,
+    html_url TEXT,
+    body_html_url TEXT,
+    citation TEXT,
+    comment_url TEXT,
+    comments_close_on DATE,
+    dates TEXT,
+    docket_ids TEXT,
+    document_number TEXT NOT NULL,
+    effective_on DATE,
+    excerpts TEXT,
+    full_text_xml_url TEXT,
+    json_url TEXT,
+    page_views_count INTEGER,
+    publication_date DATE,
+    raw_text_url TEXT,
+    regulations_dot_gov_comments_url TEXT,
+    regulations_dot_gov_docket_id TEXT,
+    regulations_dot_gov_document_id TEXT,
+    regulations_dot_gov_title TEXT,
+    regulations_dot_gov_url TEXT,
+    significant BOOLEAN,
+    subtype TEXT,
+    title TEXT,
+    toc_doc TEXT,
+    toc_subject TEXT,
+    topics TEXT,
+    type TEXT,
+    ai_related VARCHAR,
+    llm_summary VARCHAR,
+    tags TEXT[],
+    page_views_count_modified_at TIMESTAMP,
+    comments_count INTEGER,
+    comments_count_modified_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS algolia_index_metadata (
+    id SERIAL PRIMARY KEY,
+    last_indexed TIMESTAMP
+);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'fr_documents'::regclass AND contype = 'p') THEN
+        ALTER TABLE fr_documents ADD PRIMARY KEY (document_number);
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_fr_documents_publication_date ON fr_documents(publication_date);
+CREATE INDEX IF NOT EXISTS idx_fr_documents_type ON fr_documents(type);
+"""
@@ -0,0 +1,108 @@
+"""Bookkeeping tables and columns used by the pipeline scripts, as created by the old migrate_pipeline_tables.sql."""
+
+SQL = """
+-- Completed backfill shards, so an interrupted backfill resumes where it stopped
+CREATE TABLE IF NOT EXISTS fr_backfill_checkpoints (
+    shard_start DATE NOT NULL,
+    shard_end DATE NOT NULL,
+    terms TEXT NOT NULL DEFAULT '',
+    documents_count INTEGER,
+    completed_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (shard_start, shard_end, terms)
+);
+
+-- Hash of each document's content, used by the upsert in pull_fr_documents to skip unchanged rows
+ALTER TABLE fr_documents ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+-- Message Batches jobs submitted by summarize_fr_documents --mode batch-submit
+CREATE TABLE IF NOT EXISTS llm_batches (
+    batch_id TEXT PRIMARY KEY,
+    document_numbers TEXT[] NOT NULL,
+    status TEXT NOT NULL DEFAULT 'submitted',
+    submitted_at TIMESTAMP DEFAULT NOW(),
+    ended_at TIMESTAMP,
+    collected_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_llm_batches_uncollected ON llm_batches(submitted_at) WHERE collected_at IS NULL;
+
+-- Parsed LLM classifications keyed by a hash of (prompt version, model, normalized prompt inputs)
+CREATE TABLE IF NOT EXISTS llm_classification_cache (
+    cache_key TEXT PRIMARY KEY,
+    prompt_version INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    ai_related INTEGER,
+    llm_summary TEXT,
+    tags TEXT[],
+    created_at TIMESTAMP DEFAULT NOW(),
+    last_hit_at TIMESTAMP,
+    hit_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_llm_classification_cache_last_used ON llm_classification_cache((COALESCE(last_hit_at, created_at)));
+
+-- Where each classification came from: llm, cache or prescreen
+ALTER TABLE fr_documents ADD COLUMN IF NOT EXISTS classification_source TEXT;
+
+-- Token usage and latency of every LLM request, to track cost per document
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id BIGSERIAL PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT NOW(),
+    document_numbers TEXT[] NOT NULL,
+    model TEXT NOT NULL,
+    request_type TEXT NOT NULL,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    cache_creation_input_tokens INTEGER,
+    cache_read_input_tokens INTEGER,
+    latency_ms INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_llm_usage_created_at ON llm_usage(created_at);
+
+-- LLM responses that failed validation; rows stop being retried once quarantined_at is set
+CREATE TABLE IF NOT EXISTS llm_quarantine (
+    document_number TEXT PRIMARY KEY,
+    failure_count INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    raw_response TEXT,
+    first_failed_at TIMESTAMP DEFAULT NOW(),
+    last_failed_at TIMESTAMP,
+    quarantined_at TIMESTAMP
+);
+
+-- Summarizer work queue: workers lease pending rows with SKIP LOCKED until claimed_until
+ALTER TABLE fr_documents ADD COLUMN IF NOT EXISTS claimed_by TEXT;
+ALTER TABLE fr_documents ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP;
+CREATE INDEX IF NOT EXISTS idx_fr_documents_pending ON fr_documents(document_number) WHERE ai_related IS NULL OR ai_related = '';
+
+-- Change in page views plus comments at the last refresh, used to schedule the next one
+ALTER TABLE fr_documents ADD COLUMN IF NOT EXISTS counts_delta INTEGER;
+ALTER TABLE ai_documents ADD COLUMN IF NOT EXISTS counts_delta INTEGER;
+
+-- Full text of documents, zlib-compressed one paragraph per line, so re-summarizing never re-downloads it
+CREATE TABLE IF NOT EXISTS fr_full_texts (
+    document_number TEXT PRIMARY KEY,
+    source_url TEXT,
+    compressed_text BYTEA NOT NULL,
+    text_length INTEGER,
+    fetched_at TIMESTAMP DEFAULT NOW()
+);
+
+-- MinHash signatures and LSH band keys of each row's prompt fields, for reusing near-duplicates' classifications
+CREATE TABLE IF NOT EXISTS document_minhashes (
+    document_number TEXT PRIMARY KEY,
+    signature INTEGER[] NOT NULL,
+    band_keys BIGINT[] NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_document_minhashes_band_keys ON document_minhashes USING GIN (band_keys);
+
+-- One row per pipeline script run, with a JSON summary of its counters, latency histograms and time breakdown
+CREATE TABLE IF NOT EXISTS pipeline_runs (
+    id BIGSERIAL PRIMARY KEY,
+    stage TEXT NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL,
+    status TEXT NOT NULL,
+    summary JSONB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_pipeline_runs_stage_started_at ON pipeline_runs(stage, started_at DESC);
+"""
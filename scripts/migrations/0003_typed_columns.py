@@ -0,0 +1,50 @@
+"""Give the classification, list and timestamp columns proper types.
+
+- ai_related becomes a smallint in both tables. In fr_documents NULL now
+  means "not classified yet", where the old VARCHAR also used ''.
+- agency_names, docket_ids and topics in fr_documents become text[], split
+  on the ', ' the pull used to join them with.
+- ai_documents.tags becomes text[], like fr_documents.tags already is.
+- ai_documents.created_at and last_modified become timestamptz. The old
+  'YYYY-MM-DD' strings are read as midnight UTC.
+
+ai_documents.agency_names stays text. The web app filters it with ILIKE
+and the frontend splits it on ', ', so it keeps the joined form.
+
+Each column is converted online with scripts.migrate.convert_column, so
+fr_documents stays readable and writable throughout.
+"""
+from ..migrate import convert_column
+
+FR_DOCUMENTS_TABLE_NAME = 'fr_documents'
+AI_DOCUMENTS_TABLE_NAME = 'ai_documents'
+
+def ai_related_flag(value):
+    # Anything other than 0 or 1 is left NULL, so the row is classified again
+    return f"CASE WHEN btrim({value}::text) IN ('0', '1') THEN btrim({value}::text)::smallint END"
+
+def comma_joined_list(value):
+    # string_to_array('', ', ') is an empty array, as the pull now writes for an empty list
+    return f"string_to_array({value}, ', ')"
+
+def date_string_timestamp(value):
+    return f"CASE WHEN {value} ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}' THEN {value}::timestamp AT TIME ZONE 'UTC' END"
+
+def upgrade(conn, batch_size, batch_pause):
+    conversions = [
+        (FR_DOCUMENTS_TABLE_NAME, 'ai_related', 'smallint', ai_related_flag),
+        (FR_DOCUMENTS_TABLE_NAME, 'agency_names', 'text[]', comma_joined_list),
+        (FR_DOCUMENTS_TABLE_NAME, 'docket_ids', 'text[]', comma_joined_list),
+        (FR_DOCUMENTS_TABLE_NAME, 'topics', 'text[]', comma_joined_list),
+        (AI_DOCUMENTS_TABLE_NAME, 'ai_related', 'smallint', ai_related_flag),
+        (AI_DOCUMENTS_TABLE_NAME, 'tags', 'text[]', comma_joined_list),
+        (AI_DOCUMENTS_TABLE_NAME, 'created_at', 'timestamp with time zone', date_string_timestamp),
+        (AI_DOCUMENTS_TABLE_NAME, 'last_modified', 'timestamp with time zone', date_string_timestamp),
+    ]
+    for table, column, new_type, expression in conversions:
+        convert_column(conn, table, column, new_type, expression, batch_size, batch_pause)
+
+    # The backfills leave a dead version of every row behind
+    with conn.cursor() as cur:
+        for table in (FR_DOCUMENTS_TABLE_NAME, AI_DOCUMENTS_TABLE_NAME):
+            cur.execute(f"VACUUM (ANALYZE) {table}")
@@ -0,0 +1,51 @@
+"""Indexes for the hot filters, built concurrently so writes carry on meanwhile.
+
+- GIN indexes on the array columns, for containment (@>) and overlap (&&)
+  filters.
+- A partial index on pending rows (ai_related IS NULL) for the
+  summarizer's claims and the daemon's sweep. It replaces the one on
+  ai_related IS NULL OR ai_related = ''.
+- Partial indexes on comments_close_on covering only documents with a
+  comment period. "Open" depends on CURRENT_DATE, which an index
+  predicate can't use, but those rows are a small fraction of the table.
+- ai_documents.document_number becomes unique, which the ON CONFLICT in
+  insert_rows_to_ai_documents relies on. Duplicate rows are removed
+  first, keeping one row per document number.
+- Indexes made redundant by the primary key or the unique index are
+  dropped.
+"""
+import logging
+
+from ..migrate import create_index_concurrently
+
+logger = logging.getLogger(__name__)
+
+FR_DOCUMENTS_TABLE_NAME = 'fr_documents'
+AI_DOCUMENTS_TABLE_NAME = 'ai_documents'
+
+def upgrade(conn, batch_size, batch_pause):
+    for column in ('agency_names', 'docket_ids', 'topics', 'tags'):
+        create_index_concurrently(conn, f'idx_{FR_DOCUMENTS_TABLE_NAME}_{column}', FR_DOCUMENTS_TABLE_NAME, column, method='gin')
+    create_index_concurrently(conn, f'idx_{AI_DOCUMENTS_TABLE_NAME}_tags', AI_DOCUMENTS_TABLE_NAME, 'tags', method='gin')
+
+    create_index_concurrently(conn, f'idx_{FR_DOCUMENTS_TABLE_NAME}_pending', FR_DOCUMENTS_TABLE_NAME, 'document_number',
+                              where='ai_related IS NULL')
+    for table in (FR_DOCUMENTS_TABLE_NAME, AI_DOCUMENTS_TABLE_NAME):
+        create_index_concurrently(conn, f'idx_{table}_comments_close_on', table, 'comments_close_on',
+                                  where='comments_close_on IS NOT NULL')
+
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            DELETE FROM {AI_DOCUMENTS_TABLE_NAME} a
+            USING {AI_DOCUMENTS_TABLE_NAME} b
+            WHERE a.document_number = b.document_number AND a.ctid < b.ctid
+        """)
+        if cur.rowcount:
+            logger.info(f"Removed {cur.rowcount} duplicate rows from {AI_DOCUMENTS_TABLE_NAME}")
+    create_index_concurrently(conn, f'idx_{AI_DOCUMENTS_TABLE_NAME}_document_number_unique', AI_DOCUMENTS_TABLE_NAME,
+                              'document_number', unique=True)
+
+    with conn.cursor() as cur:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS idx_{AI_DOCUMENTS_TABLE_NAME}_document_number")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS idx_{FR_DOCUMENTS_TABLE_NAME}_document_number")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS idx_{FR_DOCUMENTS_TABLE_NAME}_ai_related")
@@ -0,0 +1,5 @@
+"""Schema migrations, applied in version order by scripts.migrate.
+
+Each module is named <4-digit version>_<name>. See scripts.migrate.load_migrations
+for what a module defines.
+"""
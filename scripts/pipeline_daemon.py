@@ -0,0 +1,422 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import signal
+import time
+import psycopg2
+from . import pipeline_metrics
+from . import pull_fr_documents as pull
+from . import summarize_fr_documents as summarize
+from . import update_fr_documents as update
+from .config import get_config
+from .fr_http_cache import get_http_cache
+from .pipeline_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FR_DOCUMENTS_TABLE_NAME = os.environ.get('FR_DOCUMENTS_TABLE_NAME', 'fr_documents')
+# How often each stage runs; classification is continuous and fed by the pull and sweep stages
+PULL_INTERVAL_SECONDS = int(os.environ.get('DAEMON_PULL_INTERVAL_SECONDS', 600))
+PULL_LOOKBACK_DAYS = int(os.environ.get('DAEMON_PULL_LOOKBACK_DAYS', 3))
+PULL_PER_PAGE = 1000
+SWEEP_INTERVAL_SECONDS = int(os.environ.get('DAEMON_SWEEP_INTERVAL_SECONDS', 3600))
+# Most unclassified rows the sweep queues at a time, to pick up rows nothing else has queued
+SWEEP_LIMIT = int(os.environ.get('DAEMON_SWEEP_LIMIT', 5000))
+# New labels since the pre-screen was last trained that make the sweep retrain it
+PRESCREEN_RETRAIN_LABELS = int(os.environ.get('DAEMON_PRESCREEN_RETRAIN_LABELS', 5000))
+REFRESH_INTERVAL_SECONDS = int(os.environ.get('DAEMON_REFRESH_INTERVAL_SECONDS', 900))
+# How often the metrics of the last period are written to pipeline_runs and reset
+REPORT_INTERVAL_SECONDS = int(os.environ.get('DAEMON_REPORT_INTERVAL_SECONDS', 3600))
+# Queue bounds; a full queue holds back the stage that feeds it
+CLASSIFY_QUEUE_SIZE = int(os.environ.get('DAEMON_CLASSIFY_QUEUE_SIZE', 5000))
+WRITE_QUEUE_SIZE = int(os.environ.get('DAEMON_WRITE_QUEUE_SIZE', 500))
+# How long in-flight work gets to finish after SIGTERM before it is abandoned to the claim leases
+SHUTDOWN_GRACE_SECONDS = int(os.environ.get('DAEMON_SHUTDOWN_GRACE_SECONDS', 60))
+# Upper bounds in seconds for the time from a document being queued to its classification being written
+DOCUMENT_LATENCY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+def fetch_pending_document_numbers(conn, limit):
+    """Unclassified, unclaimed document numbers, oldest first."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT document_number FROM {FR_DOCUMENTS_TABLE_NAME}
+            WHERE ai_related IS NULL
+              AND (claimed_until IS NULL OR claimed_until < NOW())
+            ORDER BY document_number
+            LIMIT %s
+            """,
+            (limit,)
+        )
+        document_numbers = [document_number for (document_number,) in cur.fetchall()]
+    conn.commit()
+    return document_numbers
+
+def reset_connection(conn):
+    """Return conn rolled back after a failed statement, or a new connection if conn was lost."""
+    if not conn.closed:
+        try:
+            conn.rollback()
+            return conn
+        except psycopg2.Error:
+            conn.close()
+    return pipeline_metrics.connect(get_config().database_url)
+
+class PipelineDaemon:
+    """Pull, classify and refresh in one process, with documents passed between stages on bounded queues.
+
+    Newly pulled document numbers go on the classify queue; the classifier
+    leases and classifies them and puts the results on the write queue, and
+    the writer writes them to fr_documents and ai_documents. Each periodic
+    stage has its own connection and interval. stop() lets in-flight work
+    finish for up to shutdown_grace seconds.
+    """
+
+    def __init__(self, pull_interval=PULL_INTERVAL_SECONDS, sweep_interval=SWEEP_INTERVAL_SECONDS,
+                 refresh_interval=REFRESH_INTERVAL_SECONDS, report_interval=REPORT_INTERVAL_SECONDS,
+                 classify_queue_size=CLASSIFY_QUEUE_SIZE, write_queue_size=WRITE_QUEUE_SIZE,
+                 shutdown_grace=SHUTDOWN_GRACE_SECONDS, max_concurrency=summarize.MAX_CONCURRENT_REQUESTS,
+                 claim_size=summarize.CLAIM_BATCH_SIZE, pack_size=summarize.PACK_SIZE,
+                 prescreen_threshold=summarize.PRESCREEN_THRESHOLD, refresh_request_budget=update.REFRESH_REQUEST_BUDGET):
+        self.intervals = {'pull': pull_interval, 'sweep': sweep_interval, 'refresh': refresh_interval, 'report': report_interval}
+        self.classify_queue_size = classify_queue_size
+        self.write_queue_size = write_queue_size
+        self.shutdown_grace = shutdown_grace
+        self.max_concurrency = max_concurrency
+        self.claim_size = claim_size
+        self.pack_size = pack_size
+        self.prescreen_threshold = prescreen_threshold
+        self.refresh_request_budget = refresh_request_budget
+        self.worker_id = summarize.default_worker_id()
+        self.connections = {}
+        # Document numbers on their way through the classifier, with when they were queued
+        self.queued_at = {}
+        self.in_flight_rows = 0
+        self.totals = {'processed': 0, 'claimed': 0, 'ai_related': 0, 'inserted': 0}
+        # Labeled rows in fr_documents when the pre-screen was last (re)set to train
+        self.prescreen_labeled_count = None
+        self.failed = False
+
+    def stop(self):
+        if not self.stopping.is_set():
+            logger.info("Stopping: finishing in-flight work")
+            self.stopping.set()
+
+    def stage_failed(self, task):
+        """Stop the daemon when the classifier or writer dies, since nothing would drain the queues."""
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Stage {task.get_name()} failed", exc_info=task.exception())
+            self.failed = True
+            self.stop()
+
+    async def wait_or_stop(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_periodically(self, name, cycle):
+        """Run cycle every interval until stopped; a failed cycle is logged and retried next interval."""
+        while not self.stopping.is_set():
+            start_time = time.monotonic()
+            outcome = 'succeeded'
+            try:
+                await cycle(self.connections[name])
+            except Exception as e:
+                logger.exception(f"{name} cycle failed: {e}")
+                outcome = 'failed'
+                self.connections[name] = await asyncio.to_thread(reset_connection, self.connections[name])
+            metrics.inc('daemon_cycles_total', stage=name, outcome=outcome)
+            metrics.observe('daemon_cycle_seconds', time.monotonic() - start_time, stage=name)
+            self.report_queue_depths()
+            await asyncio.to_thread(metrics.write_textfile)
+            await self.wait_or_stop(self.intervals[name])
+
+    async def enqueue(self, document_numbers):
+        """Queue document numbers for classification, waiting while the classify queue is full."""
+        for document_number in document_numbers:
+            if document_number in self.queued_at:
+                continue
+            self.queued_at[document_number] = time.monotonic()
+            await self.classify_queue.put(document_number)
+
+    def mark_written(self, document_numbers, path):
+        now = time.monotonic()
+        for document_number in document_numbers:
+            queued_at = self.queued_at.pop(document_number, None)
+            if queued_at is not None:
+                metrics.observe('document_latency_seconds', now - queued_at, buckets=DOCUMENT_LATENCY_BUCKETS, path=path)
+
+    def report_queue_depths(self):
+        metrics.set('queue_depth', self.classify_queue.qsize(), queue='classify')
+        metrics.set('queue_depth', self.results_queue.qsize(), queue='write')
+        metrics.set('rows_in_flight', self.in_flight_rows)
+
+    async def pull_cycle(self, conn):
+        """Pull the last few days' documents and queue the new ones for classification, a batch at a time."""
+        end_date = datetime.datetime.now()
+        start_date = end_date - datetime.timedelta(days=PULL_LOOKBACK_DAYS)
+        documents = pull.fetch_documents(pull.TERMS, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'),
+                                         PULL_PER_PAGE, show_progress=False)
+        batches = pull.iter_batches(documents, pull.INSERT_BATCH_SIZE)
+        while not self.stopping.is_set():
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            inserted_document_numbers = await asyncio.to_thread(pull.insert_to_postgres, conn, batch)
+            await self.enqueue(inserted_document_numbers)
+        await asyncio.to_thread(batches.close)
+        await asyncio.to_thread(get_http_cache().finish_run)
+
+    async def sweep_cycle(self, conn):
+        """Queue unclassified rows that weren't pulled by this process, and do the classifier's upkeep."""
+        indexed_count = await asyncio.to_thread(summarize.index_classified_minhashes, conn)
+        if indexed_count:
+            logger.info(f"Stored MinHash signatures for {indexed_count} classified rows")
+        # Retrain the pre-screen once enough labels have been written since it was trained, or on any new
+        # labels if there were too few to train it; it is trained at the next classification that needs it
+        labeled_count = await asyncio.to_thread(summarize.count_labeled_rows, conn)
+        if self.prescreen_labeled_count is None:
+            self.prescreen_labeled_count = labeled_count
+        elif (labeled_count - self.prescreen_labeled_count >= PRESCREEN_RETRAIN_LABELS
+              or (summarize.prescreen_model is False and labeled_count > self.prescreen_labeled_count)):
+            logger.info(f"Retraining the pre-screen: {labeled_count - self.prescreen_labeled_count} new labels")
+            summarize.prescreen_model = None
+            self.prescreen_labeled_count = labeled_count
+        await asyncio.to_thread(summarize.evict_classification_cache, conn)
+        document_numbers = await asyncio.to_thread(fetch_pending_document_numbers, conn, SWEEP_LIMIT)
+        logger.info(f"Sweep found {len(document_numbers)} unclassified rows")
+        await self.enqueue(document_numbers)
+
+    async def refresh_cycle(self, conn):
+        await update.refresh_due_counts_async(conn, self.refresh_request_budget)
+        await asyncio.to_thread(get_http_cache().finish_run)
+
+    async def report_periodically(self):
+        """Close a metrics period every report interval: record it in pipeline_runs and start a new one."""
+        while True:
+            await self.wait_or_stop(self.intervals['report'])
+            if self.stopping.is_set():
+                return
+            logger.info(
+                f"Classified {self.totals['processed']} rows, {self.totals['ai_related']} AI-related, "
+                f"{self.totals['inserted']} new in ai_documents; {self.classify_queue.qsize()} queued"
+            )
+            await asyncio.to_thread(metrics.finish_run, get_config().database_url)
+            metrics.start_run('daemon')
+
+    async def claim_and_classify_locally(self, conn, document_numbers, current_date):
+        """Lease the queued rows and write back those classified without the LLM; returns the rest."""
+        rows = await asyncio.to_thread(summarize.claim_pending_rows, conn, self.worker_id, len(document_numbers),
+                                       document_numbers=document_numbers)
+        self.totals['claimed'] += len(rows)
+        claimed = {row[0] for row in rows}
+        # Already classified, claimed by another worker, or quarantined
+        for document_number in document_numbers:
+            if document_number not in claimed:
+                self.queued_at.pop(document_number, None)
+        remaining_rows, counts = await asyncio.to_thread(summarize.classify_locally, conn, rows, current_date,
+                                                         self.prescreen_threshold, self.worker_id)
+        summarize.add_counts(self.totals, counts)
+        remaining = {row[0] for row in remaining_rows}
+        self.mark_written([document_number for document_number in claimed if document_number not in remaining], 'local')
+        return remaining_rows
+
+    async def classify(self):
+        """Classify queued documents as they arrive, with up to claim_size rows in flight.
+
+        Stops taking new work once stopping, but keeps draining the queue so a
+        producer waiting on it can finish; a None on the queue ends the stage
+        after the packs in flight complete.
+        """
+        conn = self.connections['classify']
+        client = summarize.create_async_claude_client(self.max_concurrency)
+        rate_limiter = summarize.ClaudeRateLimiter(summarize.MAX_REQUESTS_PER_MINUTE, summarize.MAX_TOKENS_PER_MINUTE)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        pending = {}
+        getter = None
+        closed = False
+        renewed_at = time.monotonic()
+        try:
+            while True:
+                if getter is None and not closed and self.in_flight_rows < self.claim_size:
+                    getter = asyncio.create_task(self.classify_queue.get())
+                waiting = set(pending) | ({getter} if getter is not None else set())
+                if not waiting:
+                    break
+                done, _ = await asyncio.wait(waiting, timeout=summarize.CLAIM_RENEW_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                if pending and time.monotonic() - renewed_at >= summarize.CLAIM_RENEW_SECONDS:
+                    try:
+                        await asyncio.to_thread(summarize.renew_claims, conn, self.worker_id,
+                                                [row[0] for pack in pending.values() for row in pack])
+                    except Exception as e:
+                        logger.exception(f"Error renewing leases: {e}")
+                        conn = self.connections['classify'] = await asyncio.to_thread(reset_connection, conn)
+                    renewed_at = time.monotonic()
+
+                if getter in done:
+                    document_numbers = [getter.result()]
+                    getter = None
+                    while len(document_numbers) < self.claim_size - self.in_flight_rows and not self.classify_queue.empty():
+                        document_numbers.append(self.classify_queue.get_nowait())
+                    if None in document_numbers:
+                        closed = True
+                        document_numbers = [document_number for document_number in document_numbers if document_number is not None]
+                    if self.stopping.is_set():
+                        # Left for the next run's sweep
+                        for document_number in document_numbers:
+                            self.queued_at.pop(document_number, None)
+                    elif document_numbers:
+                        current_date = datetime.datetime.now(datetime.timezone.utc)
+                        try:
+                            rows = await self.claim_and_classify_locally(conn, document_numbers, current_date)
+                        except Exception as e:
+                            logger.exception(f"Error claiming {len(document_numbers)} rows: {e}")
+                            metrics.inc('daemon_cycles_total', stage='classify', outcome='failed')
+                            conn = self.connections['classify'] = await asyncio.to_thread(reset_connection, conn)
+                            # Any rows that were leased are picked up again by the sweep once their lease expires
+                            for document_number in document_numbers:
+                                self.queued_at.pop(document_number, None)
+                            rows = []
+                        for pack in summarize.pack_rows(rows, self.pack_size):
+                            task = asyncio.create_task(summarize.classify_pack_async(client, rate_limiter, semaphore, pack, current_date))
+                            pending[task] = pack
+                            self.in_flight_rows += len(pack)
+
+                for task in done:
+                    if task in pending:
+                        pack = pending.pop(task)
+                        self.in_flight_rows -= len(pack)
+                        processed_rows = task.result()
+                        # Rows the LLM couldn't classify keep their lease until it expires
+                        returned = {row['document_number'] for row in processed_rows}
+                        for row in pack:
+                            if row[0] not in returned:
+                                self.queued_at.pop(row[0], None)
+                        for processed_row in processed_rows:
+                            await self.results_queue.put(processed_row)
+        finally:
+            if getter is not None:
+                getter.cancel()
+            for task in pending:
+                task.cancel()
+            await client.close()
+            await self.results_queue.put(None)
+
+    async def write(self):
+        """Write classified rows as they arrive, until the classifier's None."""
+        while True:
+            conn = self.connections['write']
+            try:
+                await summarize.write_results(
+                    conn, self.results_queue, self.totals,
+                    on_written=lambda rows: self.mark_written([row['document_number'] for row in rows], 'llm'),
+                    worker_id=self.worker_id
+                )
+                return
+            except Exception as e:
+                # The group being written is lost; its rows are claimed again once their lease expires
+                logger.exception(f"Error writing classified rows: {e}")
+                metrics.inc('daemon_cycles_total', stage='write', outcome='failed')
+                self.connections['write'] = await asyncio.to_thread(reset_connection, conn)
+
+    async def drain(self, producers, classifier, writer):
+        await asyncio.gather(*producers)
+        await self.classify_queue.put(None)
+        await classifier
+        await writer
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        self.classify_queue = asyncio.Queue(maxsize=self.classify_queue_size)
+        self.results_queue = asyncio.Queue(maxsize=self.write_queue_size)
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signal_number, self.stop)
+
+        for name in ('pull', 'sweep', 'refresh', 'classify', 'write'):
+            self.connections[name] = await asyncio.to_thread(pipeline_metrics.connect, get_config().database_url)
+        logger.info(f"Pipeline daemon {self.worker_id} started: {self.intervals}")
+
+        classifier = asyncio.create_task(self.classify(), name='classify')
+        writer = asyncio.create_task(self.write(), name='write')
+        for task in (classifier, writer):
+            task.add_done_callback(self.stage_failed)
+        producers = [
+            asyncio.create_task(self.run_periodically('pull', self.pull_cycle)),
+            asyncio.create_task(self.run_periodically('sweep', self.sweep_cycle)),
+            asyncio.create_task(self.run_periodically('refresh', self.refresh_cycle)),
+            asyncio.create_task(self.report_periodically()),
+        ]
+        try:
+            await self.stopping.wait()
+            try:
+                await asyncio.wait_for(self.drain(producers, classifier, writer), self.shutdown_grace)
+            except asyncio.TimeoutError:
+                logger.warning(f"In-flight work didn't finish within {self.shutdown_grace}s; abandoning it")
+            except Exception as e:
+                logger.error(f"Error while shutting down: {e}")
+                self.failed = True
+        finally:
+            for task in producers + [classifier, writer]:
+                task.cancel()
+            await asyncio.gather(*producers, classifier, writer, return_exceptions=True)
+            await asyncio.to_thread(self.close)
+        logger.info(
+            f"Pipeline daemon stopped: classified {self.totals['processed']} rows, {self.totals['ai_related']} AI-related, "
+            f"{self.totals['inserted']} new in ai_documents"
+        )
+
+    def close(self):
+        """Hand back unfinished leases, write queued usage records and close the connections."""
+        try:
+            conn = reset_connection(self.connections['write'])
+            summarize.flush_pending_records(conn)
+            summarize.release_claims(conn, self.worker_id)
+        except psycopg2.Error as e:
+            logger.error(f"Error releasing claims: {e}")
+        get_http_cache().finish_run()
+        for conn in self.connections.values():
+            if not conn.closed:
+                conn.close()
+
+def main(**options):
+    database_url = get_config().database_url
+    metrics.start_run('daemon')
+    daemon = PipelineDaemon(**options)
+    try:
+        asyncio.run(daemon.run())
+    finally:
+        metrics.finish_run(database_url, 'failed' if daemon.failed else 'succeeded')
+
+def cli(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Pull, classify and refresh Federal Register documents continuously.")
+    parser.add_argument('--pull-interval', type=int, default=PULL_INTERVAL_SECONDS, help="Seconds between pulls.")
+    parser.add_argument('--sweep-interval', type=int, default=SWEEP_INTERVAL_SECONDS,
+                        help="Seconds between sweeps for unclassified rows the pulls didn't queue.")
+    parser.add_argument('--refresh-interval', type=int, default=REFRESH_INTERVAL_SECONDS,
+                        help="Seconds between page view and comment count refreshes.")
+    parser.add_argument('--report-interval', type=int, default=REPORT_INTERVAL_SECONDS,
+                        help="Seconds between runs recorded in pipeline_runs.")
+    parser.add_argument('--classify-queue-size', type=int, default=CLASSIFY_QUEUE_SIZE)
+    parser.add_argument('--write-queue-size', type=int, default=WRITE_QUEUE_SIZE)
+    parser.add_argument('--shutdown-grace', type=int, default=SHUTDOWN_GRACE_SECONDS)
+    parser.add_argument('--concurrency', type=int, default=summarize.MAX_CONCURRENT_REQUESTS)
+    parser.add_argument('--claim-size', type=int, default=summarize.CLAIM_BATCH_SIZE)
+    parser.add_argument('--pack-size', type=int, default=summarize.PACK_SIZE)
+    parser.add_argument('--prescreen-threshold', type=float, default=summarize.PRESCREEN_THRESHOLD)
+    parser.add_argument('--no-prescreen', action='store_true', help="Send every uncached row to the LLM.")
+    parser.add_argument('--refresh-request-budget', type=int, default=update.REFRESH_REQUEST_BUDGET)
+    args = parser.parse_args(argv)
+    main(pull_interval=args.pull_interval, sweep_interval=args.sweep_interval, refresh_interval=args.refresh_interval,
+         report_interval=args.report_interval, classify_queue_size=args.classify_queue_size,
+         write_queue_size=args.write_queue_size, shutdown_grace=args.shutdown_grace, max_concurrency=args.concurrency,
+         claim_size=args.claim_size, pack_size=args.pack_size,
+         prescreen_threshold=None if args.no_prescreen else args.prescreen_threshold,
+         refresh_request_budget=args.refresh_request_budget)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,288 @@
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_RUNS_TABLE_NAME = os.environ.get('PIPELINE_RUNS_TABLE_NAME', 'pipeline_runs')
+# Where to write <prefix>_<stage>.prom for node_exporter's textfile collector, if set
+PIPELINE_METRICS_TEXTFILE_DIR = os.environ.get('PIPELINE_METRICS_TEXTFILE_DIR')
+# Port to serve /metrics on while a run is in progress, if set
+PIPELINE_METRICS_PORT = os.environ.get('PIPELINE_METRICS_PORT')
+METRIC_PREFIX = 'fr_pipeline'
+# Upper bounds in seconds; covers a fast DB statement up to a slow LLM request
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# A statement is labelled with the table it writes, or else the first table it reads, so statement
+# timings are grouped without one series per query
+WRITE_PATTERN = re.compile(r'\b(INSERT\s+INTO|(?<!FOR )UPDATE|DELETE\s+FROM|COPY)\s+(\w+)', re.IGNORECASE)
+READ_PATTERN = re.compile(r'\bFROM\s+(\w+)', re.IGNORECASE)
+
+def series_key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+def statement_label(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = str(query)
+    match = WRITE_PATTERN.search(query)
+    if match:
+        return f"{match.group(1).split()[0].upper()} {match.group(2)}"
+    match = READ_PATTERN.search(query)
+    if match:
+        return f"SELECT {match.group(1)}"
+    return query.split(None, 1)[0].upper() if query.strip() else 'other'
+
+class Histogram:
+    """Cumulative-bucket histogram, as Prometheus exposes them."""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within the bucket it falls in."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+class PipelineMetrics:
+    """Counters, gauges and latency histograms for one script run, shared by the pipeline scripts.
+
+    Call start_run() at the top of a script's main and finish_run() at the
+    end; finish_run() writes the Prometheus textfile, if configured, and a
+    JSON summary of the run to the pipeline_runs table. Safe to use from
+    several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset(None)
+
+    def reset(self, stage):
+        with self.lock:
+            self.stage = stage
+            self.started_at = datetime.now()
+            self.started_monotonic = time.monotonic()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def start_run(self, stage):
+        self.reset(stage)
+        if PIPELINE_METRICS_PORT and self.server is None:
+            self.serve(int(PIPELINE_METRICS_PORT))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, buckets=HISTOGRAM_BUCKETS, **labels):
+        """Add an observation; buckets only takes effect on a series' first observation."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start_time, **labels)
+
+    def record_request(self, api, status, seconds):
+        """Count one API request attempt and its latency; status is the HTTP status or 'error'."""
+        self.inc('api_requests_total', api=api, status=status)
+        self.observe('api_request_seconds', seconds, api=api)
+        if status == 429:
+            self.inc('api_rate_limited_total', api=api)
+
+    def record_backoff(self, api, seconds, reason):
+        """Count a retry and the time slept before it; reason is 'rate_limited' after a 429, otherwise 'error'."""
+        self.inc('api_retries_total', api=api, reason=reason)
+        self.inc('backoff_sleep_seconds_total', seconds, api=api, reason=reason)
+
+    def record_throttle(self, api, seconds):
+        """Count time a request waited on the client's own rate limiter."""
+        self.inc('throttle_sleep_seconds_total', seconds, api=api)
+
+    def total(self, name):
+        """Sum of a counter, or of a histogram's observations, across all labels."""
+        with self.lock:
+            return (sum(value for (key, _), value in self.counters.items() if key == name)
+                    + sum(histogram.sum for (key, _), histogram in self.histograms.items() if key == name))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format, labelled with the stage."""
+        stage = {'stage': self.stage or 'unknown'}
+        lines = []
+        with self.lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+                    for (series_name, labels), value in sorted(series.items(), key=str):
+                        if series_name == name:
+                            lines.append(f"{series_key(f'{METRIC_PREFIX}_{name}', {**stage, **dict(labels)})} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} histogram")
+                for (series_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+                    if series_name != name:
+                        continue
+                    labels = {**stage, **dict(labels)}
+                    cumulative = 0
+                    for bound, bucket_count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += bucket_count
+                        lines.append(f"{series_key(f'{METRIC_PREFIX}_{name}_bucket', {**labels, 'le': bound})} {cumulative}")
+                    lines.append(f"{series_key(f'{METRIC_PREFIX}_{name}_sum', labels)} {histogram.sum}")
+                    lines.append(f"{series_key(f'{METRIC_PREFIX}_{name}_count', labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, status):
+        """The run as a JSON-serialisable dict, with a breakdown of where its time went."""
+        wall_seconds = time.monotonic() - self.started_monotonic
+        with self.lock:
+            counters = {series_key(name, dict(labels)): value for (name, labels), value in self.counters.items()}
+            histograms = {
+                series_key(name, dict(labels)): {
+                    'count': histogram.count, 'sum': round(histogram.sum, 3),
+                    'p50': round(histogram.quantile(0.5), 4), 'p95': round(histogram.quantile(0.95), 4),
+                }
+                for (name, labels), histogram in self.histograms.items() if histogram.count
+            }
+        return {
+            'status': status,
+            'wall_seconds': round(wall_seconds, 3),
+            # API and DB time overlap when requests run concurrently, so these can add up to more than wall_seconds
+            'time': {
+                'api_seconds': round(self.total('api_request_seconds'), 3),
+                'db_seconds': round(self.total('db_statement_seconds'), 3),
+                'backoff_seconds': round(self.total('backoff_sleep_seconds_total'), 3),
+                'throttle_seconds': round(self.total('throttle_sleep_seconds_total'), 3),
+            },
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    def write_textfile(self, directory=PIPELINE_METRICS_TEXTFILE_DIR):
+        if not directory:
+            return
+        path = os.path.join(directory, f"{METRIC_PREFIX}_{self.stage or 'unknown'}.prom")
+        # Written under a temporary name and renamed, so the collector never reads a partial file
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(self.render())
+        os.replace(f"{path}.tmp", path)
+
+    def serve(self, port):
+        """Serve the current metrics at /metrics from a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                data = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"Serving pipeline metrics on port {port}")
+
+    def record_run(self, database_url, summary):
+        with psycopg2.connect(database_url) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    INSERT INTO {PIPELINE_RUNS_TABLE_NAME} (stage, started_at, finished_at, status, summary)
+                    VALUES (%s, %s, NOW(), %s, %s)
+                    """,
+                    (self.stage, self.started_at, summary['status'], json.dumps(summary))
+                )
+        conn.close()
+
+    def finish_run(self, database_url, status='succeeded'):
+        """Write the textfile and the pipeline_runs row for the run. Never raises, so it can go in a finally block."""
+        summary = self.summary(status)
+        self.set('run_duration_seconds', summary['wall_seconds'])
+        self.set('run_finished_timestamp_seconds', time.time(), status=status)
+        try:
+            self.write_textfile()
+        except OSError as e:
+            logger.error(f"Error writing the metrics textfile: {e}")
+        try:
+            self.record_run(database_url, summary)
+        except psycopg2.Error as e:
+            logger.error(f"Error recording the run in {PIPELINE_RUNS_TABLE_NAME}: {e}")
+        logger.info(
+            f"Run {status} in {summary['wall_seconds']:.1f}s: {summary['time']['api_seconds']:.1f}s in API requests, "
+            f"{summary['time']['db_seconds']:.1f}s in DB statements, {summary['time']['backoff_seconds']:.1f}s backing off "
+            f"and {summary['time']['throttle_seconds']:.1f}s throttled"
+        )
+
+metrics = PipelineMetrics()
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that records each statement's time under db_statement_seconds, labelled by verb and table."""
+
+    def execute(self, query, vars=None):
+        with metrics.timer('db_statement_seconds', statement=statement_label(query)):
+            return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        with metrics.timer('db_statement_seconds', statement=statement_label(sql)):
+            return super().copy_expert(sql, file, size)
+
+class TimedConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedCursor
+
+    def commit(self):
+        with metrics.timer('db_statement_seconds', statement='COMMIT'):
+            return super().commit()
+
+def connect(database_url):
+    """psycopg2.connect, with statement and commit times recorded in metrics."""
+    return psycopg2.connect(database_url, connection_factory=TimedConnection)
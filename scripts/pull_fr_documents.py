@@ -1,218 +1,407 @@
+import argparse
+import hashlib
 import json
-import requests
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from federal_register.client import FederalRegister
+from itertools import islice
+from .config import get_config
+from .fr_http_cache import create_federal_register_client, get_http_cache
+from . import pipeline_metrics
+from .pipeline_metrics import metrics
 import re
 import os
 from dateutil.parser import parse
 import psycopg2
-from psycopg2.extras import execute_values
-from tqdm import tqdm
 
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-
-DATABASE_URL = os.environ['DATABASE_URL']
-FR_DOCUMENTS_TABLE_NAME = os.environ['FR_DOCUMENTS_TABLE_NAME']
+FR_DOCUMENTS_TABLE_NAME = os.environ.get('FR_DOCUMENTS_TABLE_NAME', 'fr_documents')
+BACKFILL_CHECKPOINTS_TABLE_NAME = os.environ.get('BACKFILL_CHECKPOINTS_TABLE_NAME', 'fr_backfill_checkpoints')
 TERMS = []
+INSERT_BATCH_SIZE = 2000
+LOOKBACK_DAYS = 3
+SHARD_SIZES = {'day': 1, 'week': 7}
 # TERMS = ['GPU','machine learning','artificial intelligence','compute','semiconductors','CHIPS']
 
 
-# Initialize the Federal Register client
-federal_register_client = FederalRegister()
+# The Federal Register client, with responses cached on disk between runs; created on first use
+federal_register_client = None
+
+def get_federal_register_client():
+    global federal_register_client
+    if federal_register_client is None:
+        federal_register_client = create_federal_register_client(get_http_cache())
+    return federal_register_client
+
+class RequestRateLimiter:
+    """Spaces out requests so that all threads together stay under a per-minute cap."""
+
+    def __init__(self, max_requests_per_minute):
+        self.interval = 60.0 / max_requests_per_minute
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
 
-def fetch_documents(terms, start_date, end_date, limit):
-    """Fetch documents from the Federal Register API for a given date and parse them correctly."""
-    response = federal_register_client.documents(
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            metrics.record_throttle('federal_register', slot - now)
+            time.sleep(slot - now)
+
+def fetch_document_page(terms, start_date, end_date, per_page, page, rate_limiter=None):
+    """Fetch a single page of search results from the Federal Register API."""
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    response = get_federal_register_client().documents(
         terms=terms,
         publication_date_greater_than=start_date,
         publication_date_less_than=end_date,
-        per_page=limit,
+        per_page=per_page,
+        page_id=page,
         order=['newest']
     )
     if isinstance(response, str):
         response = json.loads(response)  # Make sure it's parsed to a dictionary if it's a string
-    
-    documents = response.get('results', [])  # Access the 'results' key that contains the actual documents
-    if documents:
-        logging.info(f"Fetched {len(documents)} documents from Federal Register.")
-    else:
-        logging.warning("No documents found in the Federal Register response.")
-    
-    # Handle missing fields in the documents
-    valid_documents = []
-    for doc in tqdm(documents, desc="Processing documents"):
-        try:
-            doc.setdefault('abstract', '')
-            doc.setdefault('action', '')
-            doc.setdefault('agency_names', [])
-            doc.setdefault('html_url', '')
-            doc.setdefault('body_html_url', '')
-            doc.setdefault('citation', '')
-            doc.setdefault('comment_url', '')
-            doc.setdefault('comments_close_on', None)
-            doc.setdefault('dates', '')
-            doc.setdefault('docket_ids', [])
-            doc.setdefault('document_number', '')
-            doc.setdefault('effective_on', None)
-            doc.setdefault('excerpts', '')
-            doc.setdefault('full_text_xml_url', '')
-            doc.setdefault('json_url', '')
-            doc.setdefault('page_views', {})
-            doc.setdefault('publication_date', '')
-            doc.setdefault('raw_text_url', '')
-            doc.setdefault('regulations_dot_gov_info', {})
-            doc.setdefault('regulations_dot_gov_url', '')
-            doc.setdefault('significant', None)
-            doc.setdefault('subtype', '')
-            doc.setdefault('title', '')
-            doc.setdefault('toc_doc', '')
-            doc.setdefault('toc_subject', '')
-            doc.setdefault('topics', [])
-            doc.setdefault('type', '')
-            
-            valid_documents.append(doc)
-
-        except AttributeError as e:
-            logging.warning(f"Skipping document due to missing attributes: {e}")
-            # documents.remove(doc)  # Remove the problematic document from the list
-    
-    
-    return documents
+    if response is None:
+        import requests
+        raise requests.exceptions.RequestException(f"Federal Register API returned no response for page {page}")
+    return response
+
+def iter_document_pages(terms, start_date, end_date, per_page, rate_limiter=None):
+    """Yield every page of results, following next_page_url.
+
+    The next page is requested in the background while the caller is still
+    normalizing and inserting the current one, so at most two pages are held
+    in memory at any time.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 1
+        future = executor.submit(fetch_document_page, terms, start_date, end_date, per_page, page, rate_limiter)
+        while future is not None:
+            response = future.result()
+            future = None
+            if response.get('next_page_url'):
+                page += 1
+                future = executor.submit(fetch_document_page, terms, start_date, end_date, per_page, page, rate_limiter)
+            yield response
+
+def fetch_documents(terms, start_date, end_date, per_page, rate_limiter=None, show_progress=True):
+    """Stream documents from the Federal Register API for a date range, page by page."""
+    from tqdm import tqdm
+
+    progress = tqdm(desc="Processing documents", unit="doc", disable=not show_progress)
+    try:
+        for page_number, response in enumerate(iter_document_pages(terms, start_date, end_date, per_page, rate_limiter), start=1):
+            documents = response.get('results', [])  # Access the 'results' key that contains the actual documents
+            if page_number == 1:
+                if documents:
+                    logging.info(f"Federal Register reports {response.get('count', len(documents))} documents across {response.get('total_pages', 1)} pages.")
+                else:
+                    logging.warning("No documents found in the Federal Register response.")
+                progress.total = response.get('count')
+                progress.refresh()
+
+            for doc in documents:
+                try:
+                    yield FRDocumentRecord.from_api(doc)
+                except AttributeError as e:
+                    logging.warning(f"Skipping document due to missing attributes: {e}")
+                progress.update(1)
+    finally:
+        progress.close()
+
+def iter_batches(iterable, batch_size):
+    """Group an iterable into lists of at most batch_size items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+DOCKET_ID_PATTERN = re.compile(r'\b[A-Z]{3}-\d{4}-[\w-]+')
 
 def transform_regulations_url(document_id, docket_ids):
     """Transforms the regulations_dot_gov_comments_url to the desired format."""
 
     if document_id:
         return f"https://www.regulations.gov/document/{document_id}"
-    else:
-        # Search 'docket_ids' for a pattern like 'XXX-XXXX-anything'
-        match = re.search(r'\b[A-Z]{3}-\d{4}-[\w-]+', docket_ids)
-        if match:
-            # Check if the found docket ID already matches the required URL base format:
-            url_pattern = r'https://www.regulations.gov/document/([A-Z]{3}-\d{4}-[\w-]+)'
-            url_match = re.match(url_pattern, f"https://www.regulations.gov/document/{match.group(0)}")
-            if url_match:
-                return f"https://www.regulations.gov/document/{url_match.group(1)}-0001"
-            else:
-                return f"https://www.regulations.gov/document/{match.group(0)}"
-        else:
-            return ""  # Leave blank if nothing is found
-
-def fetch_existing_document_numbers(conn):
-    with conn.cursor() as cur:
-        cur.execute(f"SELECT document_number FROM {FR_DOCUMENTS_TABLE_NAME}")
-        existing_numbers = {row[0] for row in cur.fetchall()}
-    logging.info(f"Fetched {len(existing_numbers)} existing document numbers from PostgreSQL.")
-    return existing_numbers
-
-def insert_to_postgres(conn, documents, existing_numbers):
-    new_documents = [doc for doc in documents if doc['document_number'] not in existing_numbers]
-    if not new_documents:
-        logging.info("No new documents to insert, all duplicates.")
-        return
-
-    columns = [
+    # Search 'docket_ids' for a pattern like 'XXX-XXXX-anything' and point at its first document
+    match = DOCKET_ID_PATTERN.search(docket_ids)
+    if match:
+        return f"https://www.regulations.gov/document/{match.group(0)}-0001"
+    return ""  # Leave blank if nothing is found
+
+def _copy_text(value):
+    """Render a single value in PostgreSQL COPY text format."""
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, list):
+        # Array literal, with every element quoted
+        value = '{' + ','.join('"' + str(item).replace('\\', '\\\\').replace('"', '\\"') + '"' for item in value) + '}'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+class FRDocumentRecord:
+    """One fr_documents row, built from a Federal Register API document.
+
+    COLUMNS is the single source of truth for the column order used by the
+    COPY loader; content_hash must stay last since it covers the columns before it.
+    """
+
+    COLUMNS = (
         'abstract', 'action', 'agency_names', 'html_url', 'body_html_url', 'citation', 'comment_url',
         'comments_close_on', 'dates', 'docket_ids', 'document_number', 'effective_on', 'excerpts',
         'full_text_xml_url', 'json_url', 'page_views_count', 'publication_date', 'raw_text_url',
         'regulations_dot_gov_comments_url', 'regulations_dot_gov_docket_id', 'regulations_dot_gov_document_id',
         'regulations_dot_gov_title', 'regulations_dot_gov_url', 'significant', 'subtype', 'title', 'toc_doc',
-        'toc_subject', 'topics', 'type', 'comments_count'
-    ]
-
-    values = []
-    skipped_documents = []
-    for doc in tqdm(new_documents, desc="Preparing documents for insertion"):
-        try:
-            value = (
-                doc.get('abstract', ''),
-                doc.get('action', ''),
-                ', '.join(doc.get('agency_names', [])),
-                doc.get('html_url', ''),
-                doc.get('body_html_url', ''),
-                doc.get('citation', ''),
-                doc.get('comment_url', ''),
-                doc.get('comments_close_on'),
-                doc.get('dates', ''),
-                ', '.join(doc.get('docket_ids', [])),
-                doc.get('document_number', ''),
-                doc.get('effective_on'),
-                doc.get('excerpts', ''),
-                doc.get('full_text_xml_url', ''),
-                doc.get('json_url', ''),
-                doc.get('page_views', {}).get('count', 0),
-                doc.get('publication_date', ''),
-                doc.get('raw_text_url', ''),
-                transform_regulations_url(doc.get('regulations_dot_gov_info', {}).get('document_id', ''), ', '.join(doc.get('docket_ids', []))),
-                doc.get('regulations_dot_gov_info', {}).get('docket_id', ''),
-                doc.get('regulations_dot_gov_info', {}).get('document_id', ''),
-                doc.get('regulations_dot_gov_info', {}).get('title', ''),
-                doc.get('regulations_dot_gov_url', ''),
-                doc.get('significant'),
-                doc.get('subtype', ''),
-                doc.get('title', ''),
-                doc.get('toc_doc', ''),
-                doc.get('toc_subject', ''),
-                ', '.join(doc.get('topics', [])),
-                doc.get('type', ''),
-                doc.get('regulations_dot_gov_info', {}).get('docket_comments_count', 0)
-            )
-            values.append(value)
-        except AttributeError as e:
-            logging.warning(f"Skipping document {doc.get('document_number', '')} due to missing attributes: {e}")
-            skipped_documents.append(doc)
-
-            
-    if skipped_documents:
-        logging.info(f"Skipped {len(skipped_documents)} documents due to missing attributes.")
-    
-    if values:
-            with conn.cursor() as cur:
-                try:
-                    execute_values(cur, f"INSERT INTO {FR_DOCUMENTS_TABLE_NAME} ({', '.join(columns)}) VALUES %s", values)
-                    conn.commit()
-                    logging.info(f"Inserted {len(values)} new records into PostgreSQL.")
-                except psycopg2.IntegrityError as e:
-                    conn.rollback()
-                    if "duplicate key value violates unique constraint" in str(e):
-                        logging.warning("Duplicate documents found. Skipping insertion of duplicate records.")
-                        # Remove the duplicate documents from the list
-                        unique_documents = [doc for doc in documents if doc['document_number'] not in existing_numbers]
-                        logging.info(f"Removed {len(documents) - len(unique_documents)} duplicate documents.")
-                        # Retry the insertion with unique documents only
-                        values = [(
-                            doc.get('abstract', ''),
-                            doc.get('action', ''),
-                            ', '.join(doc.get('agency_names', [])),
-                            # ... (rest of the doc.get calls)
-                        ) for doc in unique_documents]
-                        execute_values(cur, f"INSERT INTO {FR_DOCUMENTS_TABLE_NAME} ({', '.join(columns)}) VALUES %s", values)
-                        conn.commit()
-                        logging.info(f"Inserted {len(unique_documents)} unique records into PostgreSQL.")
-                    else:
-                        logging.error(f"PostgreSQL Integrity Error: {e}")
-                        raise
-    else:
-        logging.info("No valid documents to insert.")
+        'toc_subject', 'topics', 'type', 'comments_count', 'content_hash'
+    )
+    # Refreshed independently by update_fr_documents, so they are left out of the content hash
+    VOLATILE_COLUMNS = ('page_views_count', 'comments_count')
+    __slots__ = COLUMNS
+
+    def __init__(self, *values):
+        for column, value in zip(self.COLUMNS, values):
+            setattr(self, column, value)
+
+    @classmethod
+    def from_api(cls, doc):
+        # The API returns null for many fields, so fall back on "or" rather than get() defaults
+        regulations_dot_gov_info = doc.get('regulations_dot_gov_info') or {}
+        docket_ids = list(doc.get('docket_ids') or [])
+        record = cls(
+            doc.get('abstract') or '',
+            doc.get('action') or '',
+            list(doc.get('agency_names') or []),
+            doc.get('html_url') or '',
+            doc.get('body_html_url') or '',
+            doc.get('citation') or '',
+            doc.get('comment_url') or '',
+            doc.get('comments_close_on') or None,
+            doc.get('dates') or '',
+            docket_ids,
+            doc.get('document_number') or '',
+            doc.get('effective_on') or None,
+            doc.get('excerpts') or '',
+            doc.get('full_text_xml_url') or '',
+            doc.get('json_url') or '',
+            (doc.get('page_views') or {}).get('count', 0),
+            doc.get('publication_date') or None,
+            doc.get('raw_text_url') or '',
+            transform_regulations_url(regulations_dot_gov_info.get('document_id', ''), ', '.join(docket_ids)),
+            regulations_dot_gov_info.get('docket_id', ''),
+            regulations_dot_gov_info.get('document_id', ''),
+            regulations_dot_gov_info.get('title', ''),
+            doc.get('regulations_dot_gov_url') or '',
+            doc.get('significant'),
+            doc.get('subtype') or '',
+            doc.get('title') or '',
+            doc.get('toc_doc') or '',
+            doc.get('toc_subject') or '',
+            list(doc.get('topics') or []),
+            doc.get('type') or '',
+            regulations_dot_gov_info.get('docket_comments_count', 0),
+        )
+        record.content_hash = record.compute_content_hash()
+        return record
+
+    def values(self):
+        return tuple(getattr(self, column) for column in self.COLUMNS)
 
+    def compute_content_hash(self):
+        """Hash the non-volatile columns so unchanged documents can be detected in the database."""
+        # Lists are hashed in the comma-joined form they were stored in before they became arrays,
+        # so rows pulled before then aren't all seen as changed
+        content = [', '.join(value) if isinstance(value, list) else value
+                   for value in (getattr(self, column) for column in self.COLUMNS[:-1] if column not in self.VOLATILE_COLUMNS)]
+        return hashlib.md5(json.dumps(content, default=str).encode('utf-8')).hexdigest()
 
+    def copy_line(self):
+        return '\t'.join(_copy_text(getattr(self, column)) for column in self.COLUMNS) + '\n'
+
+class RecordCopyStream:
+    """File-like object that renders records into COPY text format as psycopg2 reads it."""
+
+    def __init__(self, records):
+        self.lines = (record.copy_line() for record in records)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        buffered = len(self.buffer)
+        while size < 0 or buffered < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            buffered += len(line)
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+def insert_to_postgres(conn, records):
+    """Bulk load records through a COPY into a staging table, then merge them into fr_documents.
+
+    Existing rows are only rewritten when their content hash has changed, and then go back to pending classification
+    unless they had no hash yet.
+    Returns the document numbers of the rows that were new.
+    """
+    if not records:
+        logging.info("No documents to insert.")
+        return []
+
+    columns = ', '.join(FRDocumentRecord.COLUMNS)
+    # The counts belong to update_fr_documents, which keeps them fresher than search results are. A document whose
+    # content changed goes back to pending (ai_related NULL) so it is classified again. Rows stored before
+    # content_hash existed have nothing to compare against, so they keep their classification when it is first filled in
+    update_assignments = ', '.join(
+        [f"{column} = EXCLUDED.{column}" for column in FRDocumentRecord.COLUMNS
+         if column != 'document_number' and column not in FRDocumentRecord.VOLATILE_COLUMNS]
+        + [f"{column} = CASE WHEN {FR_DOCUMENTS_TABLE_NAME}.content_hash IS NULL THEN {FR_DOCUMENTS_TABLE_NAME}.{column} END"
+           for column in ('ai_related', 'classification_source')]
+    )
+    with conn.cursor() as cur:
+        cur.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {FR_DOCUMENTS_TABLE_NAME}_staging "
+            f"(LIKE {FR_DOCUMENTS_TABLE_NAME} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        cur.copy_expert(
+            f"COPY {FR_DOCUMENTS_TABLE_NAME}_staging ({columns}) FROM STDIN",
+            RecordCopyStream(records)
+        )
+        # Pages can repeat a document when new ones are published mid-run, and ON CONFLICT
+        # cannot touch the same row twice in one statement
+        cur.execute(f"""
+            INSERT INTO {FR_DOCUMENTS_TABLE_NAME} ({columns})
+            SELECT DISTINCT ON (document_number) {columns} FROM {FR_DOCUMENTS_TABLE_NAME}_staging
+            ORDER BY document_number
+            ON CONFLICT (document_number) DO UPDATE SET {update_assignments}
+            WHERE {FR_DOCUMENTS_TABLE_NAME}.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+            RETURNING document_number, (xmax = 0) AS inserted
+        """)
+        results = cur.fetchall()
+    conn.commit()
+
+    inserted_document_numbers = [document_number for document_number, inserted in results if inserted]
+    inserted_count = len(inserted_document_numbers)
+    updated_count = len(results) - inserted_count
+    unchanged_count = len(records) - len(results)
+    metrics.inc('rows_processed_total', inserted_count, outcome='inserted')
+    metrics.inc('rows_processed_total', updated_count, outcome='updated')
+    metrics.inc('rows_processed_total', unchanged_count, outcome='unchanged')
+    logging.info(f"Inserted {inserted_count} new records, updated {updated_count} changed records and left {unchanged_count} unchanged or repeated records in PostgreSQL.")
+    return inserted_document_numbers
+
+def split_date_range(start_date, end_date, shard_size):
+    """Split an inclusive YYYY-MM-DD range into consecutive (start, end) shards of shard_size."""
+    step = timedelta(days=SHARD_SIZES[shard_size])
+    shard_start = parse(start_date).date()
+    last_date = parse(end_date).date()
+    shards = []
+    while shard_start <= last_date:
+        shard_end = min(shard_start + step - timedelta(days=1), last_date)
+        shards.append((shard_start.isoformat(), shard_end.isoformat()))
+        shard_start = shard_end + timedelta(days=1)
+    return shards
+
+def fetch_completed_shards(conn, terms_key):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT shard_start, shard_end FROM {BACKFILL_CHECKPOINTS_TABLE_NAME} WHERE terms = %s",
+            (terms_key,)
+        )
+        return {(row[0].isoformat(), row[1].isoformat()) for row in cur.fetchall()}
+
+def record_completed_shard(conn, terms_key, shard_start, shard_end, documents_count):
     with conn.cursor() as cur:
-        execute_values(cur, f"INSERT INTO {FR_DOCUMENTS_TABLE_NAME} ({', '.join(columns)}) VALUES %s", values)
+        cur.execute(
+            f"""
+            INSERT INTO {BACKFILL_CHECKPOINTS_TABLE_NAME} (shard_start, shard_end, terms, documents_count, completed_at)
+            VALUES (%s, %s, %s, %s, NOW())
+            ON CONFLICT (shard_start, shard_end, terms)
+            DO UPDATE SET documents_count = EXCLUDED.documents_count, completed_at = EXCLUDED.completed_at
+            """,
+            (shard_start, shard_end, terms_key, documents_count)
+        )
     conn.commit()
-    logging.info(f"Inserted {len(new_documents)} new records into PostgreSQL.")
 
-def main(terms, start_date, end_date, limit):
+def backfill_shard(terms, terms_key, shard_start, shard_end, per_page, rate_limiter, batch_size=INSERT_BATCH_SIZE):
+    """Fetch and insert one shard on its own connection, then checkpoint it."""
+    with pipeline_metrics.connect(get_config().database_url) as conn:
+        documents_count = 0
+        documents = fetch_documents(terms, shard_start, shard_end, per_page, rate_limiter, show_progress=False)
+        for batch in iter_batches(documents, batch_size):
+            insert_to_postgres(conn, batch)
+            documents_count += len(batch)
+        record_completed_shard(conn, terms_key, shard_start, shard_end, documents_count)
+    return documents_count
+
+def backfill(terms, start_date, end_date, shard_size='week', max_workers=4, max_requests_per_minute=60, per_page=1000,
+             batch_size=INSERT_BATCH_SIZE):
+    """Load a historical date range shard by shard, skipping shards completed by an earlier run."""
+    from tqdm import tqdm
+
+    database_url = get_config().database_url
+    metrics.start_run('pull_backfill')
+    terms_key = ','.join(terms or [])
+    shards = split_date_range(start_date, end_date, shard_size)
+
+    with pipeline_metrics.connect(database_url) as conn:
+        completed_shards = fetch_completed_shards(conn, terms_key)
+
+    pending_shards = [shard for shard in shards if shard not in completed_shards]
+    logging.info(f"Backfilling {start_date} to {end_date}: {len(pending_shards)} of {len(shards)} {shard_size} shards pending.")
+
+    rate_limiter = RequestRateLimiter(max_requests_per_minute)
+    failed_shards = []
+    total_documents = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(backfill_shard, terms, terms_key, shard_start, shard_end, per_page, rate_limiter, batch_size):
+                (shard_start, shard_end)
+            for shard_start, shard_end in pending_shards
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Backfilling shards"):
+            shard_start, shard_end = futures[future]
+            try:
+                total_documents += future.result()
+            except Exception as e:
+                logging.error(f"Shard {shard_start} to {shard_end} failed: {e}")
+                failed_shards.append((shard_start, shard_end))
+                metrics.inc('shards_failed_total')
+
+    logging.info(f"Backfill fetched {total_documents} documents.")
+    get_http_cache().finish_run()
+    if failed_shards:
+        logging.warning(f"{len(failed_shards)} shards failed and will be retried on the next backfill run.")
+    metrics.finish_run(database_url, 'failed' if failed_shards else 'succeeded')
+
+def main(terms, start_date, end_date, limit, batch_size=INSERT_BATCH_SIZE):
+    import requests
+
+    database_url = get_config().database_url
+    metrics.start_run('pull')
+    status = 'failed'
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with pipeline_metrics.connect(database_url) as conn:
             logging.info("Connected to PostgreSQL database.")
-            existing_numbers = fetch_existing_document_numbers(conn)
-            documents = fetch_documents(terms, start_date, end_date, limit)
-            logging.info(f"Fetched {len(documents)} valid documents")
-            insert_to_postgres(conn, documents, existing_numbers)
+            total_documents = 0
+            for batch in iter_batches(fetch_documents(terms, start_date, end_date, limit), batch_size):
+                insert_to_postgres(conn, batch)
+                total_documents += len(batch)
+            logging.info(f"Fetched {total_documents} valid documents")
         logging.info("Process completed successfully.")
+        status = 'succeeded'
     except psycopg2.Error as e:
         logging.error(f"PostgreSQL error: {e}")
     except requests.exceptions.RequestException as e:
@@ -220,8 +409,32 @@ def main(terms, start_date, end_date, limit):
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
         logging.warning("Attempting to continue execution...")
+    finally:
+        get_http_cache().finish_run()
+        metrics.finish_run(database_url, status)
 
-if __name__ == '__main__':
+def cli(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     today_date = datetime.now().strftime('%Y-%m-%d')
-    yesterday_date = (datetime.now() - timedelta(days=3)).strftime('%Y-%m-%d')
-    main(terms=TERMS, start_date=yesterday_date, end_date=today_date, limit=1000)
+    parser = argparse.ArgumentParser(description="Pull Federal Register documents into PostgreSQL.")
+    parser.add_argument('--start-date', default=(datetime.now() - timedelta(days=LOOKBACK_DAYS)).strftime('%Y-%m-%d'),
+                        help=f"First publication date to pull (YYYY-MM-DD); defaults to {LOOKBACK_DAYS} days ago.")
+    parser.add_argument('--end-date', default=today_date, help="Last publication date to pull (YYYY-MM-DD); defaults to today.")
+    parser.add_argument('--per-page', type=int, default=1000, help="Documents per search results page.")
+    parser.add_argument('--batch-size', type=int, default=INSERT_BATCH_SIZE, help="Documents per insert.")
+    parser.add_argument('--backfill', nargs=2, metavar=('START_DATE', 'END_DATE'),
+                        help="Load a historical range (YYYY-MM-DD, inclusive) shard by shard, with checkpoints.")
+    parser.add_argument('--shard-size', choices=sorted(SHARD_SIZES), default='week')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-requests-per-minute', type=int, default=60)
+    args = parser.parse_args(argv)
+
+    if args.backfill:
+        backfill(terms=TERMS, start_date=args.backfill[0], end_date=args.backfill[1], shard_size=args.shard_size,
+                 max_workers=args.workers, max_requests_per_minute=args.max_requests_per_minute, per_page=args.per_page,
+                 batch_size=args.batch_size)
+    else:
+        main(terms=TERMS, start_date=args.start_date, end_date=args.end_date, limit=args.per_page, batch_size=args.batch_size)
+
+if __name__ == '__main__':
+    cli()
@@ -1,26 +1,84 @@
+import argparse
+import asyncio
 import os
+import socket
 import psycopg2
 from psycopg2.extras import execute_values, execute_batch
-import anthropic
+import httpx
 import json
 import re
-from tqdm import tqdm
 import logging
 import datetime
+import hashlib
 import time
-from anthropic import RateLimitError
+import zlib
+from collections import deque
+import numpy as np
+from .config import get_config
+from . import pipeline_metrics
+from .pipeline_metrics import metrics
+from .text_features import TOKEN_PATTERN, hashed_term_counts
 
-DATABASE_URL = os.environ['DATABASE_URL']
-FR_DOCUMENTS_TABLE_NAME = os.environ['FR_DOCUMENTS_TABLE_NAME']
-AI_DOCUMENTS_TABLE_NAME = os.environ['AI_DOCUMENTS_TABLE_NAME']
-CLAUDE_API_KEY = os.environ['CLAUDE_API_KEY']
+FR_DOCUMENTS_TABLE_NAME = os.environ.get('FR_DOCUMENTS_TABLE_NAME', 'fr_documents')
+AI_DOCUMENTS_TABLE_NAME = os.environ.get('AI_DOCUMENTS_TABLE_NAME', 'ai_documents')
+LLM_BATCHES_TABLE_NAME = os.environ.get('LLM_BATCHES_TABLE_NAME', 'llm_batches')
+LLM_USAGE_TABLE_NAME = os.environ.get('LLM_USAGE_TABLE_NAME', 'llm_usage')
+LLM_QUARANTINE_TABLE_NAME = os.environ.get('LLM_QUARANTINE_TABLE_NAME', 'llm_quarantine')
+# Each worker leases CLAIM_BATCH_SIZE rows at a time; leases of crashed workers expire after CLAIM_LEASE_SECONDS
+CLAIM_BATCH_SIZE = int(os.environ.get('CLAIM_BATCH_SIZE', 100))
+CLAIM_LEASE_SECONDS = int(os.environ.get('CLAIM_LEASE_SECONDS', 900))
+# Leases on rows still waiting for the LLM are extended this often, so slow or throttled requests don't lose them
+CLAIM_RENEW_SECONDS = CLAIM_LEASE_SECONDS / 3
+# Rows whose responses fail validation this many times stop being picked up
+QUARANTINE_AFTER_FAILURES = int(os.environ.get('QUARANTINE_AFTER_FAILURES', 3))
+CLASSIFICATION_CACHE_TABLE_NAME = os.environ.get('CLASSIFICATION_CACHE_TABLE_NAME', 'llm_classification_cache')
+CLASSIFICATION_CACHE_MAX_ENTRIES = int(os.environ.get('CLASSIFICATION_CACHE_MAX_ENTRIES', 500000))
+CLASSIFICATION_CACHE_MAX_AGE_DAYS = int(os.environ.get('CLASSIFICATION_CACHE_MAX_AGE_DAYS', 365))
+# Rows the local pre-screen scores below this (and that contain no AI keyword) are marked unrelated without the LLM
+PRESCREEN_THRESHOLD = float(os.environ.get('PRESCREEN_THRESHOLD', 0.02))
+PRESCREEN_FEATURES = 2 ** 18
+PRESCREEN_MAX_TRAINING_ROWS = int(os.environ.get('PRESCREEN_MAX_TRAINING_ROWS', 50000))
+PRESCREEN_MIN_TRAINING_ROWS = 1000
+PRESCREEN_MIN_POSITIVE_ROWS = 20
+PRESCREEN_SCORE_BATCH_SIZE = 5000
+# MinHash signatures of every row's prompt fields, for reusing the classification of a near-duplicate
+NEAR_DUPLICATE_TABLE_NAME = os.environ.get('NEAR_DUPLICATE_TABLE_NAME', 'document_minhashes')
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get('NEAR_DUPLICATE_THRESHOLD', 0.85))
+NEAR_DUPLICATE_MAX_CANDIDATES = 2000
+NEAR_DUPLICATE_REPORT_ROWS = 2000
+# 16 bands of 4 rows: pairs with Jaccard similarity 0.8 share a band 99.9% of the time, pairs at 0.3 about 12%
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_PRIME = (1 << 31) - 1
 CLAUDE_API_URL = 'https://api.anthropic.com/v1/complete'
+CLAUDE_MODEL = "claude-3-haiku-20240307"
+CLAUDE_KEEPALIVE_SECONDS = 60
+# Bump whenever PROMPT, SYSTEM_PROMPT or the request parameters change, so cached classifications are not reused
+PROMPT_VERSION = 4
+CLAUDE_MAX_TOKENS = 200
+# Packed requests classify several documents at once; K adapts so the answers fit in the output limit
+PACK_SIZE = int(os.environ.get('CLAUDE_PACK_SIZE', 10))
+PACK_MAX_INPUT_TOKENS = 24000
+PACK_OUTPUT_TOKENS_PER_DOCUMENT = 180
+CLAUDE_MAX_OUTPUT_TOKENS = 4096
 BATCH_SIZE = 100
 ALLOWED_TAGS = ["IP & Consumer Rights","Geopolitics & Defense","Healthcare","Policy & Standards","Capabilities & Research"]
-MAX_REQUESTS_PER_MINUTE = 50
+MAX_REQUESTS_PER_MINUTE = int(os.environ.get('CLAUDE_MAX_REQUESTS_PER_MINUTE', 50))
+MAX_TOKENS_PER_MINUTE = int(os.environ.get('CLAUDE_MAX_TOKENS_PER_MINUTE', 50000))
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('CLAUDE_MAX_CONCURRENT_REQUESTS', 8))
+# Requests per Message Batches job; the API accepts up to 100,000
+MESSAGE_BATCH_SIZE = 10000
+RESULTS_CHUNK_SIZE = 500
 request_timestamps = []
+cache_stats = {'hits': 0, 'misses': 0}
+prescreen_model = None
+prescreen_stats = {'negatives': 0, 'uncertain': 0}
+near_duplicate_stats = {'reused': 0, 'below_threshold': 0, 'no_candidates': 0, 'best_similarity': np.zeros(5, dtype=np.int64)}
+claude_client = None
+usage_records = deque()
+failure_records = deque()
+usage_totals = {'requests': 0, 'input_tokens': 0, 'output_tokens': 0, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 PROMPT = """
@@ -42,10 +100,6 @@ Here are three example:
 Input text:
 The European Union has proposed new regulations for AI systems, focusing on transparency, accountability, and human oversight. The proposed legislation aims to mitigate the risks associated with AI while fostering innovation and trust in the technology.
 
-Example JSON output:
-Input text:
-The European Union has proposed new regulations for AI systems, focusing on transparency, accountability, and human oversight. The proposed legislation aims to mitigate the risks associated with AI while fostering innovation and trust in the technology.
-
 Example JSON output:
 {
   "ai_related": 1,
@@ -72,39 +126,195 @@ Example JSON output:
   "llm_summary": "` * The text discusses a nuclear power plant, Three Mile Island Nuclear Station Unit 2, which is permanently shut down\n * The text does not appear to be related to AI, AI governance, AI policy, or any of the other topics listed in the instructions`",
   "tags": []
 }
+"""
 
-Now, please analyze the following text:
+PACKED_INSTRUCTIONS = """
+You will be given several documents, each introduced by its document number. Analyze each one separately as described in your instructions.
+Record one classification per document, in any order. Each MUST CONTAIN 'document_number' (copied exactly), 'ai_related', 'llm_summary' and 'tags'.
 """
 
-def fetch_rows_with_empty_ai_related(conn, batch_size):
+SYSTEM_PROMPT = "Your task is to analyze the provided text and determine its relevance to AI, AI policy, and related topics. Provide a JSON response with 'ai_related' (0 or 1) and 'llm_summary' fields."
+
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "ai_related": {"type": "integer", "enum": [0, 1]},
+        "llm_summary": {"type": "string"},
+        "tags": {"type": "array", "items": {"type": "string", "enum": ALLOWED_TAGS}}
+    },
+    "required": ["ai_related", "llm_summary", "tags"]
+}
+
+CLASSIFICATION_TOOL = {
+    "name": "record_classification",
+    "description": "Record the classification of the document.",
+    "input_schema": CLASSIFICATION_SCHEMA
+}
+
+PACKED_CLASSIFICATION_TOOL = {
+    "name": "record_classifications",
+    "description": "Record the classification of every document.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "classifications": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"document_number": {"type": "string"}, **CLASSIFICATION_SCHEMA["properties"]},
+                    "required": ["document_number"] + CLASSIFICATION_SCHEMA["required"]
+                }
+            }
+        },
+        "required": ["classifications"]
+    }
+}
+
+# The static instructions and examples go in the system prompt. They aren't marked for prompt caching:
+# together with the tool definition they come to well under claude-3-haiku's 2048-token minimum
+# cacheable prefix, so the API would ignore the breakpoint
+SYSTEM_BLOCKS = [
+    {"type": "text", "text": SYSTEM_PROMPT},
+    {"type": "text", "text": PROMPT},
+]
+
+DIGIT_PATTERN = re.compile(r"[0-9]+")
+# American Indian/Alaska Native, which the prompt tells the LLM not to read as AI
+AIAN_PATTERN = re.compile(r"\bAI\s*/\s*ANs?\b")
+AI_ACRONYM_PATTERN = re.compile(r"\bA\.?I\b")
+AI_KEYWORD_PATTERN = re.compile(
+    r"artificial intelligence|machine learning|deep learning|neural net|natural language processing|computer vision|"
+    r"robotic|language model|generative|algorithm|automated decision|autonomous|semiconductor|microelectronic|"
+    r"\bchips\b|\bgpus?\b|supercomput|\bcompute\b|biometric|facial recognition",
+    re.IGNORECASE
+)
+
+ROW_COLUMN_NAMES = (
+    'document_number', 'abstract', 'action', 'agency_names', 'raw_text_url', 'title', 'toc_doc', 'type', 'excerpts', 'body_html_url',
+    'comment_url', 'comments_close_on', 'dates', 'effective_on', 'full_text_xml_url', 'html_url', 'publication_date',
+    'regulations_dot_gov_comments_url', 'regulations_dot_gov_docket_id', 'regulations_dot_gov_document_id', 'page_views_count'
+)
+
+def row_columns(table):
+    """The select list for a row, qualified with table (a name or alias).
+
+    agency_names is an array in fr_documents but joined with ', ' in rows,
+    as the prompt, the classification cache key and ai_documents use it.
+    """
+    return ', '.join(
+        f"array_to_string({table}.{column}, ', ') AS {column}" if column == 'agency_names' else f"{table}.{column}"
+        for column in ROW_COLUMN_NAMES
+    )
+
+ROW_COLUMNS = row_columns(FR_DOCUMENTS_TABLE_NAME)
+
+def claim_pending_rows(conn, worker_id, batch_size, after='', document_numbers=None):
+    """Lease up to batch_size unclassified rows to worker_id, in document number order after `after`.
+
+    Rows are locked with SKIP LOCKED while the lease is written, so concurrent
+    workers never claim the same row. A lease that isn't released (because its
+    worker crashed) expires after CLAIM_LEASE_SECONDS and the row becomes
+    claimable again. Quarantined rows and rows in an uncollected message
+    batch are left out. Pass document_numbers to only consider those rows.
+    """
+    only_listed = "AND document_number = ANY(%(document_numbers)s)" if document_numbers is not None else ""
     with conn.cursor() as cur:
         cur.execute(
             f"""
-            SELECT document_number, abstract, action, agency_names, raw_text_url, title, toc_doc, type, excerpts, body_html_url, 
-                   comment_url, comments_close_on, dates, effective_on, full_text_xml_url, html_url, publication_date, 
-                   regulations_dot_gov_comments_url, regulations_dot_gov_docket_id, regulations_dot_gov_document_id, page_views_count
-            FROM {FR_DOCUMENTS_TABLE_NAME} 
-            WHERE ai_related IS NULL OR ai_related = '' 
-            LIMIT %s
+            WITH claimable AS (
+                SELECT document_number
+                FROM {FR_DOCUMENTS_TABLE_NAME}
+                WHERE ai_related IS NULL
+                  AND document_number > %(after)s
+                  {only_listed}
+                  AND (claimed_until IS NULL OR claimed_until < NOW())
+                  AND NOT EXISTS (
+                      SELECT 1 FROM {LLM_BATCHES_TABLE_NAME} b
+                      WHERE b.collected_at IS NULL AND {FR_DOCUMENTS_TABLE_NAME}.document_number = ANY(b.document_numbers)
+                  )
+                  AND NOT EXISTS (
+                      SELECT 1 FROM {LLM_QUARANTINE_TABLE_NAME} q
+                      WHERE q.quarantined_at IS NOT NULL AND q.document_number = {FR_DOCUMENTS_TABLE_NAME}.document_number
+                  )
+                ORDER BY document_number
+                LIMIT %(batch_size)s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {FR_DOCUMENTS_TABLE_NAME}
+            SET claimed_by = %(worker_id)s, claimed_until = NOW() + make_interval(secs => %(lease_seconds)s)
+            FROM claimable
+            WHERE {FR_DOCUMENTS_TABLE_NAME}.document_number = claimable.document_number
+            RETURNING {ROW_COLUMNS}
+            """,
+            {'after': after, 'document_numbers': list(document_numbers or []), 'batch_size': batch_size,
+             'worker_id': worker_id, 'lease_seconds': CLAIM_LEASE_SECONDS}
+        )
+        rows = cur.fetchall()
+    conn.commit()
+    # UPDATE ... RETURNING doesn't preserve the CTE's ordering
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+def release_claims(conn, worker_id):
+    """Give up the leases worker_id still holds, so unfinished rows can be claimed again straight away."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"UPDATE {FR_DOCUMENTS_TABLE_NAME} SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = %s",
+            (worker_id,)
+        )
+    conn.commit()
+
+def renew_claims(conn, worker_id, document_numbers):
+    """Extend worker_id's leases on document_numbers by CLAIM_LEASE_SECONDS from now, returning how many it still held."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            UPDATE {FR_DOCUMENTS_TABLE_NAME} SET claimed_until = NOW() + make_interval(secs => %s)
+            WHERE claimed_by = %s AND document_number = ANY(%s)
             """,
-            (batch_size,)
+            (CLAIM_LEASE_SECONDS, worker_id, list(document_numbers))
+        )
+        renewed_count = cur.rowcount
+    conn.commit()
+    if renewed_count < len(document_numbers):
+        logger.warning(f"{len(document_numbers) - renewed_count} leases of {worker_id} expired and were taken over before renewal")
+    return renewed_count
+
+def fetch_rows_by_document_number(conn, document_numbers):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT {ROW_COLUMNS} FROM {FR_DOCUMENTS_TABLE_NAME} WHERE document_number = ANY(%s)",
+            (list(document_numbers),)
         )
         rows = cur.fetchall()
     return rows
 
-def update_rows_in_postgres(conn, rows):
+def update_rows_in_postgres(conn, rows, worker_id=None):
+    """Write classifications back to fr_documents and return the set of document numbers written.
+
+    With worker_id, a row is only written while worker_id still holds its
+    lease, so a worker whose lease expired and was taken over can't write
+    over the new owner's result or clear its claim.
+    """
+    owner_check = f"AND {FR_DOCUMENTS_TABLE_NAME}.claimed_by = data.worker_id" if worker_id is not None else ""
     with conn.cursor() as cur:
         update_query = f"""
             UPDATE {FR_DOCUMENTS_TABLE_NAME}
             SET ai_related = data.ai_related,
                 llm_summary = data.llm_summary,
-                tags = string_to_array(data.tags, ', ')
-            FROM (VALUES %s) AS data (document_number, ai_related, llm_summary, tags)
-            WHERE {FR_DOCUMENTS_TABLE_NAME}.document_number = data.document_number
+                tags = data.tags::text[],
+                classification_source = data.classification_source,
+                claimed_by = NULL,
+                claimed_until = NULL
+            FROM (VALUES %s) AS data (document_number, ai_related, llm_summary, tags, classification_source, worker_id)
+            WHERE {FR_DOCUMENTS_TABLE_NAME}.document_number = data.document_number {owner_check}
+            RETURNING {FR_DOCUMENTS_TABLE_NAME}.document_number
         """
-        values = [(row['document_number'], row['ai_related'], row['llm_summary'], row['tags']) for row in rows]
-        execute_values(cur, update_query, values)
+        values = [(row['document_number'], row['ai_related'], row['llm_summary'], row['tags'], row['classification_source'], worker_id)
+                  for row in rows]
+        written = {document_number for (document_number,) in execute_values(cur, update_query, values, fetch=True)}
     conn.commit()
+    return written
 
 
 def correct_json_formatting(incorrect_json):
@@ -134,18 +344,11 @@ def correct_json_formatting(incorrect_json):
 
     return corrected_json
 
-def process_batch(rows):
-    processed_rows = []
-    current_date = datetime.datetime.now().strftime('%Y-%m-%d')  # Format: YYYY-MM-DD
-
-    for row in tqdm(rows, desc="Processing rows"):
-        document_number, abstract, action, agency_names, raw_text_url, title, toc_doc, type_, excerpts, body_html_url, \
-        comment_url, comments_close_on, dates, effective_on, full_text_xml_url, html_url, publication_date, \
-        regulations_dot_gov_comments_url, regulations_dot_gov_docket_id, regulations_dot_gov_document_id, page_views_count = row
-
-        prompt = f"""
-        Your instructions:
-        {PROMPT}
+def build_prompt(row):
+    """Build the classification prompt for a row returned by claim_pending_rows."""
+    document_number, abstract, action, agency_names, raw_text_url, title, toc_doc, type_, excerpts = row[:9]
+    return f"""
+        Now, please analyze the following text:
 
         Abstract: {abstract}
         Action: {action}
@@ -156,63 +359,315 @@ def process_batch(rows):
         Excerpts: {excerpts}
         """
 
-        response = send_to_claude_api(prompt)
-        if response:
-            response_text = response[0].text.strip()
-            
-            # logger.info(f"Original API response for document {document_number}:")
-            # logger.info(response_text)
+def build_packed_prompt(rows):
+    """Build one prompt that asks for a classification of every row, keyed by document number."""
+    documents = "\n".join(
+        f"""
+        Document number: {row[0]}
+        Abstract: {row[1]}
+        Action: {row[2]}
+        Agency Names: {row[3]}
+        Title: {row[5]}
+        TOC Doc: {row[6]}
+        Type: {row[7]}
+        Excerpts: {row[8]}
+        """
+        for row in rows
+    )
+    return f"""
+        {PACKED_INSTRUCTIONS}
+        Now, please analyze the following documents:
+        {documents}
+        """
+
+def pack_rows(rows, max_pack_size=PACK_SIZE):
+    """Group rows into packs that fit both the input budget and the output token limit."""
+    max_documents = max(1, min(max_pack_size, CLAUDE_MAX_OUTPUT_TOKENS // PACK_OUTPUT_TOKENS_PER_DOCUMENT))
+    packs = []
+    pack = []
+    pack_tokens = 0
+    for row in rows:
+        row_tokens = sum(len(str(value or '')) for value in row[1:9]) // 4
+        if pack and (len(pack) >= max_documents or pack_tokens + row_tokens > PACK_MAX_INPUT_TOKENS):
+            packs.append(pack)
+            pack = []
+            pack_tokens = 0
+        pack.append(row)
+        pack_tokens += row_tokens
+    if pack:
+        packs.append(pack)
+    return packs
+
+def response_payload(content):
+    """The structured tool input of a response, or JSON repaired out of its text as a last resort."""
+    for block in content:
+        if block.type == 'tool_use':
+            return block.input
+    text = ''.join(getattr(block, 'text', '') for block in content).strip()
+    # Attempt to fix common JSON formatting errors
+    return json.loads(correct_json_formatting(text))
+
+def raw_response_text(content):
+    return '\n'.join(json.dumps(block.input) if block.type == 'tool_use' else getattr(block, 'text', '') for block in content)
+
+def validate_classification(result):
+    """Check one classification against CLASSIFICATION_SCHEMA, returning (ai_related, llm_summary, tags).
+
+    Raises ValueError describing the first problem found.
+    """
+    if not isinstance(result, dict):
+        raise ValueError(f"Expected a JSON object, got {type(result).__name__}")
+    ai_related = result.get('ai_related')
+    if isinstance(ai_related, str) and ai_related.strip() in ('0', '1'):
+        ai_related = int(ai_related)
+    if ai_related not in (0, 1):
+        raise ValueError(f"Invalid ai_related value: {ai_related!r}")
+    llm_summary = result.get('llm_summary')
+    if not isinstance(llm_summary, str):
+        raise ValueError("Missing or non-string llm_summary")
+    tags = result.get('tags')
+    if not isinstance(tags, list):
+        raise ValueError("Missing or non-list tags")
+    return int(ai_related), llm_summary, [tag for tag in tags if tag in ALLOWED_TAGS]
+
+def salvage_json_objects(text):
+    """Decode whatever JSON objects are intact in malformed or truncated text."""
+    results = []
+    decoder = json.JSONDecoder()
+    position = text.find('{')
+    while position != -1:
+        try:
+            result, end = decoder.raw_decode(text, position)
+            results.append(result)
+            position = text.find('{', end)
+        except json.JSONDecodeError:
+            position = text.find('{', position + 1)
+    return results
+
+def parse_packed_response(rows, content, current_date):
+    """Parse a packed response into processed rows keyed by document number.
+
+    Classifications that fail validation or don't match a requested document
+    are dropped, so the caller can retry just the missing documents.
+    """
+    rows_by_number = {row[0]: row for row in rows}
+    tool_inputs = [block.input for block in content if block.type == 'tool_use']
+    if tool_inputs:
+        results = tool_inputs[0].get('classifications') or []
+    else:
+        results = salvage_json_objects(''.join(getattr(block, 'text', '') for block in content))
+
+    processed_rows = {}
+    for result in results:
+        row = rows_by_number.get(str(result.get('document_number'))) if isinstance(result, dict) else None
+        if row is None:
+            continue
+        try:
+            processed_rows[row[0]] = build_processed_row(row, *validate_classification(result), current_date)
+        except ValueError as e:
+            logger.error(f"Invalid packed classification for document {row[0]}: {str(e)}")
+    return processed_rows
+
+def parse_llm_response(row, content, current_date):
+    """Turn the LLM's response for a row into the dict written back to Postgres.
+
+    Raises ValueError (including json.JSONDecodeError) if the response can't be used.
+    """
+    return build_processed_row(row, *validate_classification(response_payload(content)), current_date)
+
+def build_processed_row(row, ai_related, llm_summary, tags, current_date, classification_source='llm'):
+    """Combine a fetched row with its classification into the dict written back to Postgres."""
+    document_number, abstract, action, agency_names, raw_text_url, title, toc_doc, type_, excerpts, body_html_url, \
+    comment_url, comments_close_on, dates, effective_on, full_text_xml_url, html_url, publication_date, \
+    regulations_dot_gov_comments_url, regulations_dot_gov_docket_id, regulations_dot_gov_document_id, page_views_count = row
 
+    return {
+        "document_number": document_number,
+        "abstract": abstract,
+        "action": action,
+        "agency_names": agency_names,
+        "raw_text_url": raw_text_url,
+        "title": title,
+        "toc_doc": toc_doc,
+        "type": type_,
+        "excerpts": excerpts,
+        "body_html_url": body_html_url,
+        "comment_url": comment_url,
+        "comments_close_on": comments_close_on,
+        "dates": dates,
+        "effective_on": effective_on,
+        "full_text_xml_url": full_text_xml_url,
+        "html_url": html_url,
+        "publication_date": publication_date,
+        "regulations_dot_gov_comments_url": regulations_dot_gov_comments_url,
+        "regulations_dot_gov_docket_id": regulations_dot_gov_docket_id,
+        "regulations_dot_gov_document_id": regulations_dot_gov_document_id,
+        "page_views_count": page_views_count,
+        "ai_related": ai_related,
+        "llm_summary": llm_summary,
+        "tags": list(tags),
+        "created_at": current_date,
+        "last_modified": current_date,
+        "cache_key": classification_cache_key(row),
+        "classification_source": classification_source
+    }
+
+def process_batch(rows):
+    """Classify rows one at a time with the synchronous client."""
+    from tqdm import tqdm
+
+    processed_rows = []
+    current_date = datetime.datetime.now(datetime.timezone.utc)  # created_at and last_modified in ai_documents
+
+    for row in tqdm(rows, desc="Processing rows"):
+        document_number = row[0]
+        response = send_to_claude_api(build_prompt(row), document_numbers=[document_number])
+        if response:
             try:
-                # Attempt to fix common JSON formatting errors
-                corrected_json = correct_json_formatting(response_text)
+                processed_rows.append(parse_llm_response(row, response, current_date))
                 logger.info(f"Success! Parsed JSON response from LLM for document {document_number}:")
-                # logger.info(corrected_json)
-
-                response_json = json.loads(corrected_json)
-                ai_related = response_json['ai_related']
-                llm_summary = response_json['llm_summary']
-                tags = response_json['tags']
-                tags_str = ', '.join(tags)  # Convert list to comma-separated string
-
-                processed_row = {
-                    "document_number": document_number,
-                    "abstract": abstract,
-                    "action": action,
-                    "agency_names": agency_names,
-                    "raw_text_url": raw_text_url,
-                    "title": title,
-                    "toc_doc": toc_doc,
-                    "type": type_,
-                    "excerpts": excerpts,
-                    "body_html_url": body_html_url,
-                    "comment_url": comment_url,
-                    "comments_close_on": comments_close_on,
-                    "dates": dates,
-                    "effective_on": effective_on,
-                    "full_text_xml_url": full_text_xml_url,
-                    "html_url": html_url,
-                    "publication_date": publication_date,
-                    "regulations_dot_gov_comments_url": regulations_dot_gov_comments_url,
-                    "regulations_dot_gov_docket_id": regulations_dot_gov_docket_id,
-                    "regulations_dot_gov_document_id": regulations_dot_gov_document_id,
-                    "page_views_count": page_views_count,
-                    "ai_related": ai_related,
-                    "llm_summary": llm_summary,
-                    "tags": tags_str,
-                    "created_at": current_date,
-                    "last_modified": current_date
-                }
-                processed_rows.append(processed_row)
-            except (json.JSONDecodeError, ValueError, KeyError) as e:
+            except ValueError as e:
                 logger.error(f"Error processing JSON for document {document_number}: {str(e)}")
                 logger.error("Skipping this row.")
+                record_failure(document_number, e, response)
 
     return processed_rows
 
-def send_to_claude_api(prompt, max_attempts=3):
+def build_message_params(prompt, max_tokens=CLAUDE_MAX_TOKENS, packed=False):
+    """Request parameters shared by the synchronous, async and Message Batches paths.
+
+    The answer is forced through a tool call, so it always arrives as JSON matching the tool's schema.
+    """
+    tool = PACKED_CLASSIFICATION_TOOL if packed else CLASSIFICATION_TOOL
+    return {
+        "tools": [tool],
+        "tool_choice": {"type": "tool", "name": tool["name"]},
+        "model": CLAUDE_MODEL,
+        "max_tokens": max_tokens,
+        "temperature": 0,
+        "system": SYSTEM_BLOCKS,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+    }
+
+def get_claude_client():
+    """Shared synchronous client, so requests reuse pooled keep-alive connections.
+
+    anthropic takes a large share of the import time, so it is only imported
+    by the functions that create clients or catch its errors.
+    """
+    global claude_client
+    if claude_client is None:
+        import anthropic
+
+        config = get_config()
+        limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS, max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+                              keepalive_expiry=CLAUDE_KEEPALIVE_SECONDS)
+        claude_client = anthropic.Anthropic(api_key=config.claude_api_key, base_url=config.claude_api_base_url,
+                                            http_client=anthropic.DefaultHttpxClient(limits=limits))
+    return claude_client
+
+def create_async_claude_client(max_concurrency):
+    """Async client for one event loop, pooling a keep-alive connection per in-flight request."""
+    import anthropic
+
+    config = get_config()
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency,
+                          keepalive_expiry=CLAUDE_KEEPALIVE_SECONDS)
+    return anthropic.AsyncAnthropic(api_key=config.claude_api_key, base_url=config.claude_api_base_url, max_retries=0,
+                                    http_client=anthropic.DefaultAsyncHttpxClient(limits=limits))
+
+def record_usage(document_numbers, request_type, usage, latency_seconds=None):
+    """Queue a request's token usage and latency for the usage table."""
+    cache_creation_input_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    cache_read_input_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+    latency_ms = round(latency_seconds * 1000) if latency_seconds is not None else None
+    usage_records.append((
+        list(document_numbers), CLAUDE_MODEL, request_type, usage.input_tokens, usage.output_tokens,
+        cache_creation_input_tokens, cache_read_input_tokens, latency_ms
+    ))
+    metrics.inc('llm_tokens_total', usage.input_tokens, kind='input')
+    metrics.inc('llm_tokens_total', usage.output_tokens, kind='output')
+    metrics.inc('llm_tokens_total', cache_creation_input_tokens, kind='cache_creation_input')
+    metrics.inc('llm_tokens_total', cache_read_input_tokens, kind='cache_read_input')
+    usage_totals['requests'] += 1
+    usage_totals['input_tokens'] += usage.input_tokens
+    usage_totals['output_tokens'] += usage.output_tokens
+    usage_totals['cache_creation_input_tokens'] += cache_creation_input_tokens
+    usage_totals['cache_read_input_tokens'] += cache_read_input_tokens
+
+def record_failure(document_number, error, content):
+    """Queue a response that couldn't be used, to count towards quarantining its row."""
+    metrics.inc('llm_unusable_responses_total')
+    failure_records.append((document_number, str(error), raw_response_text(content)))
+
+def flush_failure_records(conn):
+    # A document can fail more than once between flushes; keep its latest failure
+    latest = {}
+    while failure_records:
+        record = failure_records.popleft()
+        latest[record[0]] = record
+    if not latest:
+        return
+    with conn.cursor() as cur:
+        quarantined = execute_values(
+            cur,
+            f"""
+            INSERT INTO {LLM_QUARANTINE_TABLE_NAME} AS q (document_number, failure_count, last_error, raw_response, last_failed_at, quarantined_at)
+            VALUES %s
+            ON CONFLICT (document_number) DO UPDATE
+            SET failure_count = q.failure_count + 1,
+                last_error = EXCLUDED.last_error,
+                raw_response = EXCLUDED.raw_response,
+                last_failed_at = NOW(),
+                quarantined_at = CASE WHEN q.failure_count + 1 >= {QUARANTINE_AFTER_FAILURES} THEN COALESCE(q.quarantined_at, NOW()) END
+            RETURNING quarantined_at IS NOT NULL
+            """,
+            list(latest.values()),
+            template=f"(%s, 1, %s, %s, NOW(), CASE WHEN 1 >= {QUARANTINE_AFTER_FAILURES} THEN NOW() END)",
+            fetch=True
+        )
+    conn.commit()
+    logger.warning(f"Recorded {len(latest)} unusable LLM responses; "
+                   f"{sum(1 for (is_quarantined,) in quarantined if is_quarantined)} of those documents are quarantined")
+
+def flush_pending_records(conn):
+    """Write queued usage and failure records."""
+    flush_usage_records(conn)
+    flush_failure_records(conn)
+
+def flush_usage_records(conn):
+    values = []
+    while usage_records:
+        values.append(usage_records.popleft())
+    if not values:
+        return
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            f"""
+            INSERT INTO {LLM_USAGE_TABLE_NAME} (document_numbers, model, request_type, input_tokens, output_tokens,
+                                                 cache_creation_input_tokens, cache_read_input_tokens, latency_ms)
+            VALUES %s
+            """,
+            values
+        )
+    conn.commit()
+
+def send_to_claude_api(prompt, max_attempts=3, document_numbers=()):
+    from anthropic import RateLimitError
+
     global request_timestamps
-    client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
+    client = get_claude_client()
 
     for attempt in range(max_attempts):
         try:
@@ -222,27 +677,19 @@ def send_to_claude_api(prompt, max_attempts=3):
             if len(request_timestamps) >= MAX_REQUESTS_PER_MINUTE:
                 sleep_time = 60 - (current_time - request_timestamps[0])
                 logger.info(f"Rate limit reached. Waiting for {sleep_time:.2f} seconds before retrying.")
+                metrics.record_throttle('claude', sleep_time)
                 time.sleep(sleep_time)
 
             request_timestamps.append(current_time)
 
-            message = client.messages.create(
-                model="claude-3-haiku-20240307",
-                max_tokens=200,
-                temperature=0,
-                system="Your task is to analyze the provided text and determine its relevance to AI, AI policy, and related topics. Provide a JSON response with 'ai_related' (0 or 1) and 'llm_summary' fields.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ]
-            )
+            start_time = time.monotonic()
+            try:
+                message = client.messages.create(**build_message_params(prompt))
+            except Exception as e:
+                metrics.record_request('claude', getattr(e, 'status_code', 'error'), time.monotonic() - start_time)
+                raise
+            metrics.record_request('claude', 200, time.monotonic() - start_time)
+            record_usage(document_numbers, 'single', message.usage, time.monotonic() - start_time)
 
             response_json = message.content
             return response_json
@@ -250,11 +697,13 @@ def send_to_claude_api(prompt, max_attempts=3):
             if attempt < max_attempts - 1:
                 sleep_time = 60 - (time.time() - request_timestamps[-1])
                 logger.info(f"Rate limit exceeded. Waiting for {sleep_time:.2f} seconds before retrying.")
+                metrics.record_backoff('claude', sleep_time, 'rate_limited')
                 time.sleep(sleep_time)
             else:
                 raise e
         except Exception as e:
             if attempt < max_attempts - 1:
+                metrics.record_backoff('claude', 0, 'error')
                 continue
             else:
                 raise e
@@ -308,36 +757,908 @@ def insert_rows_to_ai_documents(conn, rows):
         return len(ai_related_rows), inserted_count
 
 
-def main():
-    logger.info("Script started")
+def classification_cache_key(row):
+    """Hash the prompt version, model and the normalized prompt inputs of a row."""
+    abstract, action, agency_names, title, toc_doc, type_, excerpts = (row[1], row[2], row[3], row[5], row[6], row[7], row[8])
+    inputs = [' '.join(str(value or '').split()) for value in (abstract, action, agency_names, title, toc_doc, type_, excerpts)]
+    payload = json.dumps([PROMPT_VERSION, CLAUDE_MODEL, inputs])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def apply_classification_cache(conn, rows, current_date):
+    """Split rows into cached classifications (as processed rows) and rows that still need the LLM."""
+    keys_by_number = {row[0]: classification_cache_key(row) for row in rows}
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT cache_key, ai_related, llm_summary, tags FROM {CLASSIFICATION_CACHE_TABLE_NAME} WHERE cache_key = ANY(%s)",
+            (list(set(keys_by_number.values())),)
+        )
+        cached = {cache_key: (ai_related, llm_summary, tags or []) for cache_key, ai_related, llm_summary, tags in cur.fetchall()}
+        if cached:
+            cur.execute(
+                f"UPDATE {CLASSIFICATION_CACHE_TABLE_NAME} SET hit_count = hit_count + 1, last_hit_at = NOW() WHERE cache_key = ANY(%s)",
+                (list(cached),)
+            )
+    conn.commit()
+
+    cached_rows = []
+    uncached_rows = []
+    for row in rows:
+        hit = cached.get(keys_by_number[row[0]])
+        if hit:
+            cached_rows.append(build_processed_row(row, *hit, current_date, classification_source='cache'))
+        else:
+            uncached_rows.append(row)
+    cache_stats['hits'] += len(cached_rows)
+    cache_stats['misses'] += len(uncached_rows)
+    return cached_rows, uncached_rows
+
+def store_cached_classifications(conn, processed_rows):
+    # Identical documents share a key, and ON CONFLICT cannot touch the same row twice in one statement
+    values = list({
+        row['cache_key']: (row['cache_key'], PROMPT_VERSION, CLAUDE_MODEL, row['ai_related'], row['llm_summary'], row['tags'])
+        for row in processed_rows
+    }.values())
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            f"""
+            INSERT INTO {CLASSIFICATION_CACHE_TABLE_NAME} (cache_key, prompt_version, model, ai_related, llm_summary, tags)
+            VALUES %s
+            ON CONFLICT (cache_key) DO UPDATE
+            SET ai_related = EXCLUDED.ai_related, llm_summary = EXCLUDED.llm_summary, tags = EXCLUDED.tags, created_at = NOW()
+            """,
+            values
+        )
+    conn.commit()
+
+def evict_classification_cache(conn, max_entries=CLASSIFICATION_CACHE_MAX_ENTRIES, max_age_days=CLASSIFICATION_CACHE_MAX_AGE_DAYS):
+    """Drop entries not used within max_age_days, then the least recently used beyond max_entries."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"DELETE FROM {CLASSIFICATION_CACHE_TABLE_NAME} WHERE COALESCE(last_hit_at, created_at) < NOW() - make_interval(days => %s)",
+            (max_age_days,)
+        )
+        expired_count = cur.rowcount
+        cur.execute(
+            f"""
+            DELETE FROM {CLASSIFICATION_CACHE_TABLE_NAME} WHERE cache_key IN (
+                SELECT cache_key FROM {CLASSIFICATION_CACHE_TABLE_NAME}
+                ORDER BY COALESCE(last_hit_at, created_at) DESC
+                OFFSET %s
+            )
+            """,
+            (max_entries,)
+        )
+        overflow_count = cur.rowcount
+    conn.commit()
+    if expired_count or overflow_count:
+        logger.info(f"Evicted {expired_count} expired and {overflow_count} least recently used classification cache entries")
+
+def prescreen_text(row):
+    """The prompt inputs of a row as one string, with AI/AN rewritten so it can't pass for AI."""
+    abstract, action, agency_names, title, toc_doc, type_, excerpts = (row[1], row[2], row[3], row[5], row[6], row[7], row[8])
+    text = ' '.join(str(value or '') for value in (title, abstract, action, agency_names, toc_doc, type_, excerpts))
+    return AIAN_PATTERN.sub(' american indian alaska native ', text)
+
+def has_ai_keyword(text):
+    return bool(AI_KEYWORD_PATTERN.search(text) or AI_ACRONYM_PATTERN.search(text))
+
+class PrescreenModel:
+    """Hashed TF-IDF features with a logistic regression, trained on stored ai_related labels.
+
+    Documents are tokenized into unigrams and bigrams hashed into n_features
+    buckets and kept as flat (row, column, value) arrays, so both training and
+    scoring run as NumPy operations over whole batches.
+    """
+
+    def __init__(self, n_features=PRESCREEN_FEATURES):
+        self.n_features = n_features
+        self.idf = None
+        self.weights = None
+        self.bias = 0.0
 
-    with psycopg2.connect(DATABASE_URL) as conn:
-        rows = fetch_rows_with_empty_ai_related(conn, 999)
-        logger.info(f"Fetched {len(rows)} rows")
+    def _features(self, texts):
+        row_ids, columns, counts = hashed_term_counts(texts, self.n_features)
+        values = np.log1p(counts) * self.idf[columns]
+        norms = np.sqrt(np.bincount(row_ids, weights=values ** 2, minlength=len(texts)))
+        values /= np.maximum(norms, 1e-12)[row_ids]
+        return row_ids, columns, values
 
+    def fit(self, texts, labels, epochs=150, learning_rate=0.1, l2=1e-6):
+        labels = np.asarray(labels, dtype=np.float64)
+        row_ids, columns, counts = hashed_term_counts(texts, self.n_features)
+        document_frequency = np.bincount(columns, minlength=self.n_features)
+        self.idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+        row_ids, columns, values = self._features(texts)
+
+        # AI-related documents are rare, so weight the classes equally
+        positives = max(labels.sum(), 1)
+        sample_weights = np.where(labels == 1, len(labels) / (2 * positives), len(labels) / (2 * max(len(labels) - positives, 1)))
+        sample_weights /= sample_weights.sum()
+
+        # Adam on the full batch
+        self.weights = np.zeros(self.n_features)
+        self.bias = 0.0
+        moments = [np.zeros(self.n_features), np.zeros(self.n_features), 0.0, 0.0]
+        for step in range(1, epochs + 1):
+            scores = self._decision(row_ids, columns, values, len(texts))
+            errors = (1 / (1 + np.exp(-scores)) - labels) * sample_weights
+            weight_gradient = np.bincount(columns, weights=values * errors[row_ids], minlength=self.n_features) + l2 * self.weights
+            bias_gradient = errors.sum()
+            moments[0] = 0.9 * moments[0] + 0.1 * weight_gradient
+            moments[1] = 0.999 * moments[1] + 0.001 * weight_gradient ** 2
+            moments[2] = 0.9 * moments[2] + 0.1 * bias_gradient
+            moments[3] = 0.999 * moments[3] + 0.001 * bias_gradient ** 2
+            correction = np.sqrt(1 - 0.999 ** step) / (1 - 0.9 ** step)
+            self.weights -= learning_rate * correction * moments[0] / (np.sqrt(moments[1]) + 1e-8)
+            self.bias -= learning_rate * correction * moments[2] / (np.sqrt(moments[3]) + 1e-8)
+        return self
+
+    def _decision(self, row_ids, columns, values, n_rows):
+        return np.bincount(row_ids, weights=self.weights[columns] * values, minlength=n_rows) + self.bias
+
+    def predict_proba(self, texts, batch_size=PRESCREEN_SCORE_BATCH_SIZE):
+        probabilities = np.empty(len(texts))
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            scores = self._decision(*self._features(batch), len(batch))
+            probabilities[start:start + len(batch)] = 1 / (1 + np.exp(-scores))
+        return probabilities
+
+# Rows whose label can train the pre-screen; its own negatives would only teach it what it already predicts
+LABELED_ROWS_CONDITION = "ai_related IN (0, 1) AND classification_source IS DISTINCT FROM 'prescreen'"
+
+def fetch_labeled_rows(conn, limit):
+    """Fetch rows the LLM has classified, most recent first, to train the pre-screen on."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT {ROW_COLUMNS}, ai_related
+            FROM {FR_DOCUMENTS_TABLE_NAME}
+            WHERE {LABELED_ROWS_CONDITION}
+            ORDER BY publication_date DESC NULLS LAST
+            LIMIT %s
+            """,
+            (limit,)
+        )
+        return cur.fetchall()
+
+def count_labeled_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {FR_DOCUMENTS_TABLE_NAME} WHERE {LABELED_ROWS_CONDITION}")
+        labeled_count = cur.fetchone()[0]
+    conn.commit()
+    return labeled_count
+
+def train_prescreen_model(labeled_rows):
+    """Train on labeled rows, or return None if there are too few labels to trust the model."""
+    labels = [int(row[-1]) for row in labeled_rows]
+    if len(labels) < PRESCREEN_MIN_TRAINING_ROWS or sum(labels) < PRESCREEN_MIN_POSITIVE_ROWS:
+        logger.info(f"Not enough labeled rows to train the pre-screen ({len(labels)} rows, {sum(labels)} AI-related)")
+        return None
+    start_time = time.time()
+    model = PrescreenModel().fit([prescreen_text(row) for row in labeled_rows], labels)
+    logger.info(f"Trained pre-screen on {len(labels)} labeled rows in {time.time() - start_time:.2f} seconds")
+    return model
+
+def get_prescreen_model(conn):
+    """Train the pre-screen once per process on the labels already in fr_documents."""
+    global prescreen_model
+    if prescreen_model is None:
+        prescreen_model = train_prescreen_model(fetch_labeled_rows(conn, PRESCREEN_MAX_TRAINING_ROWS)) or False
+    return prescreen_model or None
+
+def prescreen_rows(model, rows, threshold):
+    """Split rows into clear negatives and rows that still need the LLM.
+
+    A row is a clear negative only if it has no AI keyword and the model
+    scores it below threshold.
+    """
+    texts = [prescreen_text(row) for row in rows]
+    probabilities = model.predict_proba(texts)
+    negative_rows = []
+    uncertain_rows = []
+    for row, text, probability in zip(rows, texts, probabilities):
+        if probability < threshold and not has_ai_keyword(text):
+            negative_rows.append(row)
+        else:
+            uncertain_rows.append(row)
+    return negative_rows, uncertain_rows
+
+def prescreen_report(conn, thresholds=(0.01, 0.02, 0.05, 0.1, 0.2)):
+    """Train on 80% of the stored labels and report how each threshold would have done on the rest."""
+    labeled_rows = fetch_labeled_rows(conn, PRESCREEN_MAX_TRAINING_ROWS)
+    holdout = [zlib.crc32(row[0].encode('utf-8')) % 5 == 0 for row in labeled_rows]
+    model = train_prescreen_model([row for row, held_out in zip(labeled_rows, holdout) if not held_out])
+    if model is None:
+        return
+    test_rows = [row for row, held_out in zip(labeled_rows, holdout) if held_out]
+    texts = [prescreen_text(row) for row in test_rows]
+    labels = np.array([int(row[-1]) for row in test_rows])
+    probabilities = model.predict_proba(texts)
+    keywords = np.array([has_ai_keyword(text) for text in texts])
+
+    predicted = probabilities >= 0.5
+    true_positives = (predicted & (labels == 1)).sum()
+    logger.info(f"Pre-screen report on {len(labels)} held-out rows ({labels.sum()} AI-related)")
+    logger.info(f"Model at 0.5: precision {true_positives / max(predicted.sum(), 1):.3f}, recall {true_positives / max(labels.sum(), 1):.3f}")
+    for threshold in thresholds:
+        screened_out = (probabilities < threshold) & ~keywords
+        missed = (screened_out & (labels == 1)).sum()
+        logger.info(
+            f"Threshold {threshold}: screens out {screened_out.mean():.1%} of rows, "
+            f"negative precision {1 - missed / max(screened_out.sum(), 1):.4f}, "
+            f"AI-related recall {1 - missed / max(labels.sum(), 1):.4f} ({missed} missed)"
+        )
+
+# Fixed seed: stored signatures are only comparable with ones made from the same permutations
+_minhash_random = np.random.default_rng(20240601)
+MINHASH_A = _minhash_random.integers(1, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.int64)
+MINHASH_B = _minhash_random.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.int64)
+BAND_MULTIPLIERS = _minhash_random.integers(1, 1 << 29, MINHASH_PERMUTATIONS // MINHASH_BANDS, dtype=np.int64)
+SIMILARITY_BUCKETS = [0.5, 0.7, 0.8, 0.9]
+
+def near_duplicate_shingles(row):
+    """Hashed word 3-grams of a row's prompt fields, with every number replaced so changed dates and docket numbers still match."""
+    tokens = TOKEN_PATTERN.findall(DIGIT_PATTERN.sub('0', prescreen_text(row).lower()))
+    shingles = {' '.join(tokens[i:i + 3]) for i in range(max(len(tokens) - 2, 1))} if tokens else set()
+    return [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+
+def minhash_signatures(rows):
+    """MinHash signatures, one row of MINHASH_PERMUTATIONS values per row, and whether each row had any text."""
+    signatures = np.full((len(rows), MINHASH_PERMUTATIONS), MINHASH_PRIME, dtype=np.int64)
+    has_text = np.zeros(len(rows), dtype=bool)
+    for i, row in enumerate(rows):
+        shingles = near_duplicate_shingles(row)
+        if shingles:
+            hashes = np.asarray(shingles, dtype=np.int64) % MINHASH_PRIME
+            signatures[i] = ((np.outer(hashes, MINHASH_A) + MINHASH_B) % MINHASH_PRIME).min(axis=0)
+            has_text[i] = True
+    return signatures, has_text
+
+def band_keys(signatures):
+    """One bigint per LSH band; rows that share any key are near-duplicate candidates."""
+    bands = signatures.reshape(len(signatures), MINHASH_BANDS, -1)
+    keys = (bands * BAND_MULTIPLIERS).sum(axis=2) % (1 << 58)
+    return keys * MINHASH_BANDS + np.arange(MINHASH_BANDS)
+
+def store_minhashes(conn, document_numbers, signatures, keys):
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            f"""
+            INSERT INTO {NEAR_DUPLICATE_TABLE_NAME} (document_number, signature, band_keys)
+            VALUES %s
+            ON CONFLICT (document_number) DO UPDATE SET signature = EXCLUDED.signature, band_keys = EXCLUDED.band_keys
+            """,
+            [(document_number, signature.tolist(), row_keys.tolist())
+             for document_number, signature, row_keys in zip(document_numbers, signatures, keys)]
+        )
+    conn.commit()
+
+def fetch_near_duplicate_candidates(conn, keys):
+    """Classified rows sharing a band with any of keys; rows labeled by the pre-screen or by another near-duplicate don't count."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT m.document_number, m.signature, f.ai_related, f.tags
+            FROM {NEAR_DUPLICATE_TABLE_NAME} m
+            JOIN {FR_DOCUMENTS_TABLE_NAME} f ON f.document_number = m.document_number
+            WHERE m.band_keys && %s::bigint[]
+              AND f.ai_related IN (0, 1)
+              AND (f.classification_source IS NULL OR f.classification_source IN ('llm', 'cache'))
+            LIMIT %s
+            """,
+            (sorted(set(keys.ravel().tolist())), NEAR_DUPLICATE_MAX_CANDIDATES)
+        )
+        return cur.fetchall()
+
+def signature_similarity(signatures, other_signatures, chunk_size=200):
+    """Estimated Jaccard similarity of every pair: the fraction of MinHash values they share."""
+    similarity = np.empty((len(signatures), len(other_signatures)), dtype=np.float32)
+    for start in range(0, len(signatures), chunk_size):
+        chunk = signatures[start:start + chunk_size]
+        similarity[start:start + chunk_size] = (chunk[:, None, :] == other_signatures[None, :, :]).mean(axis=2)
+    return similarity
+
+def apply_near_duplicates(conn, rows, current_date, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """Split rows into copies of a near-duplicate's classification (as processed rows) and rows that still need classifying.
+
+    Every row's signature is stored, so it can serve as a near-duplicate
+    itself once it has been classified.
+    """
+    if not rows:
+        return [], rows
+    signatures, has_text = minhash_signatures(rows)
+    keys = band_keys(signatures)
+    store_minhashes(conn, [row[0] for row, text in zip(rows, has_text) if text], signatures[has_text], keys[has_text])
+
+    candidates = fetch_near_duplicate_candidates(conn, keys[has_text]) if has_text.any() else []
+    if not candidates:
+        near_duplicate_stats['no_candidates'] += len(rows)
+        return [], rows
+
+    similarity = signature_similarity(signatures, np.array([candidate[1] for candidate in candidates], dtype=np.int64))
+    similarity[~has_text] = 0
+    best = similarity.argmax(axis=1)
+    best_similarity = similarity[np.arange(len(rows)), best]
+    near_duplicate_stats['best_similarity'] += np.bincount(np.searchsorted(SIMILARITY_BUCKETS, best_similarity, side='right'),
+                                                           minlength=len(SIMILARITY_BUCKETS) + 1)
+
+    reused_rows = []
+    remaining_rows = []
+    for row, candidate_index, row_similarity in zip(rows, best, best_similarity):
+        if row_similarity >= threshold:
+            # Only the labels are reused: for a recurring notice, the source's summary would describe its own
+            # dates and docket, so the row is left without one
+            source_document_number, _, ai_related, tags = candidates[candidate_index]
+            reused_rows.append(build_processed_row(row, int(ai_related), None, tags or [], current_date,
+                                                   classification_source=f'near_duplicate:{source_document_number}'))
+        else:
+            remaining_rows.append(row)
+    near_duplicate_stats['reused'] += len(reused_rows)
+    near_duplicate_stats['below_threshold'] += len(remaining_rows)
+    return reused_rows, remaining_rows
+
+def format_similarity_histogram(counts):
+    edges = ['0'] + [str(edge) for edge in SIMILARITY_BUCKETS] + ['1']
+    return ', '.join(f"{edges[i]}-{edges[i + 1]}: {count}" for i, count in enumerate(counts))
+
+def index_classified_minhashes(conn, batch_size=5000):
+    """Store signatures for classified rows that don't have one yet, such as rows classified before this stage existed."""
+    indexed_count = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT {row_columns('f')} FROM {FR_DOCUMENTS_TABLE_NAME} f
+                WHERE f.ai_related IN (0, 1)
+                  AND NOT EXISTS (SELECT 1 FROM {NEAR_DUPLICATE_TABLE_NAME} m WHERE m.document_number = f.document_number)
+                LIMIT %s
+                """,
+                (batch_size,)
+            )
+            rows = cur.fetchall()
+        if not rows:
+            return indexed_count
+        signatures, _ = minhash_signatures(rows)
+        # Rows without text get a signature anyway, so they aren't selected again
+        store_minhashes(conn, [row[0] for row in rows], signatures, band_keys(signatures))
+        indexed_count += len(rows)
+
+def near_duplicate_report(conn, sample_size=NEAR_DUPLICATE_REPORT_ROWS):
+    """Report how often near-duplicates of classified rows agree with them, by similarity, and the largest clusters."""
+    indexed_count = index_classified_minhashes(conn)
+    logger.info(f"Stored MinHash signatures for {indexed_count} classified rows")
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH sample AS (
+                SELECT m.document_number, m.signature, m.band_keys, f.ai_related, f.tags
+                FROM {NEAR_DUPLICATE_TABLE_NAME} m JOIN {FR_DOCUMENTS_TABLE_NAME} f ON f.document_number = m.document_number
+                WHERE f.ai_related IN (0, 1) AND (f.classification_source IS NULL OR f.classification_source IN ('llm', 'cache'))
+                ORDER BY random()
+                LIMIT %s
+            )
+            SELECT s.signature, m.signature, s.ai_related = f.ai_related, COALESCE(s.tags, '{{}}') = COALESCE(f.tags, '{{}}')
+            FROM sample s
+            JOIN {NEAR_DUPLICATE_TABLE_NAME} m ON m.band_keys && s.band_keys AND m.document_number <> s.document_number
+            JOIN {FR_DOCUMENTS_TABLE_NAME} f ON f.document_number = m.document_number
+            WHERE f.ai_related IN (0, 1) AND (f.classification_source IS NULL OR f.classification_source IN ('llm', 'cache'))
+            LIMIT %s
+            """,
+            (sample_size, sample_size * 100)
+        )
+        pairs = cur.fetchall()
+        cur.execute(
+            f"""
+            SELECT COUNT(*) FROM (
+                SELECT key FROM {NEAR_DUPLICATE_TABLE_NAME}, UNNEST(band_keys) AS key GROUP BY key HAVING COUNT(*) > 1
+            ) AS shared
+            """
+        )
+        shared_buckets = cur.fetchone()[0]
+        cur.execute(
+            f"""
+            SELECT COUNT(*) AS size FROM {NEAR_DUPLICATE_TABLE_NAME}, UNNEST(band_keys) AS key
+            GROUP BY key ORDER BY size DESC LIMIT 10
+            """
+        )
+        largest_buckets = [row[0] for row in cur.fetchall()]
+
+    logger.info(f"Near-duplicate report: {len(pairs)} candidate pairs from a sample of {sample_size} classified rows")
+    if pairs:
+        similarity = (np.array([pair[0] for pair in pairs]) == np.array([pair[1] for pair in pairs])).mean(axis=1)
+        labels_agree = np.array([pair[2] for pair in pairs])
+        tags_agree = np.array([pair[3] for pair in pairs])
+        buckets = np.searchsorted(SIMILARITY_BUCKETS, similarity, side='right')
+        edges = ['0'] + [str(edge) for edge in SIMILARITY_BUCKETS] + ['1']
+        for bucket in range(len(SIMILARITY_BUCKETS) + 1):
+            in_bucket = buckets == bucket
+            if in_bucket.any():
+                logger.info(
+                    f"Similarity {edges[bucket]}-{edges[bucket + 1]}: {in_bucket.sum()} pairs, "
+                    f"ai_related agrees {labels_agree[in_bucket].mean():.1%}, tags agree {tags_agree[in_bucket].mean():.1%}"
+                )
+    logger.info(f"{shared_buckets} LSH buckets are shared by more than one row; largest bucket sizes: {largest_buckets}")
+
+class TokenBucket:
+    """Async token bucket that refills continuously up to per_minute tokens.
+
+    The balance may go negative when settle() records more usage than was
+    estimated, which delays later acquirers until the debt is paid off.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60.0
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                wait_seconds = (amount - self.tokens) / self.rate
+                metrics.record_throttle('claude', wait_seconds)
+                await asyncio.sleep(wait_seconds)
+                self._refill()
+            self.tokens -= amount
+
+    def settle(self, estimated, actual):
+        self._refill()
+        self.tokens -= actual - estimated
+
+class ClaudeRateLimiter:
+    """Keeps requests under both the requests-per-minute and tokens-per-minute limits."""
+
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.requests = TokenBucket(max_requests_per_minute)
+        self.tokens = TokenBucket(max_tokens_per_minute)
+
+    async def acquire(self, estimated_tokens):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens, usage):
+        self.tokens.settle(estimated_tokens, usage.input_tokens + usage.output_tokens)
+
+def estimate_tokens(prompt, max_tokens=CLAUDE_MAX_TOKENS):
+    """Rough token count for rate limiting: ~4 characters per token plus the full output budget."""
+    return (len(SYSTEM_PROMPT) + len(PROMPT) + len(prompt)) // 4 + max_tokens
+
+def retry_after_seconds(error, default):
+    """Seconds to wait after a rate-limited response, preferring the server's Retry-After header."""
+    try:
+        return float(error.response.headers.get('retry-after', default))
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+async def send_to_claude_api_async(client, rate_limiter, prompt, max_attempts=3, max_tokens=CLAUDE_MAX_TOKENS, document_numbers=(),
+                                   packed=False):
+    """Send one prompt through the shared async client, waiting on the rate limiter first."""
+    from anthropic import RateLimitError
+
+    estimated_tokens = estimate_tokens(prompt, max_tokens)
+    for attempt in range(max_attempts):
+        await rate_limiter.acquire(estimated_tokens)
+        start_time = time.monotonic()
+        try:
+            message = await client.messages.create(**build_message_params(prompt, max_tokens, packed))
+            metrics.record_request('claude', 200, time.monotonic() - start_time)
+            record_usage(document_numbers, 'packed' if len(document_numbers) > 1 else 'single', message.usage,
+                         time.monotonic() - start_time)
+            rate_limiter.settle(estimated_tokens, message.usage)
+            return message.content
+        except RateLimitError as e:
+            metrics.record_request('claude', 429, time.monotonic() - start_time)
+            if attempt == max_attempts - 1:
+                raise
+            sleep_time = retry_after_seconds(e, 60)
+            logger.info(f"Rate limit exceeded. Waiting for {sleep_time:.2f} seconds before retrying.")
+            metrics.record_backoff('claude', sleep_time, 'rate_limited')
+            await asyncio.sleep(sleep_time)
+        except Exception as e:
+            metrics.record_request('claude', getattr(e, 'status_code', 'error'), time.monotonic() - start_time)
+            if attempt == max_attempts - 1:
+                raise
+            metrics.record_backoff('claude', 2 ** attempt, 'error')
+            await asyncio.sleep(2 ** attempt)
+
+async def classify_row_async(client, rate_limiter, semaphore, row, current_date):
+    document_number = row[0]
+    async with semaphore:
+        try:
+            response = await send_to_claude_api_async(client, rate_limiter, build_prompt(row), document_numbers=[document_number])
+        except Exception as e:
+            logger.error(f"Error calling Claude API for document {document_number}: {str(e)}")
+            return None
+    if not response:
+        return None
+    try:
+        return parse_llm_response(row, response, current_date)
+    except ValueError as e:
+        logger.error(f"Error processing JSON for document {document_number}: {str(e)}")
+        logger.error("Skipping this row.")
+        record_failure(document_number, e, response)
+        return None
+
+async def classify_pack_async(client, rate_limiter, semaphore, pack, current_date):
+    """Classify a pack in one request, falling back to single requests for documents missing from the answer."""
+    if len(pack) == 1:
+        processed_row = await classify_row_async(client, rate_limiter, semaphore, pack[0], current_date)
+        return [processed_row] if processed_row else []
+
+    max_tokens = min(CLAUDE_MAX_OUTPUT_TOKENS, len(pack) * PACK_OUTPUT_TOKENS_PER_DOCUMENT + CLAUDE_MAX_TOKENS)
+    processed_rows = {}
+    async with semaphore:
+        try:
+            response = await send_to_claude_api_async(client, rate_limiter, build_packed_prompt(pack), max_tokens=max_tokens,
+                                                      document_numbers=[row[0] for row in pack], packed=True)
+            if response:
+                processed_rows = parse_packed_response(pack, response, current_date)
+        except Exception as e:
+            logger.error(f"Error calling Claude API for a pack of {len(pack)} documents: {str(e)}")
+
+    missing_rows = [row for row in pack if row[0] not in processed_rows]
+    if missing_rows:
+        logger.info(f"Retrying {len(missing_rows)} of {len(pack)} packed documents individually")
+        fallback_rows = await asyncio.gather(*(classify_row_async(client, rate_limiter, semaphore, row, current_date) for row in missing_rows))
+        processed_rows.update((row['document_number'], row) for row in fallback_rows if row)
+    return list(processed_rows.values())
+
+def add_counts(totals, counts):
+    for key, value in counts.items():
+        totals[key] += value
+
+def write_processed_rows(conn, processed_rows, cache=True, worker_id=None):
+    """Write classified rows back to fr_documents and copy AI-related ones into ai_documents.
+
+    Rows that came from the LLM are also added to the classification cache.
+    With worker_id, rows whose lease it no longer holds are dropped. Returns
+    the counts to add to the caller's totals with add_counts.
+    """
+    written = update_rows_in_postgres(conn, processed_rows, worker_id)
+    if len(written) < len(processed_rows):
+        logger.warning(f"Dropped {len(processed_rows) - len(written)} classified rows whose lease {worker_id} no longer holds")
+        processed_rows = [row for row in processed_rows if row['document_number'] in written]
+    for row in processed_rows:
+        # near_duplicate:<document_number> is counted as near_duplicate
+        metrics.inc('rows_processed_total', outcome=row['classification_source'].split(':')[0])
+    if cache:
+        store_cached_classifications(conn, processed_rows)
+    flush_pending_records(conn)
+    ai_related_count, inserted_count = insert_rows_to_ai_documents(conn, processed_rows)
+    return {'processed': len(processed_rows), 'ai_related': ai_related_count, 'inserted': inserted_count}
+
+def classify_locally(conn, rows, current_date, prescreen_threshold=PRESCREEN_THRESHOLD, worker_id=None):
+    """Write back every row that can be classified without the LLM; returns the rest and the counts written.
+
+    Rows are first looked up in the classification cache, then matched
+    against near-duplicates of classified rows, then scored by the local
+    pre-screen; pass prescreen_threshold=None to skip the pre-screen. It
+    runs in a worker thread, so the counts are returned rather than added
+    to the caller's totals.
+    """
+    locally_classified_rows, remaining_rows = apply_classification_cache(conn, rows, current_date)
+    logger.info(f"Classification cache: {len(locally_classified_rows)} hits, {len(remaining_rows)} misses")
+
+    reused_rows, remaining_rows = apply_near_duplicates(conn, remaining_rows, current_date)
+    locally_classified_rows += reused_rows
+    if reused_rows:
+        logger.info(f"Near-duplicates: reused {len(reused_rows)} classifications")
+
+    model = get_prescreen_model(conn) if prescreen_threshold is not None and remaining_rows else None
+    if model is not None:
+        negative_rows, remaining_rows = prescreen_rows(model, remaining_rows, prescreen_threshold)
+        locally_classified_rows += [
+            build_processed_row(row, 0, None, [], current_date, classification_source='prescreen') for row in negative_rows
+        ]
+        prescreen_stats['negatives'] += len(negative_rows)
+        prescreen_stats['uncertain'] += len(remaining_rows)
+        logger.info(f"Pre-screen: {len(negative_rows)} clear negatives, {len(remaining_rows)} rows sent to the LLM")
+
+    if locally_classified_rows:
+        return remaining_rows, write_processed_rows(conn, locally_classified_rows, cache=False, worker_id=worker_id)
+    return remaining_rows, {}
+
+async def write_results(conn, results_queue, totals, on_written=None, worker_id=None):
+    """Write results as they complete, grouping whatever has finished since the last write.
+
+    on_written, if given, is called with each group of rows once it is committed.
+    Pass the worker_id that leased the rows so only rows it still holds are written.
+    """
+    finished = False
+    while not finished:
         processed_rows = []
-        total_ai_related_count = 0
-        total_inserted_count = 0
+        item = await results_queue.get()
+        while True:
+            if item is None:
+                finished = True
+                break
+            processed_rows.append(item)
+            if results_queue.empty():
+                break
+            item = results_queue.get_nowait()
+        if processed_rows:
+            add_counts(totals, await asyncio.to_thread(write_processed_rows, conn, processed_rows, worker_id=worker_id))
+            if on_written is not None:
+                on_written(processed_rows)
 
-        for i in range(0, len(rows), 50):
-            batch_rows = rows[i:i+50]
-            batch_processed_rows = process_batch(batch_rows)
-            logger.info(f"Processed {len(batch_processed_rows)} rows")
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
 
-            update_rows_in_postgres(conn, batch_processed_rows)
-            logger.info("Updated rows in PostgreSQL")
+async def classify_rows_async(conn, limit, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                              max_requests_per_minute=MAX_REQUESTS_PER_MINUTE, max_tokens_per_minute=MAX_TOKENS_PER_MINUTE,
+                              prescreen_threshold=PRESCREEN_THRESHOLD, pack_size=PACK_SIZE, worker_id=None,
+                              claim_size=CLAIM_BATCH_SIZE):
+    """Claim and classify up to limit rows with up to max_concurrency requests in flight.
 
-            ai_related_count, inserted_count = insert_rows_to_ai_documents(conn, batch_processed_rows)
-            total_ai_related_count += ai_related_count
-            total_inserted_count += inserted_count
-            logger.info(f"Found {ai_related_count} AI-related rows in this batch")
-            logger.info(f"Inserted {inserted_count} new rows into ai_documents in this batch")
+    Rows are leased claim_size at a time, walking forward through document
+    numbers, and the next lease is taken as soon as fewer than claim_size rows
+    are in flight, so several workers can drain the queue side by side.
+    """
+    from tqdm import tqdm
 
-            processed_rows.extend(batch_processed_rows)
+    worker_id = worker_id or default_worker_id()
+    client = create_async_claude_client(max_concurrency)
+    rate_limiter = ClaudeRateLimiter(max_requests_per_minute, max_tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results_queue = asyncio.Queue()
+    totals = {'processed': 0, 'claimed': 0, 'ai_related': 0, 'inserted': 0}
+    current_date = datetime.datetime.now(datetime.timezone.utc)  # created_at and last_modified in ai_documents
+
+    # The writer commits from its own thread while the claim loop runs, so it gets its own connection;
+    # on a shared one, each side's commits and rollbacks would end the other's transaction
+    writer_conn = await asyncio.to_thread(pipeline_metrics.connect, get_config().database_url)
+    writer = asyncio.create_task(write_results(writer_conn, results_queue, totals, worker_id=worker_id))
+    pending = {}
+    in_flight_rows = 0
+    renewed_at = time.monotonic()
+    after = ''
+    exhausted = limit <= 0
+    try:
+        with tqdm(desc="Processing rows") as progress:
+            while True:
+                if writer.done():
+                    # Raises the writer's error: without it, everything classified from here on would be lost
+                    writer.result()
+                if not exhausted and in_flight_rows < claim_size:
+                    rows = await asyncio.to_thread(claim_pending_rows, conn, worker_id, min(claim_size, limit - totals['claimed']), after)
+                    exhausted = not rows or totals['claimed'] + len(rows) >= limit
+                    if rows:
+                        totals['claimed'] += len(rows)
+                        after = rows[-1][0]
+                        progress.total = totals['claimed']
+                        claimed_count = len(rows)
+                        rows, counts = await asyncio.to_thread(classify_locally, conn, rows, current_date, prescreen_threshold,
+                                                               worker_id)
+                        add_counts(totals, counts)
+                        progress.update(claimed_count - len(rows))
+                        for pack in pack_rows(rows, pack_size):
+                            task = asyncio.create_task(classify_pack_async(client, rate_limiter, semaphore, pack, current_date))
+                            pending[task] = pack
+                            in_flight_rows += len(pack)
+                    continue
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(set(pending) | {writer}, timeout=CLAIM_RENEW_SECONDS,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is writer:
+                        continue
+                    pack = pending.pop(task)
+                    in_flight_rows -= len(pack)
+                    for processed_row in task.result():
+                        results_queue.put_nowait(processed_row)
+                    progress.update(len(pack))
+                if pending and time.monotonic() - renewed_at >= CLAIM_RENEW_SECONDS:
+                    await asyncio.to_thread(renew_claims, conn, worker_id, [row[0] for pack in pending.values() for row in pack])
+                    renewed_at = time.monotonic()
+    finally:
+        for task in pending:
+            task.cancel()
+        results_queue.put_nowait(None)
+        try:
+            await writer
+        finally:
+            writer_conn.close()
+            await client.close()
+            # After a failed statement the connection has to be rolled back before it can release anything
+            conn.rollback()
+            flush_pending_records(conn)
+            release_claims(conn, worker_id)
+    return totals
+
+def record_submitted_batch(conn, batch_id, document_numbers):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"INSERT INTO {LLM_BATCHES_TABLE_NAME} (batch_id, document_numbers, status, submitted_at) VALUES (%s, %s, 'submitted', NOW())",
+            (batch_id, list(document_numbers))
+        )
+    conn.commit()
+
+def fetch_uncollected_batch_ids(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT batch_id FROM {LLM_BATCHES_TABLE_NAME} WHERE collected_at IS NULL ORDER BY submitted_at")
+        return [row[0] for row in cur.fetchall()]
+
+def mark_batch(conn, batch_id, status):
+    timestamp_column = 'collected_at' if status == 'collected' else 'ended_at'
+    with conn.cursor() as cur:
+        cur.execute(
+            f"UPDATE {LLM_BATCHES_TABLE_NAME} SET status = %s, {timestamp_column} = NOW() WHERE batch_id = %s",
+            (status, batch_id)
+        )
+    conn.commit()
+
+def submit_message_batches(conn, limit, prescreen_threshold=PRESCREEN_THRESHOLD):
+    """Submit pending rows as Message Batches jobs and record their IDs.
+
+    Rows in a batch that hasn't been collected are skipped by
+    claim_pending_rows, so running this again never re-submits them.
+    """
+    client = get_claude_client()
+    worker_id = default_worker_id()
+    rows = claim_pending_rows(conn, worker_id, limit)
+    logger.info(f"Fetched {len(rows)} rows to submit as message batches")
+    current_date = datetime.datetime.now(datetime.timezone.utc)  # created_at and last_modified in ai_documents
+    try:
+        rows, _ = classify_locally(conn, rows, current_date, prescreen_threshold, worker_id)
+
+        for i in range(0, len(rows), MESSAGE_BATCH_SIZE):
+            batch_rows = rows[i:i + MESSAGE_BATCH_SIZE]
+            requests = [{"custom_id": row[0], "params": build_message_params(build_prompt(row))} for row in batch_rows]
+            message_batch = client.messages.batches.create(requests=requests)
+            record_submitted_batch(conn, message_batch.id, [row[0] for row in batch_rows])
+            logger.info(f"Submitted message batch {message_batch.id} with {len(batch_rows)} requests")
+    finally:
+        # After a failed statement the connection has to be rolled back before it can release anything
+        conn.rollback()
+        release_claims(conn, worker_id)
+
+def collect_batch_results(conn, client, batch_id, current_date, totals):
+    """Stream a finished batch's results into Postgres in chunks."""
+    def flush(responses):
+        rows_by_number = {row[0]: row for row in fetch_rows_by_document_number(conn, responses)}
+        processed_rows = []
+        for document_number, content in responses.items():
+            row = rows_by_number.get(document_number)
+            if row is None:
+                continue
+            try:
+                processed_rows.append(parse_llm_response(row, content, current_date))
+            except ValueError as e:
+                logger.error(f"Error processing JSON for document {document_number}: {str(e)}")
+                record_failure(document_number, e, content)
+        flush_pending_records(conn)
+        if processed_rows:
+            add_counts(totals, write_processed_rows(conn, processed_rows))
+
+    responses = {}
+    for result in client.messages.batches.results(batch_id):
+        if result.result.type != 'succeeded':
+            logger.warning(f"Batch request for document {result.custom_id} finished as {result.result.type}")
+            continue
+        record_usage([result.custom_id], 'batch', result.result.message.usage)
+        responses[result.custom_id] = result.result.message.content
+        if len(responses) >= RESULTS_CHUNK_SIZE:
+            flush(responses)
+            responses = {}
+    if responses:
+        flush(responses)
+
+def collect_message_batches(conn):
+    """Collect every submitted batch that has finished processing.
+
+    A batch is only marked collected once all its results are written, so a
+    restarted collector picks up where it stopped; rewriting results is harmless.
+    Requests that errored or expired leave their rows unclassified for a later run.
+    """
+    client = get_claude_client()
+    totals = {'processed': 0, 'ai_related': 0, 'inserted': 0}
+    current_date = datetime.datetime.now(datetime.timezone.utc)  # created_at and last_modified in ai_documents
+
+    for batch_id in fetch_uncollected_batch_ids(conn):
+        message_batch = client.messages.batches.retrieve(batch_id)
+        if message_batch.processing_status != 'ended':
+            logger.info(f"Message batch {batch_id} is still {message_batch.processing_status}")
+            continue
+        mark_batch(conn, batch_id, 'ended')
+        collect_batch_results(conn, client, batch_id, current_date, totals)
+        mark_batch(conn, batch_id, 'collected')
+        logger.info(f"Collected message batch {batch_id}")
+
+    return totals
+
+def run_mode(conn, limit, max_concurrency, max_requests_per_minute, max_tokens_per_minute, mode, prescreen_threshold, pack_size,
+             claim_size):
+    """Run one mode of the script on an open connection."""
+    if mode == 'prescreen-report':
+        prescreen_report(conn)
+        return
+
+    if mode == 'near-duplicate-report':
+        near_duplicate_report(conn)
+        return
+
+    if mode in ('online', 'batch-submit'):
+        indexed_count = index_classified_minhashes(conn)
+        if indexed_count:
+            logger.info(f"Stored MinHash signatures for {indexed_count} classified rows")
+
+    if mode == 'batch-submit':
+        submit_message_batches(conn, limit, prescreen_threshold)
+        return
+
+    if mode == 'batch-collect':
+        totals = collect_message_batches(conn)
+    else:
+        totals = asyncio.run(classify_rows_async(conn, limit, max_concurrency, max_requests_per_minute, max_tokens_per_minute,
+                                                 prescreen_threshold, pack_size, claim_size=claim_size))
+        logger.info(f"Claimed a total of {totals['claimed']} rows")
+
+    logger.info(f"Processed a total of {totals['processed']} rows")
+    logger.info(f"Found a total of {totals['ai_related']} AI-related rows")
+    logger.info(f"Inserted a total of {totals['inserted']} new rows into ai_documents")
+    logger.info(f"Classification cache hits: {cache_stats['hits']}, misses: {cache_stats['misses']}")
+    logger.info(f"Pre-screen negatives: {prescreen_stats['negatives']}, sent to the LLM: {prescreen_stats['uncertain']}")
+    logger.info(
+        f"Near-duplicates: {near_duplicate_stats['reused']} reused, {near_duplicate_stats['below_threshold']} below the "
+        f"{NEAR_DUPLICATE_THRESHOLD} threshold, {near_duplicate_stats['no_candidates']} without candidates; best similarity "
+        f"{format_similarity_histogram(near_duplicate_stats['best_similarity'])}"
+    )
+    logger.info(
+        f"LLM usage: {usage_totals['requests']} requests, {usage_totals['input_tokens']} input tokens "
+        f"({usage_totals['cache_read_input_tokens']} read from and {usage_totals['cache_creation_input_tokens']} written to the prompt cache), "
+        f"{usage_totals['output_tokens']} output tokens"
+    )
+    evict_classification_cache(conn)
+
+def main(limit=999, max_concurrency=MAX_CONCURRENT_REQUESTS, max_requests_per_minute=MAX_REQUESTS_PER_MINUTE,
+         max_tokens_per_minute=MAX_TOKENS_PER_MINUTE, mode='online', prescreen_threshold=PRESCREEN_THRESHOLD, pack_size=PACK_SIZE,
+         claim_size=CLAIM_BATCH_SIZE):
+    logger.info("Script started")
+    database_url = get_config().database_url
+    metrics.start_run('summarize' if mode == 'online' else f"summarize_{mode.replace('-', '_')}")
+    status = 'failed'
+    try:
+        with pipeline_metrics.connect(database_url) as conn:
+            run_mode(conn, limit, max_concurrency, max_requests_per_minute, max_tokens_per_minute, mode, prescreen_threshold,
+                     pack_size, claim_size)
+        status = 'succeeded'
+    finally:
+        metrics.finish_run(database_url, status)
 
-        logger.info(f"Processed a total of {len(processed_rows)} rows")
-        logger.info(f"Found a total of {total_ai_related_count} AI-related rows")
-        logger.info(f"Inserted a total of {total_inserted_count} new rows into ai_documents")
+def cli(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Classify unprocessed Federal Register documents with Claude.")
+    parser.add_argument('--mode', choices=['online', 'batch-submit', 'batch-collect', 'prescreen-report', 'near-duplicate-report'],
+                        default='online',
+                        help="online classifies immediately; batch-submit and batch-collect use the Message Batches API; "
+                             "prescreen-report evaluates the local pre-screen against stored labels; "
+                             "near-duplicate-report shows how well near-duplicates agree, to tune NEAR_DUPLICATE_THRESHOLD.")
+    parser.add_argument('--limit', type=int, default=999)
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument('--max-requests-per-minute', type=int, default=MAX_REQUESTS_PER_MINUTE)
+    parser.add_argument('--max-tokens-per-minute', type=int, default=MAX_TOKENS_PER_MINUTE)
+    parser.add_argument('--prescreen-threshold', type=float, default=PRESCREEN_THRESHOLD)
+    parser.add_argument('--no-prescreen', action='store_true', help="Send every uncached row to the LLM.")
+    parser.add_argument('--pack-size', type=int, default=PACK_SIZE, help="Most documents to classify per request; 1 disables packing.")
+    parser.add_argument('--claim-size', type=int, default=CLAIM_BATCH_SIZE,
+                        help="Rows each worker leases at a time; run several workers to classify in parallel.")
+    args = parser.parse_args(argv)
+    main(limit=args.limit, max_concurrency=args.concurrency, max_requests_per_minute=args.max_requests_per_minute,
+         max_tokens_per_minute=args.max_tokens_per_minute, mode=args.mode,
+         prescreen_threshold=None if args.no_prescreen else args.prescreen_threshold, pack_size=args.pack_size,
+         claim_size=args.claim_size)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    cli()
@@ -0,0 +1,367 @@
+import argparse
+import asyncio
+import codecs
+import logging
+import os
+import re
+import time
+import zlib
+from xml.etree import ElementTree
+
+import httpx
+import psycopg2
+
+from . import pipeline_metrics
+from .config import get_config
+from .pipeline_metrics import metrics
+from .summarize_fr_documents import (
+    AI_DOCUMENTS_TABLE_NAME, CLAUDE_MODEL, MAX_CONCURRENT_REQUESTS, MAX_REQUESTS_PER_MINUTE,
+    MAX_TOKENS_PER_MINUTE, ClaudeRateLimiter, create_async_claude_client, flush_usage_records, record_usage,
+    retry_after_seconds, usage_totals
+)
+
+logger = logging.getLogger(__name__)
+
+FULL_TEXTS_TABLE_NAME = os.environ.get('FULL_TEXTS_TABLE_NAME', 'fr_full_texts')
+# Each chunk of a document's text is summarized on its own; ~4 characters per token
+CHUNK_MAX_TOKENS = int(os.environ.get('FULL_TEXT_CHUNK_TOKENS', 6000))
+CHARS_PER_TOKEN = 4
+CHUNK_SUMMARY_MAX_TOKENS = 400
+FULL_SUMMARY_MAX_TOKENS = 800
+# Documents summarized at once; their chunk requests share MAX_CONCURRENT_REQUESTS
+DOCUMENT_CONCURRENCY = int(os.environ.get('FULL_TEXT_DOCUMENT_CONCURRENCY', 4))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+HTTP_TIMEOUT_SECONDS = 60
+# Elements of the Federal Register's full-text XML that hold a paragraph of running text
+XML_TEXT_TAGS = {'P', 'FP', 'HD', 'AMDPAR', 'SECTNO', 'SUBJECT', 'LI', 'NOTE'}
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+FULL_TEXT_SYSTEM_PROMPT = (
+    "You summarize Federal Register documents for readers tracking AI policy. "
+    "Be factual and concise, and focus on what the document does, who it affects, deadlines, and anything relevant to AI."
+)
+CHUNK_PROMPT = """Below is part {part} of the full text of the Federal Register document "{title}".
+Summarize this part in a few bullet points, keeping any obligations, dates, definitions and references to AI or automated systems.
+
+{text}"""
+REDUCE_PROMPT = """Below are summaries of consecutive parts of the Federal Register document "{title}".
+Combine them into a single summary of the whole document as bullet points, at most a few hundred words. Drop repetition.
+
+{text}"""
+
+def fetch_documents_to_summarize(conn, limit, force=False):
+    """AI-related documents with a full-text URL and, unless force, no full summary yet."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT DISTINCT ON (publication_date, document_number) document_number, title, full_text_xml_url, raw_text_url
+            FROM {AI_DOCUMENTS_TABLE_NAME}
+            WHERE (COALESCE(full_text_xml_url, '') <> '' OR COALESCE(raw_text_url, '') <> '')
+              {'' if force else "AND COALESCE(llm_summary_full, '') = ''"}
+            ORDER BY publication_date DESC, document_number
+            LIMIT %s
+            """,
+            (limit,)
+        )
+        return cur.fetchall()
+
+def fetch_stored_text(conn, document_number):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT compressed_text FROM {FULL_TEXTS_TABLE_NAME} WHERE document_number = %s", (document_number,))
+        row = cur.fetchone()
+    return bytes(row[0]) if row else None
+
+def store_text(conn, document_number, source_url, compressed_text, text_length):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            INSERT INTO {FULL_TEXTS_TABLE_NAME} (document_number, source_url, compressed_text, text_length, fetched_at)
+            VALUES (%s, %s, %s, %s, NOW())
+            ON CONFLICT (document_number) DO UPDATE
+            SET source_url = EXCLUDED.source_url,
+                compressed_text = EXCLUDED.compressed_text,
+                text_length = EXCLUDED.text_length,
+                fetched_at = EXCLUDED.fetched_at
+            """,
+            (document_number, source_url, psycopg2.Binary(compressed_text), text_length)
+        )
+    conn.commit()
+
+def update_full_summary(conn, document_number, summary):
+    with conn.cursor() as cur:
+        cur.execute(f"UPDATE {AI_DOCUMENTS_TABLE_NAME} SET llm_summary_full = %s WHERE document_number = %s",
+                    (summary, document_number))
+    conn.commit()
+
+class SharedConnection:
+    """A connection shared by concurrent coroutines, running one function on it at a time in a worker thread.
+
+    Without the lock, one call's commit or rollback could end another's transaction.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = asyncio.Lock()
+
+    async def run(self, function, *args):
+        async with self.lock:
+            return await asyncio.to_thread(function, self.conn, *args)
+
+def normalize_paragraph(text):
+    return ' '.join(text.split())
+
+class CompressedTextWriter:
+    """Compresses paragraphs as they stream past, one per line."""
+
+    def __init__(self):
+        self.compressor = zlib.compressobj()
+        self.compressed = bytearray()
+        self.length = 0
+
+    def write(self, paragraph):
+        data = (paragraph + '\n').encode('utf-8')
+        self.length += len(data)
+        self.compressed += self.compressor.compress(data)
+
+    def finish(self):
+        self.compressed += self.compressor.flush()
+        return bytes(self.compressed)
+
+async def download_paragraphs(http_client, url, xml):
+    """Stream a document's full text, yielding paragraphs as soon as they have downloaded.
+
+    XML is parsed incrementally and each element is cleared once its text
+    has been yielded, so memory stays bounded by the download chunk size
+    rather than the document size.
+    """
+    async with http_client.stream('GET', url) as response:
+        response.raise_for_status()
+        if xml:
+            parser = ElementTree.XMLPullParser(events=('end',))
+            async for data in response.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+                parser.feed(data)
+                for _, element in parser.read_events():
+                    if element.tag in XML_TEXT_TAGS:
+                        paragraph = normalize_paragraph(''.join(element.itertext()))
+                        if paragraph:
+                            yield paragraph
+                        element.clear()
+            parser.close()
+        else:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            buffer = ''
+            async for data in response.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+                buffer += decoder.decode(data)
+                # Plain text separates paragraphs with blank lines; keep the unfinished one for the next read
+                *paragraphs, buffer = re.split(r'\n\s*\n', buffer)
+                for paragraph in paragraphs:
+                    paragraph = normalize_paragraph(HTML_TAG_PATTERN.sub(' ', paragraph))
+                    if paragraph:
+                        yield paragraph
+            buffer += decoder.decode(b'', final=True)
+            paragraph = normalize_paragraph(HTML_TAG_PATTERN.sub(' ', buffer))
+            if paragraph:
+                yield paragraph
+
+async def stored_paragraphs(compressed_text):
+    """Yield the paragraphs of stored text, decompressing it a piece at a time."""
+    decompressor = zlib.decompressobj()
+    buffer = ''
+    for start in range(0, len(compressed_text), DOWNLOAD_CHUNK_BYTES):
+        buffer += decompressor.decompress(compressed_text[start:start + DOWNLOAD_CHUNK_BYTES]).decode('utf-8', errors='replace')
+        *paragraphs, buffer = buffer.split('\n')
+        for paragraph in paragraphs:
+            yield paragraph
+    buffer += decompressor.flush().decode('utf-8', errors='replace')
+    if buffer:
+        yield buffer
+
+async def chunk_paragraphs(paragraphs, max_tokens=CHUNK_MAX_TOKENS):
+    """Group streamed paragraphs into chunks of about max_tokens, splitting paragraphs that are too long on their own."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunk = []
+    chunk_chars = 0
+    async for paragraph in paragraphs:
+        while len(paragraph) > max_chars:
+            if chunk:
+                yield '\n\n'.join(chunk)
+                chunk, chunk_chars = [], 0
+            yield paragraph[:max_chars]
+            paragraph = paragraph[max_chars:]
+        if chunk_chars + len(paragraph) > max_chars:
+            yield '\n\n'.join(chunk)
+            chunk, chunk_chars = [], 0
+        chunk.append(paragraph)
+        chunk_chars += len(paragraph) + 2
+    if chunk:
+        yield '\n\n'.join(chunk)
+
+async def complete_async(client, rate_limiter, prompt, max_tokens, document_number, request_type, max_attempts=3):
+    """Send one plain-text prompt through the shared async client and return the response text."""
+    from anthropic import RateLimitError
+
+    estimated_tokens = (len(FULL_TEXT_SYSTEM_PROMPT) + len(prompt)) // CHARS_PER_TOKEN + max_tokens
+    for attempt in range(max_attempts):
+        await rate_limiter.acquire(estimated_tokens)
+        start_time = time.monotonic()
+        try:
+            message = await client.messages.create(
+                model=CLAUDE_MODEL,
+                max_tokens=max_tokens,
+                temperature=0,
+                system=FULL_TEXT_SYSTEM_PROMPT,
+                messages=[{"role": "user", "content": prompt}]
+            )
+            metrics.record_request('claude', 200, time.monotonic() - start_time)
+            record_usage([document_number], request_type, message.usage, time.monotonic() - start_time)
+            rate_limiter.settle(estimated_tokens, message.usage)
+            return ''.join(block.text for block in message.content if block.type == 'text').strip()
+        except RateLimitError as e:
+            metrics.record_request('claude', 429, time.monotonic() - start_time)
+            if attempt == max_attempts - 1:
+                raise
+            sleep_time = retry_after_seconds(e, 60)
+            logger.info(f"Rate limit exceeded. Waiting for {sleep_time:.2f} seconds before retrying.")
+            metrics.record_backoff('claude', sleep_time, 'rate_limited')
+            await asyncio.sleep(sleep_time)
+        except Exception as e:
+            metrics.record_request('claude', getattr(e, 'status_code', 'error'), time.monotonic() - start_time)
+            if attempt == max_attempts - 1:
+                raise
+            metrics.record_backoff('claude', 2 ** attempt, 'error')
+            await asyncio.sleep(2 ** attempt)
+
+async def reduce_summaries(client, rate_limiter, semaphore, document_number, title, summaries):
+    """Combine chunk summaries into one, merging them in groups first if they don't fit in a single request."""
+    while True:
+        groups = [[]]
+        group_chars = 0
+        for summary in summaries:
+            if groups[-1] and group_chars + len(summary) > CHUNK_MAX_TOKENS * CHARS_PER_TOKEN:
+                groups.append([])
+                group_chars = 0
+            groups[-1].append(summary)
+            group_chars += len(summary) + 2
+
+        async def reduce_group(group):
+            async with semaphore:
+                prompt = REDUCE_PROMPT.format(title=title, text='\n\n'.join(group))
+                return await complete_async(client, rate_limiter, prompt, FULL_SUMMARY_MAX_TOKENS, document_number, 'full_text_reduce')
+
+        summaries = await asyncio.gather(*(reduce_group(group) for group in groups))
+        if len(summaries) == 1:
+            return summaries[0]
+
+async def summarize_document(db, http_client, client, rate_limiter, semaphore, document):
+    """Summarize one document's full text into llm_summary_full, downloading it only if it isn't stored yet."""
+    document_number, title, full_text_xml_url, raw_text_url = document
+    compressed_text = await db.run(fetch_stored_text, document_number)
+    writer = None
+    if compressed_text is not None:
+        paragraphs = stored_paragraphs(compressed_text)
+    else:
+        source_url = full_text_xml_url or raw_text_url
+        writer = CompressedTextWriter()
+
+        async def downloaded_paragraphs():
+            async for paragraph in download_paragraphs(http_client, source_url, xml=bool(full_text_xml_url)):
+                writer.write(paragraph)
+                yield paragraph
+        paragraphs = downloaded_paragraphs()
+
+    async def summarize_chunk(part, chunk):
+        prompt = CHUNK_PROMPT.format(part=part, title=title, text=chunk)
+        return await complete_async(client, rate_limiter, prompt, CHUNK_SUMMARY_MAX_TOKENS, document_number, 'full_text_chunk')
+
+    # Taking a semaphore slot before creating each task keeps at most MAX_CONCURRENT_REQUESTS chunks in memory.
+    # The slot is released when the task is done, which includes being cancelled before it started.
+    tasks = []
+    try:
+        async for chunk in chunk_paragraphs(paragraphs):
+            await semaphore.acquire()
+            task = asyncio.create_task(summarize_chunk(len(tasks) + 1, chunk))
+            task.add_done_callback(lambda _: semaphore.release())
+            tasks.append(task)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    if writer is not None:
+        await db.run(store_text, document_number, source_url, writer.finish(), writer.length)
+    summaries = await asyncio.gather(*tasks)
+    if not summaries:
+        logger.warning(f"No text found for document {document_number}")
+        return False
+
+    if len(summaries) == 1:
+        summary = summaries[0]
+    else:
+        summary = await reduce_summaries(client, rate_limiter, semaphore, document_number, title, summaries)
+    await db.run(update_full_summary, document_number, summary)
+    logger.info(f"Summarized document {document_number} from {len(summaries)} chunks")
+    return True
+
+async def summarize_documents_async(conn, documents, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                                    max_requests_per_minute=MAX_REQUESTS_PER_MINUTE, max_tokens_per_minute=MAX_TOKENS_PER_MINUTE):
+    from tqdm import tqdm
+
+    client = create_async_claude_client(max_concurrency)
+    rate_limiter = ClaudeRateLimiter(max_requests_per_minute, max_tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    document_semaphore = asyncio.Semaphore(DOCUMENT_CONCURRENCY)
+    db = SharedConnection(conn)
+    summarized_count = 0
+
+    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT_SECONDS, follow_redirects=True) as http_client:
+        async def summarize_one(document):
+            async with document_semaphore:
+                try:
+                    return await summarize_document(db, http_client, client, rate_limiter, semaphore, document)
+                except Exception as e:
+                    logger.error(f"Error summarizing full text of document {document[0]}: {e}")
+                    return False
+                finally:
+                    await db.run(flush_usage_records)
+
+        try:
+            tasks = [asyncio.create_task(summarize_one(document)) for document in documents]
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Summarizing full texts"):
+                summarized_count += await task
+        finally:
+            await client.close()
+    return summarized_count
+
+def main(limit=50, force=False, max_concurrency=MAX_CONCURRENT_REQUESTS, max_requests_per_minute=MAX_REQUESTS_PER_MINUTE,
+         max_tokens_per_minute=MAX_TOKENS_PER_MINUTE):
+    logger.info("Full-text summarization started")
+    database_url = get_config().database_url
+    metrics.start_run('summarize_full_text')
+    status = 'failed'
+    try:
+        with pipeline_metrics.connect(database_url) as conn:
+            documents = fetch_documents_to_summarize(conn, limit, force)
+            logger.info(f"Fetched {len(documents)} documents to summarize")
+            summarized_count = asyncio.run(summarize_documents_async(conn, documents, max_concurrency, max_requests_per_minute,
+                                                                     max_tokens_per_minute))
+        metrics.inc('rows_processed_total', summarized_count, outcome='summarized')
+        status = 'succeeded'
+    finally:
+        metrics.finish_run(database_url, status)
+    logger.info(f"Wrote llm_summary_full for {summarized_count} of {len(documents)} documents")
+    logger.info(f"LLM usage: {usage_totals['requests']} requests, {usage_totals['input_tokens']} input tokens, "
+                f"{usage_totals['output_tokens']} output tokens")
+
+def cli(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Summarize the full text of AI-related documents into llm_summary_full.")
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--force', action='store_true', help="Re-summarize documents that already have a full summary.")
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument('--max-requests-per-minute', type=int, default=MAX_REQUESTS_PER_MINUTE)
+    parser.add_argument('--max-tokens-per-minute', type=int, default=MAX_TOKENS_PER_MINUTE)
+    args = parser.parse_args(argv)
+    main(limit=args.limit, force=args.force, max_concurrency=args.concurrency,
+         max_requests_per_minute=args.max_requests_per_minute, max_tokens_per_minute=args.max_tokens_per_minute)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,23 @@
+import re
+import zlib
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def hashed_term_counts(texts, n_features):
+    """Unigram and bigram counts hashed into n_features buckets, as flat (row, column, count) arrays sorted by row.
+
+    Shared by the pre-screen classifier and the similarity index.
+    """
+    columns = []
+    offsets = [0]
+    for text in texts:
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        terms = tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+        columns.extend(zlib.crc32(term.encode('utf-8')) for term in terms)
+        offsets.append(len(columns))
+    row_ids = np.repeat(np.arange(len(texts), dtype=np.int64), np.diff(offsets))
+    keys = row_ids * n_features + np.asarray(columns, dtype=np.int64) % n_features
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys // n_features, keys % n_features, counts
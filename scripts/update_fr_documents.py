@@ -1,130 +1,341 @@
-import json
+import argparse
+import asyncio
 import logging
 import os
-import psycopg2
+from psycopg2.extras import execute_values
 import time
-from datetime import datetime, timedelta
-from federal_register.client import FederalRegister
-from multiprocessing import Pool
-from tqdm import tqdm
-import requests
-from time import sleep
-
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import httpx
+from .config import get_config
+from .fr_http_cache import get_http_cache
+from . import pipeline_metrics
+from .pipeline_metrics import metrics
+
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+FR_DOCUMENTS_TABLE_NAME = os.environ.get('FR_DOCUMENTS_TABLE_NAME', 'fr_documents')
+AI_DOCUMENTS_TABLE_NAME = os.environ.get('AI_DOCUMENTS_TABLE_NAME', 'ai_documents')
+WRITE_BATCH_SIZE = 500
+# Document numbers per multi-ID documents request
+FETCH_BATCH_SIZE = int(os.environ.get('FR_FETCH_BATCH_SIZE', 100))
+COUNT_FIELDS = ['page_views', 'regulations_dot_gov_info']
+# Most multi-ID requests a single run may spend
+REFRESH_REQUEST_BUDGET = int(os.environ.get('REFRESH_REQUEST_BUDGET', 200))
+# How often each tier is due: documents open for comment, recent or still-changing documents, and everything else
+REFRESH_INTERVAL_SECONDS = {
+    'hot': int(os.environ.get('REFRESH_HOT_INTERVAL_SECONDS', 3600)),
+    'warm': int(os.environ.get('REFRESH_WARM_INTERVAL_SECONDS', 86400)),
+    'cold': int(os.environ.get('REFRESH_COLD_INTERVAL_SECONDS', 7 * 86400)),
+}
+REFRESH_WARM_MAX_AGE_DAYS = int(os.environ.get('REFRESH_WARM_MAX_AGE_DAYS', 30))
+# Combined change in page views and comments at the last refresh that keeps a document warm
+REFRESH_WARM_MIN_DELTA = int(os.environ.get('REFRESH_WARM_MIN_DELTA', 10))
+
+FR_API_BASE_URL = os.environ.get('FR_API_BASE_URL', 'https://www.federalregister.gov/api/v1')
+# All requests share one keep-alive connection pool, so concurrency costs sockets rather than processes
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('FR_MAX_CONCURRENT_REQUESTS', 100))
+MAX_REQUESTS_PER_MINUTE = int(os.environ.get('FR_MAX_REQUESTS_PER_MINUTE', 300))
+FETCH_RETRIES = 5
+HTTP_TIMEOUT_SECONDS = 30
+
+class AsyncRequestRateLimiter:
+    """Spaces out requests so that all tasks together stay under a per-minute cap."""
+
+    def __init__(self, max_requests_per_minute):
+        self.interval = 60.0 / max_requests_per_minute
+        self.next_slot = time.monotonic()
 
-DATABASE_URL = os.environ['DATABASE_URL']
-FR_DOCUMENTS_TABLE_NAME = os.environ['FR_DOCUMENTS_TABLE_NAME']
-AI_DOCUMENTS_TABLE_NAME = os.environ['AI_DOCUMENTS_TABLE_NAME']
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            metrics.record_throttle('federal_register', slot - now)
+            await asyncio.sleep(slot - now)
 
-# Initialize the Federal Register client
-federal_register_client = FederalRegister()
+    def pause(self, seconds):
+        """Hold back every request not yet sent, after the server has asked us to slow down."""
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
 
-def fetch_page_views_and_comments(document_number):
-    retries = 5
-    for attempt in range(retries):
+def extract_counts(document_number, document):
+    """Pull (page_views_count, comments_count) out of a document returned by the API."""
+    page_views_count = None
+    if 'page_views' in document:
+        page_views_data = document['page_views'] or {}
+        if 'count' in page_views_data:
+            page_views_count = page_views_data['count']
+        else:
+            logger.warning(f"Missing 'count' key in page_views data for document {document_number}: {page_views_data}")
+
+    comments_count = None
+    regulations_dot_gov_info = document.get('regulations_dot_gov_info') or {}
+    if 'comments_count' in regulations_dot_gov_info:
+        comments_count = regulations_dot_gov_info['comments_count']
+    else:
+        logger.warning(f"Missing 'comments_count' key in regulations_dot_gov_info for document {document_number}: {regulations_dot_gov_info}")
+
+    logger.debug(f"Page views count for document {document_number}: {page_views_count}")
+    logger.debug(f"Comments count for document {document_number}: {comments_count}")
+    return page_views_count, comments_count
+
+def retry_after_seconds(response, default):
+    """Seconds to wait before retrying, preferring the server's Retry-After header."""
+    try:
+        return float(response.headers.get('retry-after', default))
+    except (TypeError, ValueError):
+        return default
+
+async def get_json(client, rate_limiter, semaphore, url, params, description):
+    """GET a Federal Register API URL, retrying rate limits, server errors and network errors.
+
+    Responses come from http_cache while fresh and are revalidated with a
+    conditional request after that; its SQLite calls run in a worker thread
+    so they don't stall the other requests. Backoff sleeps outside the semaphore, so
+    a waiting request doesn't hold up others. Returns None if the request
+    keeps failing or the API says no.
+    """
+    http_cache = get_http_cache()
+    key, cached = await asyncio.to_thread(http_cache.lookup, url, params)
+    if cached is not None and cached.fresh:
+        return await asyncio.to_thread(http_cache.use, cached)
+
+    for attempt in range(FETCH_RETRIES):
+        await rate_limiter.wait()
+        delay = 2 ** attempt  # Exponential backoff
+        reason = 'error'
         try:
-            logger.debug(f"Fetching page views and comments count for document {document_number}")
-            document = federal_register_client.document_by_id(
-                document_id=document_number,
-                fields='page_views,regulations_dot_gov_info'
-            )
-
-            if document is None:
-                logger.warning(f"API returned None for document {document_number}")
-                return None, None
-
-            page_views_count = None
-            if 'page_views' in document:
-                page_views_data = document['page_views']
-                if 'count' in page_views_data:
-                    page_views_count = page_views_data['count']
-                else:
-                    logger.warning(f"Missing 'count' key in page_views data for document {document_number}: {page_views_data}")
-
-            comments_count = None
-            regulations_dot_gov_info = document.get('regulations_dot_gov_info', {})
-            if 'comments_count' in regulations_dot_gov_info:
-                comments_count = regulations_dot_gov_info['comments_count']
+            async with semaphore:
+                start_time = time.monotonic()
+                response = await client.get(url, params=params, headers=http_cache.conditional_headers(cached))
+        except httpx.HTTPError as e:
+            metrics.record_request('federal_register', 'error', time.monotonic() - start_time)
+            logger.error(f"Error fetching data for {description}: {e}")
+        else:
+            metrics.record_request('federal_register', response.status_code, time.monotonic() - start_time)
+            if response.status_code == 304 and cached is not None:
+                return await asyncio.to_thread(http_cache.use, cached, revalidated=True)
+            if response.status_code == 429:
+                delay = retry_after_seconds(response, delay)
+                reason = 'rate_limited'
+                rate_limiter.pause(delay)
+                logger.warning(f"Rate limited fetching {description}, retrying in {delay:.1f}s")
+            elif response.status_code >= 500:
+                logger.warning(f"API returned {response.status_code} for {description}, retrying in {delay}s")
+            elif response.is_success:
+                await asyncio.to_thread(http_cache.store, key, response.headers, response.content)
+                return response.json()
             else:
-                logger.warning(f"Missing 'comments_count' key in regulations_dot_gov_info for document {document_number}: {regulations_dot_gov_info}")
+                logger.warning(f"API returned {response.status_code} for {description}")
+                return None
+        if attempt < FETCH_RETRIES - 1:
+            metrics.record_backoff('federal_register', delay, reason)
+            await asyncio.sleep(delay)
+    return None
 
-            logger.debug(f"Page views count for document {document_number}: {page_views_count}")
-            logger.debug(f"Comments count for document {document_number}: {comments_count}")
-            return page_views_count, comments_count
+async def fetch_counts(client, rate_limiter, semaphore, document_numbers):
+    """Fetch a group of documents' counts in one multi-ID request.
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching data for document {document_number}: {e}")
-            if attempt < retries - 1:
-                sleep(2 ** attempt)  # Exponential backoff
-            else:
-                return None, None
+    Documents missing from a response are fetched one at a time, concurrently.
+    If the request itself fails, the whole group's counts are None rather
+    than retried one by one against an API that is already failing.
+    Returns (document_number, page_views_count, comments_count) for every document in the group.
+    """
+    response = await get_json(
+        client, rate_limiter, semaphore,
+        f"{FR_API_BASE_URL}/documents/{','.join(document_numbers)}.json",
+        {'fields[]': ['document_number'] + COUNT_FIELDS},
+        f"{len(document_numbers)} documents starting at {document_numbers[0]}"
+    )
+    if response is None:
+        return [(document_number, None, None) for document_number in document_numbers]
+    # A single document number gets the bare document back instead of a results list
+    results = response.get('results', [response] if 'document_number' in response else [])
+    documents = {document['document_number']: document for document in results}
 
-def update_page_views_and_comments(args):
-    document_number, previous_page_views_count, previous_comments_count, page_views_count_modified_at, comments_count_modified_at, table_name = args
-    page_views_count, comments_count = fetch_page_views_and_comments(document_number)
-    
-    if page_views_count is not None or comments_count is not None:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as cur:
-                update_query = f"UPDATE {table_name} SET"
-                update_fields = []
-                update_values = []
-
-                if page_views_count is not None:
-                    update_fields.append("page_views_count = %s")
-                    update_values.append(page_views_count)
-                    update_fields.append("page_views_count_modified_at = NOW()")
-                
-                if comments_count is not None:
-                    update_fields.append("comments_count = %s")
-                    update_values.append(comments_count)
-                    update_fields.append("comments_count_modified_at = NOW()")
-                
-                update_query += ", ".join(update_fields) + " WHERE document_number = %s"
-                update_values.append(document_number)
-
-                cur.execute(update_query, tuple(update_values))
-                conn.commit()
-                return 1
-
-    return 0
-
-def update_page_views_and_comments_in_postgres(table_name):
-    with psycopg2.connect(DATABASE_URL) as conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT document_number, page_views_count, comments_count, page_views_count_modified_at, comments_count_modified_at FROM {table_name}")
-            documents = cur.fetchall()
-
-    total_documents = len(documents)
-    logger.info(f"Total documents in {table_name}: {total_documents}")
-
-    with Pool() as pool:
-        args = [(doc[0], doc[1], doc[2], doc[3], doc[4], table_name) for doc in documents]
-        updated_counts = list(tqdm(pool.imap(update_page_views_and_comments, args), total=len(args), desc=f"Updating page views and comments for {table_name}"))
-
-    updated_count = sum(updated_counts)
-    logger.info(f"Updated page views and comments for {updated_count} out of {total_documents} documents in {table_name}")
-
-def main():
+    async def fetch_one(document_number):
+        logger.debug(f"Fetching page views and comments count for document {document_number}")
+        document = await get_json(client, rate_limiter, semaphore, f"{FR_API_BASE_URL}/documents/{document_number}.json",
+                                  {'fields[]': COUNT_FIELDS}, f"document {document_number}")
+        if document is None:
+            logger.warning(f"API returned None for document {document_number}")
+            return None, None
+        return extract_counts(document_number, document)
+
+    missing = [document_number for document_number in document_numbers if document_number not in documents]
+    fallback_counts = dict(zip(missing, await asyncio.gather(*(fetch_one(document_number) for document_number in missing))))
+    return [
+        (document_number, *(extract_counts(document_number, documents[document_number]) if document_number in documents
+                            else fallback_counts[document_number]))
+        for document_number in document_numbers
+    ]
+
+def write_counts(conn, table_name, counts):
+    """Write a batch of (document_number, page_views_count, comments_count) in one UPDATE.
+
+    A count that couldn't be fetched is None and leaves the stored value and its modified_at untouched.
+    """
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            f"""
+            UPDATE {table_name} AS t
+            SET page_views_count = COALESCE(data.page_views_count, t.page_views_count),
+                page_views_count_modified_at = CASE WHEN data.page_views_count IS NOT NULL THEN NOW() ELSE t.page_views_count_modified_at END,
+                comments_count = COALESCE(data.comments_count, t.comments_count),
+                comments_count_modified_at = CASE WHEN data.comments_count IS NOT NULL THEN NOW() ELSE t.comments_count_modified_at END,
+                counts_delta = COALESCE(ABS(data.page_views_count - t.page_views_count), 0) + COALESCE(ABS(data.comments_count - t.comments_count), 0)
+            FROM (VALUES %s) AS data (document_number, page_views_count, comments_count)
+            WHERE t.document_number = data.document_number
+            """,
+            counts,
+            template="(%s, %s::integer, %s::integer)",
+            page_size=len(counts)
+        )
+    conn.commit()
+
+def refresh_tier_sql(table_name):
+    """SQL CASE naming a row's refresh tier: hot while comments are open, warm while new or still changing, otherwise cold."""
+    return f"""
+        CASE WHEN {table_name}.comments_close_on >= CURRENT_DATE THEN 'hot'
+             WHEN {table_name}.publication_date >= CURRENT_DATE - {REFRESH_WARM_MAX_AGE_DAYS}
+                  OR COALESCE({table_name}.counts_delta, 0) >= {REFRESH_WARM_MIN_DELTA} THEN 'warm'
+             ELSE 'cold' END
+    """
+
+def refresh_candidates_sql(table_name):
+    """Rows of table_name due for a refresh, with how many of their tier's intervals have passed since the last one."""
+    # A count that has never been fetched counts as fetched at the epoch, so it's always due first
+    last_refreshed = (f"LEAST(COALESCE({table_name}.page_views_count_modified_at, 'epoch'), "
+                      f"COALESCE({table_name}.comments_count_modified_at, 'epoch'))")
+    interval_seconds = (f"CASE tier WHEN 'hot' THEN {REFRESH_INTERVAL_SECONDS['hot']} "
+                        f"WHEN 'warm' THEN {REFRESH_INTERVAL_SECONDS['warm']} ELSE {REFRESH_INTERVAL_SECONDS['cold']} END")
+    return f"""
+        SELECT document_number, tier, EXTRACT(EPOCH FROM NOW() - last_refreshed) / {interval_seconds} AS overdue
+        FROM (
+            SELECT document_number, {refresh_tier_sql(table_name)} AS tier, {last_refreshed} AS last_refreshed
+            FROM {table_name}
+        ) AS scored
+        WHERE EXTRACT(EPOCH FROM NOW() - last_refreshed) >= {interval_seconds}
+    """
+
+def select_refresh_candidates(conn, limit):
+    """Pick up to limit documents to refresh across both tables, most overdue first.
+
+    A document number in both tables appears once, in its more urgent tier.
+    Returns (document_number, tier) pairs.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT document_number, (ARRAY_AGG(tier ORDER BY overdue DESC))[1]
+            FROM (
+                {refresh_candidates_sql(FR_DOCUMENTS_TABLE_NAME)}
+                UNION ALL
+                {refresh_candidates_sql(AI_DOCUMENTS_TABLE_NAME)}
+            ) AS candidates
+            GROUP BY document_number
+            ORDER BY MAX(overdue) DESC
+            LIMIT %s
+            """,
+            (limit,)
+        )
+        return cur.fetchall()
+
+def write_counts_to_both_tables(conn, counts):
+    write_counts(conn, FR_DOCUMENTS_TABLE_NAME, counts)
+    write_counts(conn, AI_DOCUMENTS_TABLE_NAME, counts)
+
+async def refresh_counts_async(conn, document_numbers, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                               max_requests_per_minute=MAX_REQUESTS_PER_MINUTE):
+    """Fetch counts for document_numbers with up to max_concurrency requests in flight, writing as results arrive.
+
+    Returns the number of documents updated.
+    """
+    from tqdm import tqdm
+
+    rate_limiter = AsyncRequestRateLimiter(max_requests_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+    groups = [document_numbers[i:i + FETCH_BATCH_SIZE] for i in range(0, len(document_numbers), FETCH_BATCH_SIZE)]
+
+    # This coroutine is the single writer, flushing every WRITE_BATCH_SIZE results
+    updated_count = 0
+    pending = []
+    async with httpx.AsyncClient(limits=limits, timeout=HTTP_TIMEOUT_SECONDS) as client:
+        tasks = [asyncio.create_task(fetch_counts(client, rate_limiter, semaphore, group)) for group in groups]
+        with tqdm(total=len(document_numbers), desc="Updating page views and comments") as progress:
+            for task in asyncio.as_completed(tasks):
+                counts = await task
+                progress.update(len(counts))
+                pending.extend(count for count in counts if count[1] is not None or count[2] is not None)
+                if len(pending) >= WRITE_BATCH_SIZE:
+                    await asyncio.to_thread(write_counts_to_both_tables, conn, pending)
+                    updated_count += len(pending)
+                    pending = []
+    if pending:
+        await asyncio.to_thread(write_counts_to_both_tables, conn, pending)
+        updated_count += len(pending)
+    metrics.inc('rows_processed_total', updated_count, outcome='updated')
+    metrics.inc('rows_processed_total', len(document_numbers) - updated_count, outcome='failed')
+    return updated_count
+
+async def refresh_due_counts_async(conn, request_budget=REFRESH_REQUEST_BUDGET, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                                   max_requests_per_minute=MAX_REQUESTS_PER_MINUTE):
+    """Refresh the most overdue documents' counts, spending at most about request_budget API requests.
+
+    The budget is counted in multi-ID requests of FETCH_BATCH_SIZE documents;
+    per-document fallbacks for IDs missing from a response come on top.
+    Each document is fetched once and written to both tables. Returns the
+    number of documents updated.
+    """
+    candidates = await asyncio.to_thread(select_refresh_candidates, conn, request_budget * FETCH_BATCH_SIZE)
+    tier_counts = {}
+    for _, tier in candidates:
+        tier_counts[tier] = tier_counts.get(tier, 0) + 1
+    logger.info(f"Selected {len(candidates)} documents due for a refresh: {tier_counts}")
+
+    document_numbers = [document_number for document_number, _ in candidates]
+    updated_count = await refresh_counts_async(conn, document_numbers, max_concurrency, max_requests_per_minute)
+    logger.info(f"Updated page views and comments for {updated_count} out of {len(document_numbers)} documents")
+    return updated_count
+
+def refresh_page_views_and_comments(request_budget=REFRESH_REQUEST_BUDGET, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                                    max_requests_per_minute=MAX_REQUESTS_PER_MINUTE):
+    with pipeline_metrics.connect(get_config().database_url) as conn:
+        asyncio.run(refresh_due_counts_async(conn, request_budget, max_concurrency, max_requests_per_minute))
+    get_http_cache().finish_run()
+
+def main(request_budget=REFRESH_REQUEST_BUDGET, max_concurrency=MAX_CONCURRENT_REQUESTS,
+         max_requests_per_minute=MAX_REQUESTS_PER_MINUTE):
     logger.info("Starting page views and comments update process")
     start_time = time.time()
+    metrics.start_run('refresh')
+    status = 'failed'
     
     try:
-        # Update page views and comments for FR_DOCUMENTS_TABLE_NAME
-        update_page_views_and_comments_in_postgres(FR_DOCUMENTS_TABLE_NAME)
-
-        # Update page views and comments for AI_DOCUMENTS_TABLE_NAME
-        update_page_views_and_comments_in_postgres(AI_DOCUMENTS_TABLE_NAME)
+        # Refresh FR_DOCUMENTS_TABLE_NAME and AI_DOCUMENTS_TABLE_NAME together, most overdue documents first
+        refresh_page_views_and_comments(request_budget, max_concurrency, max_requests_per_minute)
 
         logger.info("Process completed successfully")
+        status = 'succeeded'
     except Exception as e:
         logger.exception(f"An error occurred: {e}")
+    finally:
+        metrics.finish_run(get_config().database_url, status)
 
     end_time = time.time()
     execution_time = end_time - start_time
     logger.info(f"Page views and comments update process finished in {execution_time:.2f} seconds")
 
+def cli(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Refresh page views and comment counts of Federal Register documents.")
+    parser.add_argument('--request-budget', type=int, default=REFRESH_REQUEST_BUDGET)
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument('--max-requests-per-minute', type=int, default=MAX_REQUESTS_PER_MINUTE)
+    args = parser.parse_args(argv)
+    main(request_budget=args.request_budget, max_concurrency=args.concurrency, max_requests_per_minute=args.max_requests_per_minute)
+
 if __name__ == '__main__':
-    main()
+    cli()
@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='ai-policy-docs',
     version='1.0.0',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     include_package_data=True,
     install_requires=[
         'requests',
@@ -11,13 +11,22 @@ setup(
         'python-dateutil',
         'psycopg2',
         'tqdm',
-        'anthropic'
+        'anthropic',
+        'httpx',
+        'numpy'
     ],
+    extras_require={
+        'test': ['pytest'],
+    },
     entry_points={
         'console_scripts': [
-            'pull_fr_documents = scripts.pull_fr_documents:main',
-            'summarize_fr_documents = scripts.summarize_fr_documents:main',
-            'update_fr_documents = scripts.update_fr_documents:main',
+            'pull_fr_documents = scripts.pull_fr_documents:cli',
+            'summarize_fr_documents = scripts.summarize_fr_documents:cli',
+            'update_fr_documents = scripts.update_fr_documents:cli',
+            'summarize_full_text = scripts.summarize_full_text:cli',
+            'build_similarity_index = scripts.build_similarity_index:cli',
+            'pipeline_daemon = scripts.pipeline_daemon:cli',
+            'migrate_database = scripts.migrate:cli',
         ],
     },
 )
\ No newline at end of file
@@ -0,0 +1,42 @@
+import importlib
+
+import pytest
+
+from scripts import migrate
+
+def test_load_migrations_in_version_order():
+    loaded = migrate.load_migrations()
+    versions = [migration.version for migration in loaded]
+    assert versions == sorted(versions)
+    assert versions[:4] == [1, 2, 3, 4]
+    assert [migration.name for migration in loaded[:4]] == ['initial_schema', 'pipeline_tables', 'typed_columns', 'indexes']
+    for migration in loaded:
+        assert hasattr(migration.module, 'SQL') or hasattr(migration.module, 'upgrade')
+
+@pytest.fixture
+def migrations_package(tmp_path, monkeypatch):
+    """Point load_migrations at an empty package in tmp_path; returns a function adding a module to it."""
+    # Named after the test, so no two tests share an entry in sys.modules
+    package = tmp_path / f'migrations_{tmp_path.name}'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(migrate, 'migrations', importlib.import_module(package.name))
+
+    def add_module(name):
+        (package / f'{name}.py').write_text("SQL = 'SELECT 1'\n")
+        importlib.invalidate_caches()
+    return add_module
+
+def test_load_migrations_sorts_numerically_and_skips_other_modules(migrations_package):
+    for name in ('0010_later', '0002_second', '0001_first', 'helpers', '12_short'):
+        migrations_package(name)
+    assert [(migration.version, migration.name) for migration in migrate.load_migrations()] == [
+        (1, 'first'), (2, 'second'), (10, 'later'),
+    ]
+
+def test_load_migrations_rejects_duplicate_versions(migrations_package):
+    migrations_package('0001_first')
+    migrations_package('0001_other')
+    with pytest.raises(RuntimeError, match='Duplicate migration versions'):
+        migrate.load_migrations()
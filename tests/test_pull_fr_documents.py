@@ -0,0 +1,92 @@
+from scripts.pull_fr_documents import FRDocumentRecord, _copy_text, split_date_range
+
+def api_document(**overrides):
+    doc = {
+        'abstract': 'Requests comments on the use of artificial intelligence.',
+        'action': 'Request for information.',
+        'agency_names': ['Commerce Department', 'National Institute of Standards and Technology'],
+        'document_number': '2024-01234',
+        'docket_ids': ['NIST-2024-0001'],
+        'publication_date': '2024-01-15',
+        'comments_close_on': '2024-02-15',
+        'page_views': {'count': 120},
+        'regulations_dot_gov_info': {'docket_comments_count': 4},
+        'significant': False,
+        'title': 'Artificial Intelligence Risk Management',
+        'topics': ['Science and technology'],
+        'type': 'Notice',
+    }
+    doc.update(overrides)
+    return doc
+
+def test_split_date_range_by_week():
+    assert split_date_range('2024-01-01', '2024-01-17', 'week') == [
+        ('2024-01-01', '2024-01-07'),
+        ('2024-01-08', '2024-01-14'),
+        ('2024-01-15', '2024-01-17'),
+    ]
+
+def test_split_date_range_by_day_is_inclusive():
+    assert split_date_range('2024-02-28', '2024-03-01', 'day') == [
+        ('2024-02-28', '2024-02-28'),
+        ('2024-02-29', '2024-02-29'),
+        ('2024-03-01', '2024-03-01'),
+    ]
+
+def test_split_date_range_single_day_and_empty():
+    assert split_date_range('2024-01-01', '2024-01-01', 'week') == [('2024-01-01', '2024-01-01')]
+    assert split_date_range('2024-01-02', '2024-01-01', 'week') == []
+
+def test_content_hash_ignores_volatile_columns():
+    record = FRDocumentRecord.from_api(api_document())
+    refreshed = FRDocumentRecord.from_api(api_document(page_views={'count': 9999},
+                                                       regulations_dot_gov_info={'docket_comments_count': 50}))
+    assert refreshed.content_hash == record.content_hash
+
+def test_content_hash_changes_with_content():
+    record = FRDocumentRecord.from_api(api_document())
+    assert FRDocumentRecord.from_api(api_document(title='A different title')).content_hash != record.content_hash
+    assert FRDocumentRecord.from_api(api_document(topics=['Other'])).content_hash != record.content_hash
+
+def test_content_hash_matches_comma_joined_lists():
+    # Rows stored before the list columns became arrays were hashed with the lists joined by ', '
+    record = FRDocumentRecord.from_api(api_document())
+    joined = FRDocumentRecord(*record.values())
+    joined.agency_names = ', '.join(record.agency_names)
+    joined.docket_ids = ', '.join(record.docket_ids)
+    joined.topics = ', '.join(record.topics)
+    assert joined.compute_content_hash() == record.content_hash
+
+def test_copy_text_scalars():
+    assert _copy_text(None) == '\\N'
+    assert _copy_text(True) == 't'
+    assert _copy_text(False) == 'f'
+    assert _copy_text(42) == '42'
+    assert _copy_text('') == ''
+
+def test_copy_text_escapes_control_characters():
+    assert _copy_text('a\tb\nc\rd\\e') == 'a\\tb\\nc\\rd\\\\e'
+
+def test_copy_text_arrays():
+    assert _copy_text([]) == '{}'
+    assert _copy_text(['Commerce Department', 'NIST']) == '{"Commerce Department","NIST"}'
+    # Quotes and backslashes are escaped once for the array literal, then the backslashes again for COPY
+    assert _copy_text(['say "hi"', 'a\\b', 'x,y']) == '{"say \\\\"hi\\\\"","a\\\\\\\\b","x,y"}'
+
+def test_from_api_builds_lists():
+    record = FRDocumentRecord.from_api(api_document())
+    assert record.agency_names == ['Commerce Department', 'National Institute of Standards and Technology']
+    assert record.docket_ids == ['NIST-2024-0001']
+    assert record.topics == ['Science and technology']
+    assert record.page_views_count == 120
+    assert record.comments_count == 4
+    assert record.content_hash == record.compute_content_hash()
+    assert len(record.values()) == len(FRDocumentRecord.COLUMNS)
+
+def test_copy_line_has_one_field_per_column():
+    line = FRDocumentRecord.from_api(api_document()).copy_line()
+    assert line.endswith('\n')
+    fields = line[:-1].split('\t')
+    assert len(fields) == len(FRDocumentRecord.COLUMNS)
+    assert fields[FRDocumentRecord.COLUMNS.index('agency_names')] == \
+        '{"Commerce Department","National Institute of Standards and Technology"}'
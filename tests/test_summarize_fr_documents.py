@@ -0,0 +1,159 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from scripts import summarize_fr_documents as summarize
+from scripts.summarize_fr_documents import (
+    ALLOWED_TAGS, MINHASH_BANDS, MINHASH_PERMUTATIONS, ROW_COLUMN_NAMES, TokenBucket, band_keys, minhash_signatures,
+    pack_rows, parse_packed_response, validate_classification,
+)
+
+def make_row(document_number, **fields):
+    values = dict.fromkeys(ROW_COLUMN_NAMES, '')
+    values.update(document_number=document_number, title=f"Document {document_number}", page_views_count=0)
+    values.update(fields)
+    return tuple(values[column] for column in ROW_COLUMN_NAMES)
+
+def tool_use(classifications):
+    return [SimpleNamespace(type='tool_use', input={'classifications': classifications})]
+
+def text(value):
+    return [SimpleNamespace(type='text', text=value)]
+
+def test_token_bucket_acquires_within_capacity_without_waiting():
+    async def run():
+        bucket = TokenBucket(600)
+        start_time = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire(100)
+        return time.monotonic() - start_time, bucket.tokens
+    elapsed, tokens = asyncio.run(run())
+    assert elapsed < 0.05
+    assert tokens < 1
+
+def test_token_bucket_waits_for_refill():
+    async def run():
+        bucket = TokenBucket(600)  # 10 tokens a second
+        await bucket.acquire(600)
+        start_time = time.monotonic()
+        await bucket.acquire(2)
+        return time.monotonic() - start_time
+    assert 0.15 <= asyncio.run(run()) < 1
+
+def test_token_bucket_caps_amount_at_capacity():
+    async def run():
+        bucket = TokenBucket(60)
+        await bucket.acquire(1000)
+        return bucket.tokens
+    assert asyncio.run(run()) < 1
+
+def test_token_bucket_settle_carries_debt():
+    async def run():
+        bucket = TokenBucket(600)
+        await bucket.acquire(600)
+        bucket.settle(estimated=0, actual=2)
+        assert bucket.tokens < 0
+        start_time = time.monotonic()
+        await bucket.acquire(1)
+        return time.monotonic() - start_time
+    # 2 tokens of debt plus the 1 acquired
+    assert 0.25 <= asyncio.run(run()) < 1
+
+def test_token_bucket_settle_refunds_overestimate():
+    async def run():
+        bucket = TokenBucket(600)
+        await bucket.acquire(600)
+        bucket.settle(estimated=500, actual=100)
+        return bucket.tokens
+    assert asyncio.run(run()) >= 400
+
+def test_pack_rows_respects_pack_size():
+    rows = [make_row(str(i)) for i in range(7)]
+    packs = pack_rows(rows, max_pack_size=3)
+    assert [len(pack) for pack in packs] == [3, 3, 1]
+    assert [row for pack in packs for row in pack] == rows
+
+def test_pack_rows_respects_input_budget():
+    long_abstract = 'x' * (summarize.PACK_MAX_INPUT_TOKENS * 4 // 2)
+    rows = [make_row(str(i), abstract=long_abstract) for i in range(3)]
+    assert [len(pack) for pack in pack_rows(rows, max_pack_size=10)] == [1, 1, 1]
+
+def test_pack_rows_keeps_oversized_row():
+    rows = [make_row('1', abstract='x' * (summarize.PACK_MAX_INPUT_TOKENS * 8))]
+    assert pack_rows(rows) == [rows]
+    assert pack_rows([]) == []
+
+def test_parse_packed_response_from_tool_use():
+    rows = [make_row('2024-1'), make_row('2024-2'), make_row('2024-3')]
+    content = tool_use([
+        {'document_number': '2024-1', 'ai_related': 1, 'llm_summary': '* AI', 'tags': [ALLOWED_TAGS[0]]},
+        {'document_number': '2024-2', 'ai_related': 5, 'llm_summary': '', 'tags': []},
+        {'document_number': '2024-9', 'ai_related': 0, 'llm_summary': '', 'tags': []},
+    ])
+    processed = parse_packed_response(rows, content, '2024-06-01')
+    # The invalid classification and the unrequested document are dropped; the missing one is left for a retry
+    assert list(processed) == ['2024-1']
+    assert processed['2024-1']['ai_related'] == 1
+    assert processed['2024-1']['llm_summary'] == '* AI'
+    assert processed['2024-1']['tags'] == [ALLOWED_TAGS[0]]
+    assert processed['2024-1']['title'] == 'Document 2024-1'
+
+def test_parse_packed_response_salvages_truncated_text():
+    rows = [make_row('2024-1'), make_row('2024-2')]
+    content = text(
+        '{"classifications": [{"document_number": "2024-1", "ai_related": 0, "llm_summary": "", "tags": []}, '
+        '{"document_number": "2024-2", "ai_related": 1, "llm_sum'
+    )
+    processed = parse_packed_response(rows, content, '2024-06-01')
+    assert list(processed) == ['2024-1']
+    assert processed['2024-1']['ai_related'] == 0
+
+def test_validate_classification():
+    result = {'ai_related': 1, 'llm_summary': '* Summary', 'tags': ['Healthcare', 'Not a tag']}
+    assert validate_classification(result) == (1, '* Summary', ['Healthcare'])
+
+def test_validate_classification_accepts_string_flag():
+    assert validate_classification({'ai_related': ' 0 ', 'llm_summary': '', 'tags': []}) == (0, '', [])
+
+@pytest.mark.parametrize('result', [
+    [],
+    {'ai_related': 2, 'llm_summary': '', 'tags': []},
+    {'ai_related': 'yes', 'llm_summary': '', 'tags': []},
+    {'ai_related': 1, 'tags': []},
+    {'ai_related': 1, 'llm_summary': '', 'tags': 'Healthcare'},
+])
+def test_validate_classification_rejects(result):
+    with pytest.raises(ValueError):
+        validate_classification(result)
+
+def test_minhash_signatures():
+    rows = [
+        make_row('1', abstract='Request for comments on the use of artificial intelligence in medical devices, docket 2024-001'),
+        make_row('2', abstract='Request for comments on the use of artificial intelligence in medical devices, docket 2025-417'),
+        make_row('3', abstract='Fishery closure for red snapper in the Gulf of Mexico', title='Fisheries'),
+        make_row('4', title=''),
+    ]
+    signatures, has_text = minhash_signatures(rows)
+    assert signatures.shape == (4, MINHASH_PERMUTATIONS)
+    assert has_text.tolist() == [True, True, True, False]
+    # Numbers are masked, so rows differing only in dates and docket numbers get the same signature
+    assert np.array_equal(signatures[0], signatures[1])
+    assert (signatures[0] == signatures[2]).mean() < 0.5
+    assert np.array_equal(minhash_signatures(rows[:1])[0][0], signatures[0])
+
+def test_band_keys():
+    rows = [
+        make_row('1', abstract='Request for comments on the use of artificial intelligence in medical devices'),
+        make_row('2', abstract='Request for comments on the use of artificial intelligence in medical devices'),
+        make_row('3', abstract='Fishery closure for red snapper in the Gulf of Mexico', title='Fisheries'),
+    ]
+    signatures, _ = minhash_signatures(rows)
+    keys = band_keys(signatures)
+    assert keys.shape == (3, MINHASH_BANDS)
+    # The band number is in the low bits, so equal keys always come from the same band
+    assert (keys % MINHASH_BANDS == np.arange(MINHASH_BANDS)).all()
+    assert np.array_equal(keys[0], keys[1])
+    assert not set(keys[0]) & set(keys[2])
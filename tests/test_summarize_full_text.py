@@ -0,0 +1,32 @@
+import asyncio
+
+from scripts.summarize_full_text import CHARS_PER_TOKEN, chunk_paragraphs
+
+async def stream(paragraphs):
+    for paragraph in paragraphs:
+        yield paragraph
+
+def chunks(paragraphs, max_tokens):
+    async def collect():
+        return [chunk async for chunk in chunk_paragraphs(stream(paragraphs), max_tokens)]
+    return asyncio.run(collect())
+
+def test_chunk_paragraphs_groups_short_paragraphs():
+    paragraphs = ['a' * 10, 'b' * 10, 'c' * 10, 'd' * 10]
+    # 30 characters fit two paragraphs with their separator, but not three
+    assert chunks(paragraphs, 30 // CHARS_PER_TOKEN + 1) == ['a' * 10 + '\n\n' + 'b' * 10, 'c' * 10 + '\n\n' + 'd' * 10]
+
+def test_chunk_paragraphs_splits_long_paragraph():
+    max_chars = 10 * CHARS_PER_TOKEN
+    result = chunks(['intro', 'x' * (max_chars * 2 + 5), 'outro'], 10)
+    assert result == ['intro', 'x' * max_chars, 'x' * max_chars, 'x' * 5 + '\n\n' + 'outro']
+
+def test_chunk_paragraphs_keeps_all_text_in_order():
+    paragraphs = [f"paragraph {i} " * (i % 7 + 1) for i in range(50)]
+    result = chunks(paragraphs, 20)
+    assert all(len(chunk) <= 20 * CHARS_PER_TOKEN for chunk in result)
+    # Split paragraphs aren't rejoined with a separator, so compare without them
+    assert ''.join(result).replace('\n\n', '') == ''.join(paragraphs)
+
+def test_chunk_paragraphs_empty():
+    assert chunks([], 10) == []